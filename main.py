@@ -1,5 +1,9 @@
-import wx, socket, json, threading, datetime, wx.adv, configparser, ssl, sys, os, base64, uuid, subprocess, tempfile, re, time
+import wx, socket, json, threading, datetime, wx.adv, configparser, ssl, sys, os, base64, uuid, subprocess, tempfile, re, time, struct, zlib
 import keyring
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 try:
     from accessible_output2.outputs.auto import Auto as _AO2Auto
@@ -91,6 +95,7 @@ def load_server_config():
         'cafile': config.get('server', 'cafile', fallback=None),
         'max_retries': config.getint('server', 'max_retries', fallback=5),
         'retry_timeout': config.getint('server', 'retry_timeout', fallback=15),
+        'compression': config.getboolean('server', 'compression', fallback=False),
     }
 
 def get_config_dir():
@@ -543,19 +548,151 @@ class StatusDialog(wx.Dialog):
             self.status_text.SetValue(sel); self.sizer.Hide(self.custom_box); self.panel.Layout()
             self.SetSize((350, 150))
 
+# Contexts live for the whole process: a TLS session can only be resumed through the
+# context that created it, and reconnecting with a saved session skips the full handshake.
+_tls_contexts = {}
+_tls_sessions = {}
+
+def _tls_context(verify):
+    context = _tls_contexts.get(verify)
+    if context is None:
+        if not verify:
+            context = ssl.create_default_context(); context.check_hostname = False; context.verify_mode = ssl.CERT_NONE
+        elif SERVER_CONFIG['cafile'] and os.path.exists(SERVER_CONFIG['cafile']):
+            context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=SERVER_CONFIG['cafile'])
+        else: context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+        _tls_contexts[verify] = context
+    return context
+
+def _wrap_tls(sock, verify):
+    context = _tls_context(verify)
+    session = _tls_sessions.get((verify, ADDR))
+    try: return context.wrap_socket(sock, server_hostname=SERVER_CONFIG['host'], session=session)
+    except ValueError:
+        # The saved session no longer fits this context; fall back to a full handshake.
+        _tls_sessions.pop((verify, ADDR), None)
+        return context.wrap_socket(sock, server_hostname=SERVER_CONFIG['host'])
+
+def _remember_tls_session(ssock):
+    # TLS 1.3 tickets arrive after the handshake, so call this once a reply has been read.
+    if not isinstance(ssock, ssl.SSLSocket) or ssock.session is None: return
+    verify = ssock.context.verify_mode != ssl.CERT_NONE
+    _tls_sessions[(verify, ADDR)] = ssock.session
+    if ssock.session_reused: print("Resumed TLS session with the server.")
+
 def create_secure_socket(timeout=None):
     sock = socket.create_connection(ADDR, timeout=timeout)
-    if SERVER_CONFIG['cafile'] and os.path.exists(SERVER_CONFIG['cafile']):
-        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=SERVER_CONFIG['cafile'])
-    else: context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-    try: return context.wrap_socket(sock, server_hostname=SERVER_CONFIG['host'])
+    try: return _wrap_tls(sock, True)
     except ssl.SSLCertVerificationError:
         sock.close(); sock = socket.create_connection(ADDR, timeout=timeout)
-        context = ssl.create_default_context(); context.check_hostname = False; context.verify_mode = ssl.CERT_NONE
-        return context.wrap_socket(sock, server_hostname=SERVER_CONFIG['host'])
+        return _wrap_tls(sock, False)
     except (ssl.SSLError, OSError):
         sock.close(); return socket.create_connection(ADDR, timeout=timeout)
 
+# Binary frames negotiated at login: 1 byte of flags, 4 byte body length, msgpack body.
+_FRAME_HEADER = struct.Struct("!BI")
+
+# Feature caps last received per (server, user). A reconnect offers the version held
+# so the server only sends what changed since.
+_feature_caps = {}
+# Resume tokens per (server, user), handed out at password login. Reconnects present
+# the token so the server can skip the password check; they are never written to disk.
+_resume_tokens = {}
+
+def _client_caps(username):
+    caps = {"framing": ["msgpack"]} if msgpack is not None else {}
+    caps["batching"] = True
+    caps["heartbeat"] = True
+    caps["caps_delta"] = True
+    caps["offline_ack"] = True
+    caps["resume"] = True
+    held = _feature_caps.get((ADDR, username))
+    if held and held.get("version") is not None: caps["caps_version"] = held["version"]
+    if SERVER_CONFIG.get('compression'): caps["compression"] = ["zlib"]
+    return caps
+
+class ServerConnection:
+    """The logged-in server socket. Callers keep writing JSON lines with sendall();
+    when the server agreed to binary framing those lines are re-encoded as frames."""
+    def __init__(self, sock, codec="json", caps=None):
+        self.raw_socket = sock
+        self.codec = codec
+        self.caps = caps or {}
+        self.last_rx = time.monotonic()
+        self._send_lock = threading.Lock()
+
+    def send(self, payload):
+        if self.codec == "msgpack":
+            body = msgpack.packb(payload, use_bin_type=True)
+            data = _FRAME_HEADER.pack(0, len(body)) + body
+        else:
+            data = (json.dumps(payload) + "\n").encode()
+        with self._send_lock:
+            self.raw_socket.sendall(data)
+
+    def sendall(self, data):
+        if self.codec == "json":
+            with self._send_lock:
+                self.raw_socket.sendall(data)
+            return
+        for line in data.splitlines():
+            if line.strip():
+                self.send(json.loads(line))
+
+    def __getattr__(self, name):
+        return getattr(self.raw_socket, name)
+
+class _InflateStream:
+    """read()/readline() over a zlib stream the server deflates and sync-flushes per write."""
+    def __init__(self, raw):
+        self.raw = raw
+        self._z = zlib.decompressobj()
+        self._buf = bytearray()
+
+    def _fill(self):
+        chunk = self.raw.read1(65536)
+        if not chunk: return False
+        self._buf += self._z.decompress(chunk)
+        return True
+
+    def read(self, n):
+        while len(self._buf) < n and self._fill(): pass
+        out = bytes(self._buf[:n]); del self._buf[:n]
+        return out
+
+    def readline(self):
+        start = 0
+        while True:
+            i = self._buf.find(b"\n", start)
+            if i >= 0:
+                out = bytes(self._buf[:i + 1]); del self._buf[:i + 1]
+                return out
+            start = len(self._buf)
+            if not self._fill():
+                out = bytes(self._buf); self._buf.clear()
+                return out
+
+class FrameReader:
+    """Iterates decoded frames (dicts) from the server's byte stream."""
+    def __init__(self, raw, codec="json", compression=None):
+        self.raw = _InflateStream(raw) if compression == "zlib" else raw
+        self.codec = codec
+
+    def __iter__(self):
+        while True:
+            if self.codec == "msgpack":
+                header = self.raw.read(_FRAME_HEADER.size)
+                if len(header) < _FRAME_HEADER.size: return
+                flags, length = _FRAME_HEADER.unpack(header)
+                if flags: raise ValueError(f"Unsupported frame flags {flags:#x}")
+                body = self.raw.read(length)
+                if len(body) < length: return
+                yield msgpack.unpackb(body, raw=False)
+            else:
+                line = self.raw.readline()
+                if not line: return
+                yield json.loads(line)
+
 class ClientApp(wx.App):
     def OnInit(self):
         self.instance_checker = wx.SingleInstanceChecker("ThriveMessenger-%s" % wx.GetUserId())
@@ -634,16 +771,27 @@ class ClientApp(wx.App):
                     save_user_config(self.user_config); self.start_main_session(dlg.new_username, sock, sf); return True
             else: return False
     
-    def perform_login(self, username, password, silent=False, connect_timeout=None):
+    def perform_login(self, username, password, silent=False, connect_timeout=None, resume_token=None):
+        self.login_retry_after = 0
         try:
             ssock = create_secure_socket(timeout=connect_timeout)
             ssock.settimeout(None)  # switch to blocking after connect
-            ssock.sendall(json.dumps({"action":"login","user":username,"pass":password}).encode()+b"\n")
-            sf = ssock.makefile()
-            resp = json.loads(sf.readline() or "{}")
-            if resp.get("status") == "ok": return True, ssock, sf, "Success"
+            if resume_token: req = {"action":"resume","token":resume_token,"caps":_client_caps(username)}
+            else: req = {"action":"login","user":username,"pass":password,"caps":_client_caps(username)}
+            ssock.sendall(json.dumps(req).encode()+b"\n")
+            raw = ssock.makefile("rb")
+            resp = json.loads(raw.readline() or b"{}")
+            if resp.get("status") == "ok":
+                _remember_tls_session(ssock)
+                if resp.get("resume"): _resume_tokens[(ADDR, username)] = resp["resume"]["token"]
+                caps = resp.get("caps") or {}
+                codec = caps.get("framing", "json")
+                return True, ServerConnection(ssock, codec, caps), FrameReader(raw, codec, caps.get("compression")), "Success"
             else:
                 reason = resp.get("reason", "Unknown error")
+                if resp.get("resume") == "invalid": _resume_tokens.pop((ADDR, username), None)
+                # The server throttles login bursts and says when the next attempt will be let in.
+                self.login_retry_after = min(300, max(0, int(resp.get("retry_after") or 0)))
                 if not silent: wx.MessageBox("Login failed: " + reason, "Login Failed", wx.ICON_ERROR)
                 ssock.close(); return False, None, None, reason
         except Exception as e:
@@ -672,13 +820,24 @@ class ClientApp(wx.App):
     def listen_loop(self):
         sock = self.sock
         handled = False
+        heartbeat = getattr(sock, "caps", {}).get("heartbeat")
+        if heartbeat:
+            threading.Thread(target=self.heartbeat_loop, args=(sock, heartbeat["interval"], heartbeat["misses"]), daemon=True).start()
         try:
-            for line in self.sockfile:
-                msg = json.loads(line); act = msg.get("action")
-                if act == "contact_list": wx.CallAfter(self.frame.load_contacts, msg["contacts"])
+            for msg in self.sockfile:
+                sock.last_rx = time.monotonic()
+                act = msg.get("action")
+                if act == "ping": sock.send({"action": "pong"})
+                elif act == "pong": pass
+                elif act == "contact_list": wx.CallAfter(self.frame.load_contacts, msg["contacts"])
                 elif act == "contact_status": wx.CallAfter(self.frame.update_contact_status, msg["user"], msg["online"], msg.get("status_text"))
+                elif act == "events": wx.CallAfter(self.on_events, msg["events"])
+                elif act in ("feature_caps", "feature_caps_delta"): self.on_feature_caps(msg)
                 elif act == "msg": wx.CallAfter(self.frame.receive_message, msg)
                 elif act == "msg_failed": wx.CallAfter(self.frame.on_message_failed, msg["to"], msg["reason"])
+                elif act == "rate_limited":
+                    # Dropped typing or call signals need no notice; a dropped message does.
+                    if msg.get("for") == "msg": wx.CallAfter(self.frame.on_message_failed, msg.get("to"), msg["reason"])
                 elif act == "add_contact_failed": wx.CallAfter(self.frame.on_add_contact_failed, msg["reason"])
                 elif act == "add_contact_success": wx.CallAfter(self.frame.on_add_contact_success, msg["contact"])
                 elif act == "admin_response": wx.CallAfter(self.frame.on_admin_response, msg["response"])
@@ -691,7 +850,7 @@ class ClientApp(wx.App):
                 elif act == "file_accepted": wx.CallAfter(self.on_file_accepted, msg)
                 elif act == "file_declined": wx.CallAfter(self.on_file_declined, msg)
                 elif act == "file_data": wx.CallAfter(self.on_file_data, msg)
-                elif act == "offline_messages": wx.CallAfter(self.frame.on_offline_messages, msg["messages"])
+                elif act == "offline_messages": wx.CallAfter(self.frame.on_offline_messages, msg["messages"], msg.get("ack"), msg.get("more"), sock)
                 elif act == "change_password_result": wx.CallAfter(self.frame.on_change_password_result, msg)
                 elif act == "banned_kick": wx.CallAfter(self.on_banned); handled = True; break
         except (IOError, json.JSONDecodeError, ValueError):
@@ -702,6 +861,35 @@ class ClientApp(wx.App):
             print("Server closed connection.")
             wx.CallAfter(self.on_server_disconnect)
     
+    def heartbeat_loop(self, sock, interval, misses):
+        # Ping when the server has been quiet; if it stays silent, shut the socket so
+        # listen_loop falls into the normal reconnect path.
+        while self.sock is sock:
+            time.sleep(interval / 2.0)
+            if self.sock is not sock or self.intentional_disconnect: return
+            idle = time.monotonic() - sock.last_rx
+            if idle >= interval * misses:
+                print("Server stopped answering heartbeats.")
+                try: sock.shutdown(socket.SHUT_RDWR)
+                except OSError: pass
+                return
+            if idle >= interval:
+                try: sock.send({"action": "ping"})
+                except OSError: pass
+
+    def on_feature_caps(self, msg):
+        # A full feature_caps frame replaces what we hold; a delta only carries the features that changed.
+        held = _feature_caps.setdefault((ADDR, self.username), {"version": None, "caps": {}})
+        if msg.get("action") == "feature_caps": held["caps"] = dict(msg.get("caps") or {})
+        else: held["caps"].update(msg.get("caps") or {})
+        held["version"] = msg.get("version")
+        wx.CallAfter(self.frame.apply_feature_caps, dict(held["caps"]))
+
+    def on_events(self, events):
+        # One UI update for a whole batch of presence changes.
+        statuses = [(e["user"], e["online"], e.get("status_text")) for e in events if e.get("action") == "contact_status"]
+        if statuses: self.frame.update_contact_statuses(statuses)
+
     def on_banned(self):
         self._return_to_login("You have been banned.", "Banned")
 
@@ -712,7 +900,7 @@ class ClientApp(wx.App):
         except: pass
         username = getattr(self, 'username', '')
         password = self.user_config.get('password', '')
-        if not username or not password:
+        if not username or not (password or _resume_tokens.get((ADDR, username))):
             self.intentional_disconnect = False
             self._return_to_login("Connection to the server was lost.", "Connection Lost")
             return
@@ -728,11 +916,16 @@ class ClientApp(wx.App):
         for attempt in range(1, max_retries + 1):
             if dlg.cancelled: return
             wx.CallAfter(dlg.set_status, f"Reconnecting... (attempt {attempt} of {max_retries})")
-            success, sock, sf, _ = self.perform_login(username, password, silent=True, connect_timeout=10)
+            token = _resume_tokens.get((ADDR, username))
+            if token:
+                success, sock, sf, _ = self.perform_login(username, password, silent=True, connect_timeout=10, resume_token=token)
+            # Fall back to the password only when the server turned the token down.
+            if not token or (not success and (ADDR, username) not in _resume_tokens):
+                success, sock, sf, _ = self.perform_login(username, password, silent=True, connect_timeout=10)
             if success:
                 wx.CallAfter(self._finish_reconnect, dlg, sock, sf); return
             if dlg.cancelled: return
-            for remaining in range(wait_secs, 0, -1):
+            for remaining in range(max(wait_secs, self.login_retry_after), 0, -1):
                 if dlg.cancelled: return
                 wx.CallAfter(dlg.set_status, f"Attempt {attempt} of {max_retries} failed. Retrying in {remaining}s...")
                 time.sleep(1)
@@ -1376,33 +1569,41 @@ class UserDirectoryDialog(wx.Dialog):
 
 class MainFrame(wx.Frame):
     def update_contact_status(self, user, online, status_text=None):
-        was_online = False
-        for c in self._all_contacts:
-            if c["user"] == user:
+        self.update_contact_statuses([(user, online, status_text)])
+
+    def update_contact_statuses(self, updates):
+        came_online, went_offline = [], []
+        contacts = {c["user"]: c for c in self._all_contacts}
+        for user, online, status_text in updates:
+            was_online = False
+            c = contacts.get(user)
+            if c:
                 was_online = c["status"] != "offline" and not c["status"].startswith("offline")
                 is_admin = "(Admin)" in c["status"]
                 new_status = status_text if status_text else ("online" if online else "offline")
                 if not online: new_status = "offline"
                 if is_admin: new_status += " (Admin)"
                 c["status"] = new_status
-                break
+            if online and not was_online: came_online.append(user)
+            elif not online and was_online: went_offline.append(user)
         self._apply_search_filter()
         app = wx.GetApp()
-        if online and not was_online:
+        if came_online:
             app.play_sound("contact_online.wav")
-            if app.user_config.get('announce_status', False):
-                speak(f"{user} has come online.")
-            else:
-                show_notification("Contact online", f"{user} has come online.")
-        elif not online and was_online:
+            self._announce_contacts(came_online, "has come online", "have come online", "Contact online")
+        if went_offline:
             app.play_sound("contact_offline.wav")
-            if app.user_config.get('announce_status', False):
-                speak(f"{user} has gone offline.")
-            else:
-                show_notification("Contact offline", f"{user} has gone offline.")
+            self._announce_contacts(went_offline, "has gone offline", "have gone offline", "Contact offline")
+
+    def _announce_contacts(self, users, verb_one, verb_many, title):
+        if len(users) == 1: text = f"{users[0]} {verb_one}."
+        elif len(users) <= 3: text = f"{', '.join(users[:-1])} and {users[-1]} {verb_many}."
+        else: text = f"{', '.join(users[:3])} and {len(users) - 3} others {verb_many}."
+        if wx.GetApp().user_config.get('announce_status', False): speak(text)
+        else: show_notification(title, text)
 
     def __init__(self, user, sock):
-        super().__init__(None, title=f"Thrive Messenger – {user}", size=(400,380)); self.user, self.sock = user, sock; self.task_bar_icon = None; self.is_exiting = False; self._directory_dlg = None; self._conversations_dlg = None; self._noncontact_senders = load_noncontact_senders(user)
+        super().__init__(None, title=f"Thrive Messenger – {user}", size=(400,380)); self.user, self.sock = user, sock; self.task_bar_icon = None; self.is_exiting = False; self._directory_dlg = None; self._conversations_dlg = None; self._noncontact_senders = load_noncontact_senders(user); self._offline_pending = {}; self._feature_caps = {}
         self.current_status = wx.GetApp().user_config.get('status', 'online')
         self.notifications = []; self.Bind(wx.EVT_CLOSE, self.on_close_window); panel = wx.Panel(self)
 
@@ -1491,7 +1692,7 @@ class MainFrame(wx.Frame):
     def on_server_info(self, _):
         self.sock.sendall(json.dumps({"action": "server_info"}).encode() + b"\n")
     def on_server_info_response(self, msg):
-        encrypted = isinstance(self.sock, ssl.SSLSocket)
+        encrypted = isinstance(self.sock.raw_socket, ssl.SSLSocket)
         size_limit = msg.get("size_limit", 0)
         size_str = format_size(size_limit) if size_limit > 0 else "No limit"
         blackfiles = msg.get("blackfiles", [])
@@ -1622,7 +1823,20 @@ class MainFrame(wx.Frame):
                 base_status = c["status"].replace(" (Admin)", "")
                 c["status"] = base_status + " (Admin)" if is_admin else base_status; break
         self._apply_search_filter()
-    def on_admin(self, _): dlg = self.get_admin_dialog() or AdminDialog(self, self.sock); dlg.Show(); dlg.input_ctrl.SetFocus()
+    def apply_feature_caps(self, caps):
+        # Features the server hides are hidden here too; ones this account may not use are greyed out.
+        self._feature_caps = caps
+        cap = caps.get("admin_console")
+        if cap:
+            self.btn_admin.Show(bool(cap.get("ui_visible", True))); self.btn_admin.Enable(bool(cap.get("can_use", True)))
+            self.btn_admin.GetParent().Layout()
+    def feature_allowed(self, feature_key):
+        # Until the server has sent caps, leave it to the server to refuse.
+        return bool(self._feature_caps.get(feature_key, {}).get("can_use", True))
+    def on_admin(self, _):
+        if not self.feature_allowed("admin_console"):
+            wx.MessageBox("Server side commands are disabled for your account.", "Not Available", wx.OK | wx.ICON_INFORMATION); return
+        dlg = self.get_admin_dialog() or AdminDialog(self, self.sock); dlg.Show(); dlg.input_ctrl.SetFocus()
     def get_admin_dialog(self):
         for child in self.GetChildren():
             if isinstance(child, AdminDialog): return child
@@ -1678,6 +1892,7 @@ class MainFrame(wx.Frame):
         app.ExitMainLoop()
     def on_logout(self, _):
         self.is_exiting = True; app = wx.GetApp(); app.intentional_disconnect = True
+        _resume_tokens.pop((ADDR, self.user), None)
         try: self.sock.sendall(json.dumps({"action":"logout"}).encode()+b"\n")
         except: pass
         try: self.sock.close()
@@ -1758,23 +1973,31 @@ class MainFrame(wx.Frame):
         if app.user_config.get('tts_enabled', True):
             speak(f"{msg['from']}: {msg['msg']}")
     def on_message_failed(self, to, reason): chat_dlg = self.get_chat(to); (chat_dlg.append_error(reason) if chat_dlg else wx.MessageBox(reason, "Message Failed", wx.OK | wx.ICON_ERROR))
-    def on_offline_messages(self, messages):
-        if not messages: return
-        by_sender = {}
+    def on_offline_messages(self, messages, ack=None, more=False, sock=None):
+        page = {}
         for m in messages:
-            by_sender.setdefault(m["from"], []).append(m)
+            page.setdefault(m["from"], []).append(m)
         app = wx.GetApp(); logging_config = app.user_config.get('chat_logging', {})
         any_new_noncontact = False
-        for sender, msgs in by_sender.items():
+        for sender, msgs in page.items():
             is_contact = sender in self.contact_states
             dlg = self.get_chat(sender) or ChatDialog(self, sender, self.sock, self.user, logging_config.get(sender, False), is_contact=is_contact)
             for m in msgs:
                 dlg.append(m["msg"], m["from"], m["time"])
+            self._offline_pending.setdefault(sender, []).extend(msgs)
             if not is_contact and sender not in self._noncontact_senders:
                 self._noncontact_senders.add(sender); any_new_noncontact = True
         if any_new_noncontact:
             save_noncontact_senders(self.user, self._noncontact_senders)
-        n_msgs = len(messages); n_senders = len(by_sender)
+        # The page is in its chat windows now; acking deletes it on the server and asks
+        # for the next one. One summary covers every page, shown after the last.
+        if ack is not None and sock is not None:
+            try: sock.send({"action": "offline_ack", "upto": ack})
+            except Exception: pass
+        if more: return
+        by_sender, self._offline_pending = self._offline_pending, {}
+        if not by_sender: return
+        n_msgs = sum(len(msgs) for msgs in by_sender.values()); n_senders = len(by_sender)
         summary = ", ".join(sorted(by_sender.keys()))
         result = wx.MessageBox(
             f"You received {n_msgs} message{'s' if n_msgs != 1 else ''} while offline "
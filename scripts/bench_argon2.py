@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Pick argon2 settings for a target login rate, and compare a login wave through the
+server's password pool with one thread per login.
+
+The sweep times verify_password through the server's password pool (password_workers
+threads, sized to the CPU count by default) for each argon2_time_cost and
+argon2_memory_kib pair and prints the sustained logins per second. It then
+recommends the strongest setting that still reaches --target with --headroom to
+spare. The wave runs --wave logins at once with the recommended setting: first
+through the pool, then each on its own thread as logins used to run. It reports
+latency and the peak memory of the process. Argon2 allocates memory_cost for every
+hash in flight, which is what makes an unbounded wave thrash.
+
+    python3 scripts/bench_argon2.py --target 50 --wave 200
+"""
+import argparse
+import os
+import resource
+import sys
+import threading
+import time
+
+from benchlib import load_server_module, percentile
+
+
+def _configure(server, time_cost, memory_kib, parallelism):
+    server._ph = server.PasswordHasher(time_cost=time_cost, memory_cost=memory_kib, parallelism=parallelism)
+    return server._ph.hash("correct horse battery staple")
+
+
+def _concurrent(n, fn):
+    latencies = []
+    start = threading.Barrier(n + 1)
+
+    def one():
+        start.wait()
+        started = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - started) * 1000.0)
+
+    threads = [threading.Thread(target=one) for _ in range(n)]
+    for t in threads:
+        t.start()
+    start.wait()
+    started = time.perf_counter()
+    for t in threads:
+        t.join()
+    return latencies, time.perf_counter() - started
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", type=float, default=50.0, help="logins per second the server must sustain")
+    parser.add_argument("--headroom", type=float, default=2.0, help="required capacity as a multiple of --target")
+    parser.add_argument("--time-costs", default="1,2,3,4")
+    parser.add_argument("--memory-kib", default="19456,32768,65536,131072")
+    parser.add_argument("--parallelism", type=int, default=1)
+    parser.add_argument("--logins", type=int, default=0, help="logins per sweep point (default: 4 per worker, at least 8)")
+    parser.add_argument("--wave", type=int, default=200)
+    args = parser.parse_args()
+
+    server = load_server_module()
+    workers = server.password_config["workers"]
+    server.password_config["queue"] = max(server.password_config["queue"], args.wave)
+    logins = args.logins or max(8, 4 * workers)
+    print(f"cores: {os.cpu_count()}, password_workers: {workers}, target: {args.target:g}/s x{args.headroom:g}")
+    print(f"{'time_cost':>9} {'memory_kib':>10} {'ms/hash':>8} {'logins/s':>9}")
+    best = None
+    for memory_kib in [int(m) for m in args.memory_kib.split(",")]:
+        for time_cost in [int(t) for t in args.time_costs.split(",")]:
+            stored = _configure(server, time_cost, memory_kib, args.parallelism)
+            latencies, elapsed = _concurrent(logins, lambda: server.verify_password(stored, "correct horse battery staple"))
+            rate = logins / elapsed
+            ms = elapsed * 1000.0 * workers / logins
+            ok = rate >= args.target * args.headroom
+            print(f"{time_cost:>9} {memory_kib:>10} {ms:>8.1f} {rate:>9.1f}{'' if ok else '  too slow'}")
+            # Cost is roughly time_cost * memory: prefer the most work that still fits.
+            if ok and (best is None or time_cost * memory_kib > best[0] * best[1]):
+                best = (time_cost, memory_kib)
+    if best is None:
+        print("No setting reaches the target; lower the costs or add cores.")
+        return 1
+    print(f"\nrecommended [server] settings:\n    argon2_time_cost={best[0]}\n    argon2_memory_kib={best[1]}\n    argon2_parallelism={args.parallelism}")
+
+    stored = _configure(server, best[0], best[1], args.parallelism)
+    cases = (
+        ("password pool", lambda: server.verify_password(stored, "correct horse battery staple")),
+        ("thread per login", lambda: server._check_password(stored, "correct horse battery staple")),
+    )
+    print(f"\nlogin wave of {args.wave}:")
+    print(f"{'hashing':<18} {'seconds':>8} {'p50 ms':>8} {'p99 ms':>8} {'peak MB':>8}")
+    for label, fn in cases:
+        latencies, elapsed = _concurrent(args.wave, fn)
+        print(f"{label:<18} {elapsed:>8.2f} {percentile(latencies, 50):>8.0f} {percentile(latencies, 99):>8.0f} {_peak_rss_mb():>8.0f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Cost of pushing feature caps to 10k online users after a policy change: full caps
+recomputed for everyone versus deltas for the users whose caps changed.
+
+Runs in-process against a seeded database with every user online as a no-op session
+that negotiated caps_delta. Two admin actions are timed through the real handlers:
+adding one user to the group_call allowlist (one user's caps change) and flipping
+group_call from allowlist to all (everyone's group_call entry changes). "full" is
+the old push, which queried the policy tables for every feature of every online
+user; it is timed on a sample and projected to all users.
+
+    python3 scripts/bench_caps_delta.py --online 10000
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchlib import load_server_module, seed_users
+
+
+def _session_class(server):
+    class NullSession(server.ClientSession):
+        """A ClientSession that only counts what would have been sent."""
+        addr = ("127.0.0.1", 0)
+
+        def __init__(self):
+            self.caps = {"caps_delta": True}
+            self.feature_caps_version = None
+            self.frames = 0
+            self.bytes = 0
+
+        def send(self, payload):
+            self.frames += 1
+            self.bytes += len(json.dumps(payload))
+
+        def _wake(self):
+            pass
+
+        def _close_transport(self):
+            pass
+
+    return NullSession
+
+
+def _old_caps_for_user(server, username):
+    caps = {}
+    for fk in sorted(server.FEATURE_DEFAULTS):
+        con = server._db_connect()
+        row = con.execute("SELECT enabled, ui_visible, scope FROM feature_policies WHERE feature_key=?", (fk,)).fetchone()
+        con.close()
+        enabled, scope = bool(row[0]), str(row[2] or "all").lower()
+        admins = server._read_admin_file()
+        if not enabled:
+            can_use = False
+        elif scope == "all":
+            can_use = True
+        elif scope == "admin":
+            can_use = username in admins
+        else:
+            con = server._db_connect()
+            can_use = username in admins or bool(
+                con.execute("SELECT 1 FROM feature_allow_users WHERE feature_key=? AND username=?", (fk, username)).fetchone()
+                or con.execute("SELECT 1 FROM feature_allow_groups g JOIN user_access_groups u ON u.group_name=g.group_name "
+                               "WHERE g.feature_key=? AND u.username=? LIMIT 1", (fk, username)).fetchone())
+            con.close()
+        caps[fk] = {"enabled": enabled, "ui_visible": bool(row[1]), "scope": str(row[2]), "can_use": can_use}
+    return caps
+
+
+def _push(server, sessions, admin, action):
+    for s in sessions.values():
+        s.frames = s.bytes = 0
+    started = time.perf_counter()
+    server._handle_session_action(admin, "admin0", action)
+    elapsed = (time.perf_counter() - started) * 1000.0
+    frames = sum(s.frames for s in sessions.values())
+    return elapsed, frames, sum(s.bytes for s in sessions.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--online", type=int, default=10000)
+    parser.add_argument("--old-sample", type=int, default=500)
+    args = parser.parse_args()
+
+    server = load_server_module()
+    users = [f"user{i}" for i in range(args.online)]
+    with tempfile.TemporaryDirectory(prefix="thrive-bench-") as tmp:
+        os.chdir(tmp)
+        Path(server.ADMIN_FILE).write_text("admin0\n")
+        db = Path(tmp) / "thrive.db"
+        seed_users(db, users + ["admin0"])
+        con = sqlite3.connect(str(db))
+        con.execute("UPDATE feature_policies SET scope='allowlist' WHERE feature_key='group_call'")
+        con.execute("INSERT INTO feature_allow_groups(feature_key, group_name) VALUES('group_call', 'callers')")
+        con.executemany("INSERT INTO user_access_groups(group_name, username) VALUES('callers', ?)", [(u,) for u in users[::10]])
+        con.commit()
+        con.close()
+        server.DB = str(db)
+        server.feature_caps.invalidate(publish=False)
+        session_class = _session_class(server)
+        admin = session_class()
+        sessions = {u: session_class() for u in users}
+        server.clients.update(sessions)
+        for u, s in sessions.items():
+            server._send_feature_caps(s, u)
+
+        sample = users[:args.old_sample]
+        old = session_class()
+        started = time.perf_counter()
+        for u in sample:
+            old.send({"action": "feature_caps", "caps": _old_caps_for_user(server, u)})
+        old_ms = (time.perf_counter() - started) * 1000.0 * args.online / len(sample)
+        full_bytes = old.bytes * args.online / len(sample)
+
+        cases = (
+            ("allowlist +1 user", {"action": "feature_allow_user_add", "feature_key": "group_call", "username": users[1]}),
+            ("scope flip", {"action": "set_feature_policy", "feature_key": "group_call", "enabled": True, "ui_visible": True, "scope": "all"}),
+        )
+        print(f"online users: {args.online}")
+        print(f"{'change':<18} {'push':<6} {'ms':>9} {'frames':>7} {'KB':>8}")
+        for label, action in cases:
+            ms, frames, nbytes = _push(server, sessions, admin, action)
+            print(f"{label:<18} {'full':<6} {old_ms:>9.0f} {args.online:>7} {full_bytes / 1024:>8.0f}  (projected from {len(sample)} users)")
+            print(f"{label:<18} {'delta':<6} {ms:>9.1f} {frames:>7} {nbytes / 1024:>8.0f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
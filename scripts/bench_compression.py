@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Bytes on the wire with and without negotiated zlib stream compression.
+
+A viewer with --contacts contacts logs in (contact_list), opens the user directory
+(user_directory_response for --users accounts), then watches --churn contacts log in
+and out (contact_status). Each case uses a fresh server with the given
+compression_level; the server's compression counters are read back with `stats`.
+
+    python3 scripts/bench_compression.py --users 2000 --contacts 300 --levels 1,6,9
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from benchlib import LineClient, ServerProcess, raise_nofile_limit, seed_users
+
+
+async def _session(port, caps, contacts, churn):
+    viewer = await LineClient.connect(port)
+    await viewer.login("viewer", caps=caps)
+    after_login = viewer.wire_bytes
+    await viewer.send({"action": "user_directory"})
+    await viewer.recv_action("user_directory_response")
+    after_directory = viewer.wire_bytes
+    for i in range(churn):
+        c = await LineClient.connect(port)
+        await c.login(f"user{i:05d}")
+        await viewer.recv_action("contact_status")
+        await c.close()
+        await viewer.recv_action("contact_status")
+    total = viewer.wire_bytes
+    await viewer.close()
+    return after_login, after_directory - after_login, total - after_directory
+
+
+def _server_stats(server, prefix):
+    server.proc.stdin.write(f"stats {prefix}\n".encode())
+    server.proc.stdin.flush()
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        text = server.log_path.read_text()
+        idx = text.rfind('{\n  "counters"')
+        if idx >= 0:
+            try:
+                return json.JSONDecoder().raw_decode(text[idx:])[0]
+            except ValueError:
+                pass
+        time.sleep(0.2)
+    return {"counters": {}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--contacts", type=int, default=300)
+    parser.add_argument("--churn", type=int, default=20)
+    parser.add_argument("--levels", default="1,6,9")
+    parser.add_argument("--framing", default="json", choices=["json", "msgpack"])
+    args = parser.parse_args()
+    raise_nofile_limit()
+
+    users = [f"user{i:05d}" for i in range(args.users)]
+    contacts = [("viewer", u) for u in users[:max(args.contacts, args.churn)]]
+    cases = [("off", 0)] + [(f"zlib-{lvl}", int(lvl)) for lvl in args.levels.split(",") if lvl.strip()]
+
+    print(f"{'mode':<8} {'login B':>9} {'directory B':>12} {'presence B':>11} {'total B':>9} {'saved':>7} {'cpu ms':>7}")
+    baseline = None
+    for name, level in cases:
+        server = ServerProcess({"server": {"compression_level": level}})
+        seed_users(server.db_path, ["viewer"] + users, contacts=contacts)
+        caps = {"framing": [args.framing]} if args.framing != "json" else {}
+        if level:
+            caps["compression"] = ["zlib"]
+        with server:
+            login_b, dir_b, presence_b = asyncio.run(_session(server.port, caps, args.contacts, args.churn))
+            counters = _server_stats(server, "compression")["counters"]
+        total = login_b + dir_b + presence_b
+        baseline = baseline or total
+        print(f"{name:<8} {login_b:>9} {dir_b:>12} {presence_b:>11} {total:>9} {1 - total / baseline:>7.1%} {counters.get('compression.cpu_us', 0) / 1000.0:>7.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Per-message database overhead: a fresh sqlite3 connection per helper call, the
+server's shared connection pool, and pooled connections plus the block cache.
+
+Runs the real msg and file_offer handlers from srv/server.py in-process against a
+seeded database (the recipient is offline, so no socket work is involved) and
+reports microseconds per handled frame. The "per-call" case swaps _db_connect for
+a plain sqlite3.connect, which is how every helper used to open the database; the
+first two cases run with the block cache disabled so every block check hits SQLite.
+
+    python3 scripts/bench_db_overhead.py --frames 20000 --threads 1,8
+"""
+import argparse
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from benchlib import load_server_module, seed_users
+
+
+class _NullSession:
+    addr = ("127.0.0.1", 0)
+    caps = {}
+
+    def send(self, payload):
+        pass
+
+    sendall = send
+
+
+def _frames(n):
+    for i in range(n):
+        if i % 4 == 3:
+            yield {"action": "file_offer", "to": "bench_b", "files": [{"filename": "notes.txt", "size": 10}]}
+        else:
+            yield {"action": "msg", "from": "bench_a", "to": "bench_b", "time": "", "msg": f"hello {i}"}
+
+
+def _run(server, frames, threads):
+    per_thread = max(1, frames // threads)
+
+    def work():
+        session = _NullSession()
+        for frame in _frames(per_thread):
+            server._handle_session_action(session, "bench_a", frame)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return (time.perf_counter() - started) * 1e6 / (per_thread * threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=20000)
+    parser.add_argument("--threads", default="1,8")
+    args = parser.parse_args()
+
+    server = load_server_module()
+    server.rate_limit_config["enabled"] = False
+    # Keep the offline recipient's messages out of the offline mailbox: this measures lookups, not storage.
+    server.offline_config["enabled"] = False
+    pooled = server._db_connect
+    cache_entries = server.block_cache.max_entries
+    modes = (
+        ("per-call", lambda: sqlite3.connect(server.DB), 0),
+        ("pooled", pooled, 0),
+        ("cached", pooled, cache_entries),
+    )
+    with tempfile.TemporaryDirectory(prefix="thrive-bench-") as tmp:
+        db = Path(tmp) / "thrive.db"
+        seed_users(db, ["bench_a", "bench_b"], contacts=[("bench_a", "bench_b"), ("bench_b", "bench_a")])
+        server.DB = str(db)
+        print(f"{'mode':<10} {'threads':>8} {'us/frame':>10}")
+        for threads in [int(t) for t in args.threads.split(",") if t.strip()]:
+            for mode, connect, entries in modes:
+                server._db_connect = connect
+                server.block_cache.max_entries = entries
+                server.block_cache.forget_user("bench_a")
+                us = _run(server, args.frames, threads)
+                print(f"{mode:<10} {threads:>8} {us:>10.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
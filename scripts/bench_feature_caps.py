@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Group call signal relay cost, querying feature policies per check versus the
+compiled feature-capability cache.
+
+Runs the real group_call_signal handler from srv/server.py in-process: bench_a
+relays signals to bench_b inside one call (bench_b is a no-op session). The
+group_call feature is put on an allowlist that bench_a reaches through an access
+group, the most expensive check. "per-check query" swaps _can_user_use_feature for
+the old version, which read the policy, allowlist and access group tables and
+admins.txt on every call; "compiled" is the server's bitmask lookup.
+
+    python3 scripts/bench_feature_caps.py --signals 20000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchlib import load_server_module, seed_users
+
+
+class _NullSession:
+    addr = ("127.0.0.1", 0)
+    caps = {}
+    codec = "json"
+    batching = False
+
+    def __init__(self):
+        self.frames = 0
+
+    def send(self, payload):
+        self.frames += 1
+
+    def sendall(self, data):
+        self.frames += 1
+
+
+def _old_can_user_use_feature(server):
+    def can_use(username, feature_key):
+        con = server._db_connect()
+        row = con.execute("SELECT enabled, scope FROM feature_policies WHERE feature_key=?", (feature_key,)).fetchone()
+        con.close()
+        if not row or not row[0]:
+            return False
+        scope = str(row[1] or "all").lower()
+        is_admin = username in server.get_admins()
+        if scope == "all":
+            return True
+        if scope == "admin":
+            return is_admin
+        if is_admin:
+            return True
+        con = server._db_connect()
+        allowed = con.execute("SELECT 1 FROM feature_allow_users WHERE feature_key=? AND username=?",
+                              (feature_key, username)).fetchone()
+        con.close()
+        if allowed:
+            return True
+        con = server._db_connect()
+        groups = [r[0] for r in con.execute("SELECT group_name FROM user_access_groups WHERE username=?", (username,))]
+        con.close()
+        if not groups:
+            return False
+        con = server._db_connect()
+        row = con.execute(
+            f"SELECT 1 FROM feature_allow_groups WHERE feature_key=? AND group_name IN ({','.join('?' * len(groups))}) LIMIT 1",
+            [feature_key] + groups,
+        ).fetchone()
+        con.close()
+        return bool(row)
+    return can_use
+
+
+def _run(server, signals):
+    session = _NullSession()
+    frame = {"action": "group_call_signal", "group": "bench", "to": "bench_b", "signal_type": "ice", "data": {"c": "x"}}
+    started = time.perf_counter()
+    for _ in range(signals):
+        server._handle_session_action(session, "bench_a", frame)
+    return (time.perf_counter() - started) * 1e6 / signals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--signals", type=int, default=20000)
+    args = parser.parse_args()
+
+    server = load_server_module()
+    server.rate_limit_config["enabled"] = False
+    compiled = server._can_user_use_feature
+    with tempfile.TemporaryDirectory(prefix="thrive-bench-") as tmp:
+        os.chdir(tmp)
+        Path(server.ADMIN_FILE).write_text("someone_else\n")
+        db = Path(tmp) / "thrive.db"
+        seed_users(db, ["bench_a", "bench_b"])
+        con = sqlite3.connect(str(db))
+        con.execute("UPDATE feature_policies SET scope='allowlist' WHERE feature_key='group_call'")
+        con.execute("INSERT INTO user_access_groups(group_name, username) VALUES('callers', 'bench_a')")
+        con.execute("INSERT INTO user_access_groups(group_name, username) VALUES('callers', 'bench_b')")
+        con.execute("INSERT INTO feature_allow_groups(feature_key, group_name) VALUES('group_call', 'callers')")
+        con.commit()
+        con.close()
+        server.DB = str(db)
+        server.feature_caps.invalidate(publish=False)
+        target = _NullSession()
+        server.clients["bench_b"] = target
+        server.group_call_sessions["bench"] = {"mode": "voice", "participants": {"bench_a", "bench_b"}}
+
+        print(f"{'check':<16} {'us/signal':>10} {'relayed':>9}")
+        for label, can_use in (("per-check query", _old_can_user_use_feature(server)), ("compiled", compiled)):
+            server._can_user_use_feature = can_use
+            target.frames = 0
+            us = _run(server, args.signals)
+            print(f"{label:<16} {us:>10.1f} {target.frames:>9}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""Encode/decode cost and wire size of JSON lines vs. msgpack frames.
+
+Uses the server's own _encode_frame/_read_frame on typical msg, contact_status and
+contact_list frames, so the numbers cover the code that actually runs.
+
+    python3 scripts/bench_framing.py --contacts 200 --iterations 20000
+"""
+import argparse
+import io
+import sys
+import timeit
+
+from benchlib import load_server_module
+
+
+def sample_frames(contacts):
+    return {
+        "msg": {"action": "msg", "from": "alice", "to": "bob", "time": "2026-01-01 12:00:00", "msg": "Are we still on for lunch tomorrow?"},
+        "contact_status": {"action": "contact_status", "user": "alice", "online": True, "status_text": "online"},
+        "contact_list": {"action": "contact_list", "contacts": [
+            {"user": f"user{i:04d}", "blocked": 0, "online": i % 3 == 0, "is_admin": i % 50 == 0, "status_text": "online" if i % 3 == 0 else "offline"}
+            for i in range(contacts)
+        ]},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--contacts", type=int, default=200)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    server = load_server_module()
+    if server.msgpack is None:
+        print("msgpack is not installed; only JSON lines can be measured.")
+    codecs = ["json"] + (["msgpack"] if server.msgpack is not None else [])
+
+    print(f"{'frame':<16} {'codec':<8} {'bytes':>8} {'encode us':>10} {'decode us':>10}")
+    for name, payload in sample_frames(args.contacts).items():
+        n = args.iterations if name != "contact_list" else max(1, args.iterations // 20)
+        for codec in codecs:
+            wire = server._encode_frame(payload, codec)
+            assert server._read_frame(io.BytesIO(wire), codec) == payload
+            enc = timeit.timeit(lambda: server._encode_frame(payload, codec), number=n) / n * 1e6
+            dec = timeit.timeit(lambda: server._read_frame(io.BytesIO(wire), codec), number=n) / n * 1e6
+            print(f"{name:<16} {codec:<8} {len(wire):>8} {enc:>10.2f} {dec:>10.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
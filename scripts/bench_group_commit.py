@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Contact mutations per second: a commit per write versus the group-commit writer.
+
+Several threads toggle contact block flags and add contacts, the same statements the
+server's handlers issue, through db_writer and waiting on each write. "per-write"
+runs with db_group_commit=false, so each thread commits its own write; "group" runs
+with it on. Reported per db_synchronous setting: writes/sec, the average batch size
+and p99 commit latency.
+
+    python3 scripts/bench_group_commit.py --threads 16 --writes 500
+"""
+import argparse
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from benchlib import load_server_module, seed_users
+
+
+def _statements(n, writes):
+    for i in range(writes):
+        if i % 2:
+            yield "UPDATE contacts SET blocked=? WHERE owner=? AND contact=?", (i % 4 // 2, f"bench_{n}", f"bench_{(n + 1) % 64}")
+        else:
+            yield "INSERT OR IGNORE INTO contacts(owner,contact) VALUES(?,?)", (f"bench_{n}", f"peer_{i}")
+
+
+def _run(server, threads, writes):
+    def work(n):
+        for sql, params in _statements(n, writes):
+            server.db_writer.execute(sql, params)
+
+    workers = [threading.Thread(target=work, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return threads * writes / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--writes", type=int, default=500)
+    parser.add_argument("--synchronous", default="NORMAL,FULL")
+    args = parser.parse_args()
+
+    server = load_server_module()
+    print(f"{'sync':<8} {'mode':<10} {'writes/s':>10} {'avg batch':>10} {'p99 commit ms':>14}")
+    for sync in [s.strip().upper() for s in args.synchronous.split(",") if s.strip()]:
+        for mode in ("per-write", "group"):
+            with tempfile.TemporaryDirectory(prefix="thrive-bench-") as tmp:
+                db = Path(tmp) / "thrive.db"
+                seed_users(db, [f"bench_{n}" for n in range(64)],
+                           contacts=[(f"bench_{n}", f"bench_{(n + 1) % 64}") for n in range(64)])
+                server.DB = str(db)
+                server.db_config["synchronous"] = sync
+                server.db_config["group_commit"] = mode == "group"
+                server.metrics = server._Metrics()
+                rate = _run(server, args.threads, args.writes)
+                hists = server.metrics.snapshot("db.")["histograms"]
+                batch = hists.get("db.batch_size", {}).get("avg", 1)
+                p99 = hists.get("db.commit_ms", {}).get("p99", 0)
+            print(f"{sync:<8} {mode:<10} {rate:>10.0f} {batch:>10} {p99:>14}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
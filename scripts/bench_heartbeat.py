@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Measure how quickly the idle reaper clears dead heartbeat sessions.
+
+Logs in a set of clients that negotiate the heartbeat cap. Half of them answer
+pings; the other half go silent as a half-open connection would. Reported per
+engine: seconds until every silent session was reaped, how many answering
+sessions survived, the sessions.reaped counter and server thread count.
+
+    python3 scripts/bench_heartbeat.py --clients 200 --interval 2 --misses 2
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from benchlib import LineClient, ServerProcess, raise_nofile_limit, seed_users
+
+
+def _server_stats(server):
+    server.proc.stdin.write(b"stats\n")
+    server.proc.stdin.flush()
+    time.sleep(0.5)
+    text = server.log_path.read_text()
+    start = text.rfind('{\n  "counters"')
+    if start < 0:
+        return {}
+    return json.JSONDecoder().raw_decode(text[start:])[0]
+
+
+async def _answer_pings(client):
+    try:
+        while True:
+            msg = await client.recv()
+            if msg.get("action") == "ping":
+                await client.send({"action": "pong"})
+    except (ConnectionError, OSError):
+        pass
+
+
+async def _wait_closed(client):
+    try:
+        while True:
+            await client.recv()
+    except (ConnectionError, OSError):
+        return time.perf_counter()
+
+
+async def _run_case(server, clients, deadline):
+    live, silent, answering = [], [], []
+    for i in range(clients):
+        c = await LineClient.connect(server.port)
+        await c.login(f"hb_{i}", caps={"heartbeat": True})
+        if i % 2 == 0:
+            live.append(c)
+            answering.append(asyncio.create_task(_answer_pings(c)))
+        else:
+            silent.append(c)
+    started = time.perf_counter()
+    # Silent clients never reply; their reader only notices when the server hangs up.
+    closed = await asyncio.wait_for(asyncio.gather(*[_wait_closed(c) for c in silent]), deadline)
+    _, threads = server.proc_status()
+    survivors = sum(1 for t in answering if not t.done())
+    for t in answering:
+        t.cancel()
+    for c in live:
+        await c.close()
+    return max(closed) - started, survivors, threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--interval", type=int, default=2)
+    parser.add_argument("--misses", type=int, default=2)
+    parser.add_argument("--engines", default="threaded,asyncio")
+    args = parser.parse_args()
+
+    raise_nofile_limit()
+    print(f"{'engine':<10} {'clients':>8} {'reap s':>8} {'survived':>9} {'reaped':>7} {'threads':>8}")
+    for engine in [e.strip() for e in args.engines.split(",") if e.strip()]:
+        server = ServerProcess({"server": {
+            "engine": engine,
+            "heartbeat_interval": str(args.interval),
+            "heartbeat_misses": str(args.misses),
+        }})
+        seed_users(server.db_path, [f"hb_{i}" for i in range(args.clients)])
+        with server:
+            deadline = args.interval * (args.misses + 2) + 30
+            reap_s, survived, threads = asyncio.run(_run_case(server, args.clients, deadline))
+            reaped = _server_stats(server).get("counters", {}).get("sessions.reaped", 0)
+        print(f"{engine:<10} {args.clients:>8} {reap_s:>8.1f} {survived:>6}/{(args.clients + 1) // 2:<2} {reaped:>7} {threads:>8}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Message history ingest throughput and fetch/search latency on a synthetic corpus.
+
+Messages between random pairs of users are recorded through the server's own path
+(_record_history, which queues them on the group-commit writer), then timed:
+fetching the newest page and a deep page of a conversation, and FTS5 searches for
+a common word, a rare word, two words and a prefix, across all of a user's
+conversations and within one. The default corpus, ten million messages, takes
+about half an hour to build; use --messages to try a smaller one first.
+
+    python3 scripts/bench_history.py --messages 10000000 --users 50000
+"""
+import argparse
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchlib import load_server_module, percentile, seed_users
+
+
+def _vocabulary(rng, size):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(3, 9))) for _ in range(size)]
+
+
+def _timed(fn, args_list):
+    times = []
+    for args in args_list:
+        started = time.perf_counter()
+        fn(*args)
+        times.append((time.perf_counter() - started) * 1000.0)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=10000000)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--contacts", type=int, default=20, help="conversation partners per user")
+    parser.add_argument("--queries", type=int, default=500)
+    args = parser.parse_args()
+
+    server = load_server_module()
+    rng = random.Random(7)
+    vocab = _vocabulary(rng, 20000)
+    # Zipf-like word choice: a few words are everywhere, most are rare.
+    weights = [1.0 / (i + 1) for i in range(len(vocab))]
+    users = [f"user{i}" for i in range(args.users)]
+    partners = {u: rng.sample(users, args.contacts) for u in users}
+
+    with tempfile.TemporaryDirectory(prefix="thrive-bench-") as tmp:
+        db = Path(tmp) / "thrive.db"
+        server.history_config["enabled"] = True
+        seed_users(db, users[:2])
+        server.DB = str(db)
+
+        started = time.perf_counter()
+        chunk = 10000
+        for base in range(0, args.messages, chunk):
+            words = rng.choices(vocab, weights, k=chunk * 12)
+            for i in range(min(chunk, args.messages - base)):
+                frm = users[rng.randrange(args.users)]
+                to = partners[frm][rng.randrange(args.contacts)]
+                body = " ".join(words[i * 12:i * 12 + rng.randint(4, 12)])
+                server._record_history(frm, to, str(time.time()), body)
+            # Keep the writer's queue bounded, as a live server's message rate would.
+            server.db_writer.execute("SELECT 1")
+        ingest_s = time.perf_counter() - started
+        size_mb = db.stat().st_size / 1e6 + (Path(str(db) + "-wal").stat().st_size / 1e6 if Path(str(db) + "-wal").exists() else 0)
+
+        pairs = [(u, partners[u][rng.randrange(args.contacts)]) for u in rng.choices(users, k=args.queries)]
+        per_conv = max(1, args.messages * 2 // (args.users * args.contacts))
+        cases = [
+            ("fetch newest 50", server._history_fetch, [(u, p, server.HISTORY_CURSOR_END, 50) for u, p in pairs]),
+            ("fetch deep 50", server._history_fetch, [(u, p, rng.randint(1, per_conv), 50) for u, p in pairs]),
+        ]
+        common, rare = vocab[0], vocab[len(vocab) // 2]
+        for label, query in (("common word", common), ("rare word", rare), ("two words", f"{vocab[1]} {vocab[50]}"), ("prefix", vocab[3][:3] + "*")):
+            cases.append((f"search {label}", server._history_search,
+                          [(server._history_match(u, query), server.HISTORY_CURSOR_END, 50) for u, _ in pairs]))
+            cases.append((f"search {label} 1:1", server._history_search,
+                          [(server._history_match(u, query, p), server.HISTORY_CURSOR_END, 50) for u, p in pairs]))
+
+        print(f"messages: {args.messages}, conversations: ~{args.users * args.contacts // 2}, database: {size_mb:.0f} MB")
+        print(f"ingest: {args.messages / ingest_s:.0f} messages/s ({ingest_s:.1f}s)")
+        print(f"{'query':<26} {'p50 ms':>8} {'p99 ms':>8}")
+        for label, fn, arg_list in cases:
+            times = _timed(fn, arg_list)
+            print(f"{label:<26} {percentile(times, 50):>8.2f} {percentile(times, 99):>8.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Legitimate login latency during a credential-stuffing burst, with and without
+login throttling.
+
+An attacker on 127.0.0.1 fires wrong-password logins for many usernames as fast
+as the server answers. Meanwhile real users connect from 127.0.0.2 and log in
+one after another. Reported: attacker attempts answered, how many were
+throttled, and the real users' login latency.
+
+    python3 scripts/bench_login_throttle.py --attackers 16 --duration 30
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from benchlib import LineClient, ServerProcess, percentile, seed_users
+
+UNLIMITED = {"login_ip_burst": "1000000", "login_user_burst": "1000000"}
+
+
+async def _attacker(port, n, stop, counts):
+    i = 0
+    while time.perf_counter() < stop:
+        try:
+            c = await LineClient.connect(port)
+            await c.send({"action": "login", "user": f"victim{n}_{i % 50}", "pass": "guess"})
+            resp = await c.recv()
+            await c.close()
+        except (ConnectionError, OSError):
+            continue
+        counts["answered"] += 1
+        if resp.get("retry_after"):
+            counts["throttled"] += 1
+        i += 1
+
+
+async def _real_user(port, users, stop, latencies):
+    i = 0
+    while time.perf_counter() < stop:
+        started = time.perf_counter()
+        reader, writer = await asyncio.open_connection("127.0.0.1", port, local_addr=("127.0.0.2", 0), limit=1 << 24)
+        c = LineClient(reader, writer)
+        await c.login(users[i % len(users)])
+        latencies.append((time.perf_counter() - started) * 1000.0)
+        await c.close()
+        i += 1
+        await asyncio.sleep(0.2)
+
+
+async def _run_case(port, attackers, duration, users):
+    stop = time.perf_counter() + duration
+    counts = {"answered": 0, "throttled": 0}
+    latencies = []
+    await asyncio.gather(
+        _real_user(port, users, stop, latencies),
+        *[_attacker(port, n, stop, counts) for n in range(attackers)],
+    )
+    return counts, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--attackers", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--engines", default="threaded,asyncio")
+    args = parser.parse_args()
+
+    users = [f"real_{i}" for i in range(20)]
+    print(f"{'engine':<10} {'throttle':<9} {'attempts':>9} {'throttled':>10} {'logins':>7} {'p50 ms':>9} {'p99 ms':>9}")
+    for engine in [e.strip() for e in args.engines.split(",") if e.strip()]:
+        for throttle in (False, True):
+            sections = {"server": dict({"engine": engine}, **({} if throttle else UNLIMITED))}
+            server = ServerProcess(sections)
+            seed_users(server.db_path, users + [f"victim{n}_{i}" for n in range(args.attackers) for i in range(50)])
+            with server:
+                counts, latencies = asyncio.run(_run_case(server.port, args.attackers, args.duration, users))
+            print(f"{engine:<10} {'on' if throttle else 'off':<9} {counts['answered']:>9} {counts['throttled']:>10} {len(latencies):>7} "
+                  f"{percentile(latencies, 50):>9.1f} {percentile(latencies, 99):>9.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
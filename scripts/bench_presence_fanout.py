@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Presence fan-out cost during a login wave with 10k users online.
+
+Runs in-process against a seeded database: every user is online (as a no-op
+session) and has --contacts random contacts. Each login announces one status
+change. "per-client query" is the old fan-out, which asked SQLite about every
+online client; it is timed on a sample and projected to the whole wave. "index"
+is broadcast_contact_status with the reverse contact index.
+
+    python3 scripts/bench_presence_fanout.py --online 10000 --contacts 50
+"""
+import argparse
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchlib import load_server_module, seed_users
+
+
+class _NullSession:
+    codec = "json"
+    batching = False
+
+    def __init__(self):
+        self.frames = 0
+
+    def sendall(self, data):
+        self.frames += 1
+
+
+def _old_fanout(server, user):
+    with server.lock:
+        targets = list(server.clients.items())
+    db = server._db_connect()
+    allowed = []
+    for owner, sock in targets:
+        r = db.execute("SELECT blocked FROM contacts WHERE owner=? AND contact=?", (owner, user)).fetchone()
+        if r and r[0] == 0:
+            allowed.append(sock)
+    db.close()
+    server._broadcast_frame(allowed, {"action": "contact_status", "user": user, "online": True, "status_text": "online"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--online", type=int, default=10000)
+    parser.add_argument("--contacts", type=int, default=50)
+    parser.add_argument("--old-sample", type=int, default=20)
+    args = parser.parse_args()
+
+    server = load_server_module()
+    rng = random.Random(1)
+    users = [f"user{i}" for i in range(args.online)]
+    contacts = {(u, c) for u in users for c in rng.sample(users, args.contacts) if c != u}
+    with tempfile.TemporaryDirectory(prefix="thrive-bench-") as tmp:
+        db = Path(tmp) / "thrive.db"
+        seed_users(db, users, contacts=sorted(contacts))
+        server.DB = str(db)
+        started = time.perf_counter()
+        server._load_contact_index()
+        load_s = time.perf_counter() - started
+        sessions = {u: _NullSession() for u in users}
+        server.clients.update(sessions)
+
+        sample = users[:args.old_sample]
+        started = time.perf_counter()
+        for u in sample:
+            _old_fanout(server, u)
+        old_ms = (time.perf_counter() - started) * 1000.0 / len(sample)
+
+        for s in sessions.values():
+            s.frames = 0
+        started = time.perf_counter()
+        for u in users:
+            server.broadcast_contact_status(u, True)
+        new_ms = (time.perf_counter() - started) * 1000.0 / len(users)
+        frames = sum(s.frames for s in sessions.values())
+
+    print(f"online users: {args.online}, contact rows: {len(contacts)}, index load: {load_s:.2f}s")
+    print(f"{'fan-out':<18} {'ms/change':>10} {'wave s':>9}")
+    print(f"{'per-client query':<18} {old_ms:>10.2f} {old_ms * args.online / 1000.0:>9.1f}  (projected from {len(sample)} changes)")
+    print(f"{'index':<18} {new_ms:>10.3f} {new_ms * args.online / 1000.0:>9.2f}")
+    print(f"frames delivered during the indexed wave: {frames}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
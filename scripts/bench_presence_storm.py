@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Presence storm: frames, UI callbacks and server writes with and without event batching.
+
+--watchers users stay online with every stormer as a contact. Then --stormers users log
+in at once and each sets a custom status (two presence changes per stormer). Each
+watcher counts the frames it receives: the client does one wx.CallAfter per frame, so
+frames are the UI event count. Server write syscalls come from `stats outbound`.
+
+    python3 scripts/bench_presence_storm.py --watchers 20 --stormers 200 --batch-ms 0,50,250
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from benchlib import LineClient, ServerProcess, raise_nofile_limit, seed_users
+
+
+async def _watch(client, stormers, counts):
+    final = {}
+    while len(final) < stormers:
+        msg = await client.recv()
+        counts["frames"] += 1
+        events = msg["events"] if msg.get("action") == "events" else [msg]
+        for ev in events:
+            if ev.get("action") == "contact_status":
+                counts["events"] += 1
+                if ev.get("status_text") == "busy":
+                    final[ev["user"]] = True
+
+
+async def _storm(port, watchers, stormers, batching):
+    caps = {"batching": True} if batching else {}
+    watching = []
+    for i in range(watchers):
+        c = await LineClient.connect(port)
+        await c.login(f"watch{i:03d}", caps=caps)
+        watching.append(c)
+    counts = {"frames": 0, "events": 0}
+    watch_tasks = [asyncio.create_task(_watch(c, stormers, counts)) for c in watching]
+
+    async def storm_one(i):
+        c = await LineClient.connect(port)
+        await c.login(f"storm{i:04d}")
+        await c.send({"action": "set_status", "status_text": "busy"})
+        return c
+
+    started = time.perf_counter()
+    storm = await asyncio.gather(*[storm_one(i) for i in range(stormers)])
+    await asyncio.wait_for(asyncio.gather(*watch_tasks), 120)
+    elapsed = time.perf_counter() - started
+    for c in storm + watching:
+        await c.close()
+    return elapsed, counts
+
+
+def _server_stats(server):
+    server.proc.stdin.write(b"stats\n")
+    server.proc.stdin.flush()
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        text = server.log_path.read_text()
+        idx = text.rfind('{\n  "counters"')
+        if idx >= 0:
+            try:
+                return json.JSONDecoder().raw_decode(text[idx:])[0]
+            except ValueError:
+                pass
+        time.sleep(0.2)
+    return {"counters": {}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--watchers", type=int, default=20)
+    parser.add_argument("--stormers", type=int, default=200)
+    parser.add_argument("--batch-ms", default="0,50,250")
+    parser.add_argument("--engine", default="threaded")
+    args = parser.parse_args()
+    raise_nofile_limit()
+
+    watchers = [f"watch{i:03d}" for i in range(args.watchers)]
+    stormers = [f"storm{i:04d}" for i in range(args.stormers)]
+    contacts = [(w, s) for w in watchers for s in stormers]
+
+    print(f"{'batch ms':>8} {'storm s':>8} {'frames/watcher':>15} {'events/watcher':>15} {'server writes':>14} {'coalesced':>10}")
+    for batch_ms in [int(b) for b in args.batch_ms.split(",") if b.strip()]:
+        server = ServerProcess({"server": {"engine": args.engine, "event_batch_ms": batch_ms}})
+        seed_users(server.db_path, watchers + stormers, contacts=contacts)
+        with server:
+            elapsed, counts = asyncio.run(_storm(server.port, args.watchers, args.stormers, batch_ms > 0))
+            counters = _server_stats(server)["counters"]
+        print(f"{batch_ms:>8} {elapsed:>8.2f} {counts['frames'] / args.watchers:>15.1f} {counts['events'] / args.watchers:>15.1f} "
+              f"{counters.get('outbound.writes', 0):>14} {counters.get('events.coalesced', 0):>10}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Cost of the per-user action rate limiter: time per relayed frame with and without it,
+how cheaply a flood is turned away, and memory per user.
+
+Runs the real msg and typing handlers from srv/server.py in-process. bench_a sends
+to bench_b, which is online as a no-op session. "off" runs with rate_limits=false.
+"on" runs with the limiter enabled and limits high enough that nothing is
+refused. "flood" sets the limits low, so almost every frame gets the rate_limited
+reply. Memory is measured with tracemalloc after --users distinct users have each
+sent one message and one typing frame.
+
+    python3 scripts/bench_rate_limit.py --frames 50000 --users 100000
+"""
+import argparse
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from benchlib import load_server_module, seed_users
+
+
+class _NullSession:
+    addr = ("127.0.0.1", 0)
+    caps = {}
+
+    def send(self, payload):
+        pass
+
+    sendall = send
+
+
+def _frames(n):
+    for i in range(n):
+        if i % 2:
+            yield {"action": "typing", "to": "bench_b", "typing": True}
+        else:
+            yield {"action": "msg", "from": "bench_a", "to": "bench_b", "time": "", "msg": f"hello {i}"}
+
+
+def _run(server, frames):
+    session = _NullSession()
+    started = time.perf_counter()
+    for frame in _frames(frames):
+        server._handle_session_action(session, "bench_a", frame)
+    return (time.perf_counter() - started) * 1e6 / frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=50000)
+    parser.add_argument("--users", type=int, default=100000)
+    args = parser.parse_args()
+
+    server = load_server_module()
+    cfg = server.rate_limit_config
+    with tempfile.TemporaryDirectory(prefix="thrive-bench-") as tmp:
+        db = Path(tmp) / "thrive.db"
+        seed_users(db, ["bench_a", "bench_b"], contacts=[("bench_a", "bench_b"), ("bench_b", "bench_a")])
+        server.DB = str(db)
+        server.clients["bench_b"] = _NullSession()
+        server.group_policy_store.reload()
+
+        print(f"{'limiter':<8} {'us/frame':>9}")
+        cases = (
+            ("off", dict(enabled=False)),
+            ("on", dict(enabled=True, msg_burst=10 ** 9, typing_burst=10 ** 9)),
+            ("flood", dict(enabled=True, msg_burst=1, typing_burst=1, typing_per_minute=1)),
+        )
+        for label, overrides in cases:
+            cfg.update(overrides)
+            server.action_limiter.reset()
+            print(f"{label:<8} {_run(server, args.frames):>9.2f}")
+
+        cfg.update(enabled=True, users_max=max(cfg['users_max'], args.users))
+        server.action_limiter.reset()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for i in range(args.users):
+            server.action_limiter.take(f"user{i}", "msg")
+            server.action_limiter.take(f"user{i}", "typing")
+        after = tracemalloc.take_snapshot()
+        used = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+        print(f"\n{args.users} users: {used / 1e6:.1f} MB, {used / args.users:.0f} bytes per user (two buckets)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Reconnect storm against a TLS server, with optional stalled handshakes.
+
+Opens --stalled plain TCP connections that never send a ClientHello (a slow or
+malicious peer), then has --clients TLS clients connect at the same moment and ask
+for the welcome message. Reported: how long the storm took to be served, per-client
+connect+handshake latency, failures, and the server's own accept/TLS counters.
+
+    python3 scripts/bench_reconnect_storm.py --clients 2000 --stalled 50
+"""
+import argparse
+import asyncio
+import json
+import socket
+import sys
+import time
+
+from benchlib import LineClient, ServerProcess, client_ssl_context, make_self_signed_cert, percentile, raise_nofile_limit
+
+
+async def _storm(port, clients, concurrency):
+    context = client_ssl_context()
+    latencies = []
+    failures = 0
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one():
+        nonlocal failures
+        async with gate:
+            started = time.perf_counter()
+            try:
+                c = await asyncio.wait_for(LineClient.connect(port, ssl_context=context), 60)
+                await c.send({"action": "get_welcome"})
+                await asyncio.wait_for(c.recv(), 60)
+                latencies.append((time.perf_counter() - started) * 1000.0)
+                await c.close()
+            except Exception:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(clients)])
+    return time.perf_counter() - started, latencies, failures
+
+
+def _server_stats(server):
+    """Ask the server console for its stats and parse the JSON it prints."""
+    server.proc.stdin.write(b"stats\n")
+    server.proc.stdin.flush()
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        text = server.log_path.read_text()
+        idx = text.rfind('{\n  "counters"')
+        if idx >= 0:
+            try:
+                return json.JSONDecoder().raw_decode(text[idx:])[0]
+            except ValueError:
+                pass
+        time.sleep(0.2)
+    return {"counters": {}, "rates": {}, "histograms": {}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--engines", default="threaded,asyncio")
+    parser.add_argument("--clients", type=int, default=2000)
+    parser.add_argument("--stalled", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=1000, help="client connections in flight at once")
+    parser.add_argument("--max-connections", type=int, default=10000)
+    parser.add_argument("--handshake-timeout", type=float, default=5.0)
+    args = parser.parse_args()
+    raise_nofile_limit()
+
+    print(f"{'engine':<10} {'clients':>8} {'stalled':>8} {'total s':>8} {'p50 ms':>8} {'p99 ms':>9} {'failed':>7}  server counters")
+    for engine in [e.strip() for e in args.engines.split(",") if e.strip()]:
+        server = ServerProcess({"server": {
+            "engine": engine,
+            "max_connections": args.max_connections,
+            "handshake_timeout": args.handshake_timeout,
+        }})
+        cert, key = make_self_signed_cert(server.workdir)
+        server.sections["server"].update({"certfile": str(cert), "keyfile": str(key)})
+        with server:
+            stalled = [socket.create_connection(("127.0.0.1", server.port)) for _ in range(args.stalled)]
+            elapsed, latencies, failures = asyncio.run(_storm(server.port, args.clients, args.concurrency))
+            for s in stalled:
+                s.close()
+            stats = _server_stats(server)
+        tls = stats["histograms"].get("tls.handshake_ms", {})
+        counters = stats["counters"]
+        print(
+            f"{engine:<10} {args.clients:>8} {args.stalled:>8} {elapsed:>8.2f} {percentile(latencies, 50):>8.1f} "
+            f"{percentile(latencies, 99):>9.1f} {failures:>7}  accepted={counters.get('accept.accepted', 0)} "
+            f"rejected={counters.get('accept.rejected', 0)} timeouts={counters.get('tls.handshake_timeouts', 0)} "
+            f"tls_p99={tls.get('p99', 0)}ms peak_accept/s={stats['rates'].get('accept.accepted', {}).get('peak_per_sec', 0)}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Server CPU spent on a reconnect storm: every client logging in again with its
+password versus resuming with the token from its last login.
+
+Seeds --users accounts and logs each one in once to collect a resume token. All of
+them then reconnect at the same moment, first with the password, as they would
+after a server restart, and then with their tokens. Each reconnect counts as done
+once the contact list has arrived. Reported for each storm: wall time, reconnect
+latency, and the CPU seconds the server process used, read from /proc. Login
+throttling is opened up so it doesn't refuse the storm.
+
+    python3 scripts/bench_resume_storm.py --users 500
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from benchlib import BENCH_PASSWORD, LineClient, ServerProcess, _child_pids, percentile, raise_nofile_limit, seed_users
+
+
+def _cpu_seconds(pid):
+    total = 0
+    for p in [pid] + _child_pids(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+        except OSError:
+            pass
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+async def _reconnect(port, req):
+    started = time.perf_counter()
+    c = await LineClient.connect(port)
+    await c.send(req)
+    resp = await c.recv()
+    if resp.get("status") == "ok":
+        await c.recv_action("contact_list")
+    await c.close()
+    return resp, (time.perf_counter() - started) * 1000.0
+
+
+async def _storm(port, requests):
+    started = time.perf_counter()
+    results = await asyncio.gather(*[_reconnect(port, req) for req in requests])
+    elapsed = time.perf_counter() - started
+    ok = [ms for resp, ms in results if resp.get("status") == "ok"]
+    return elapsed, ok, len(results) - len(ok), [resp for resp, _ in results]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--engine", default="threaded")
+    args = parser.parse_args()
+    raise_nofile_limit()
+
+    users = [f"user{i}" for i in range(args.users)]
+    server = ServerProcess({"server": {
+        "engine": args.engine,
+        "login_ip_burst": args.users * 10,
+        "login_resume_burst": args.users * 10,
+        "login_user_burst": 100,
+        "password_queue": args.users,
+    }})
+    seed_users(server.db_path, users)
+    with server:
+        caps = {"resume": True}
+        password = [{"action": "login", "user": u, "pass": BENCH_PASSWORD, "caps": caps} for u in users]
+        # The first logins also rehash the seeded passwords if the argon2 settings differ.
+        _, _, _, first = asyncio.run(_storm(server.port, password))
+        tokens = [resp["resume"]["token"] for resp in first]
+        resume = [{"action": "resume", "token": t, "caps": caps} for t in tokens]
+
+        print(f"users: {args.users}, engine: {args.engine}")
+        print(f"{'reconnect':<10} {'total s':>8} {'p50 ms':>8} {'p99 ms':>8} {'failed':>7} {'server CPU s':>13}")
+        for label, requests in (("password", password), ("resume", resume)):
+            cpu = _cpu_seconds(server.proc.pid)
+            elapsed, latencies, failed, _ = asyncio.run(_storm(server.port, requests))
+            cpu = _cpu_seconds(server.proc.pid) - cpu
+            print(f"{label:<10} {elapsed:>8.2f} {percentile(latencies, 50):>8.0f} {percentile(latencies, 99):>8.0f} "
+                  f"{failed:>7} {cpu:>13.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Message write latency while expired history is deleted: the server's batched,
+paced retention pass versus one unbatched DELETE.
+
+Seeds a database with message history where half of the rows are older than the
+retention period, then records a stream of new messages through the group-commit
+writer (as the msg handler does, but waiting for each commit) and reports their
+latency with no cleanup running, during _run_retention, and during a single
+DELETE of every expired row. Each case starts from a fresh copy of the database.
+
+    python3 scripts/bench_retention.py --rows 300000
+"""
+import argparse
+import json
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from benchlib import load_server_module, percentile, seed_users
+
+DAY = 86400
+
+
+def _seed(server, db, rows):
+    server.history_config["enabled"] = True
+    seed_users(db, ["bench_a", "bench_b"])
+    con = sqlite3.connect(str(db))
+    now = int(time.time())
+    words = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+    con.executemany(
+        "INSERT INTO history(conversation, seq, id, sender, sent_at, body, stored_at) VALUES(?,?,?,?,?,?,?)",
+        ((server._conversation_id(f"user{i % 500}", f"user{i % 499 + 1}"), i, i, f"user{i % 500}", "",
+          " ".join(words[(i + k) % len(words)] for k in range(10)), now - (60 if i <= rows // 2 else 30) * DAY)
+         for i in range(1, rows + 1)),
+    )
+    con.execute("INSERT INTO group_policies(scope, group_name, policy_json) VALUES('global', '__global__', ?)",
+                (json.dumps({"group_retention_days": 45}),))
+    con.commit()
+    con.close()
+
+
+def _writes_during(server, cleanup, interval):
+    conversation = server._conversation_id("bench_a", "bench_b")
+    latencies = []
+    done = threading.Event()
+
+    def writer():
+        while not done.is_set():
+            started = time.perf_counter()
+            server.db_writer.execute(server.HISTORY_INSERT, (conversation, conversation, "bench_a", "", "hello there"))
+            latencies.append((time.perf_counter() - started) * 1000.0)
+            time.sleep(interval)
+
+    t = threading.Thread(target=writer)
+    t.start()
+    started = time.perf_counter()
+    cleanup()
+    elapsed = time.perf_counter() - started
+    done.set()
+    t.join()
+    return latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=300000)
+    parser.add_argument("--idle-seconds", type=float, default=3.0)
+    parser.add_argument("--interval-ms", type=float, default=2.0, help="pause between message writes")
+    parser.add_argument("--batch", type=int, default=None, help="retention_batch (default: the server's)")
+    parser.add_argument("--pause-ms", type=int, default=None, help="retention_pause_ms (default: the server's)")
+    args = parser.parse_args()
+
+    server = load_server_module()
+    if args.batch is not None:
+        server.retention_config["batch"] = args.batch
+    if args.pause_ms is not None:
+        server.retention_config["pause_ms"] = args.pause_ms
+    with tempfile.TemporaryDirectory(prefix="thrive-bench-") as tmp:
+        seed = Path(tmp) / "seed.db"
+        _seed(server, seed, args.rows)
+        cutoff = int(time.time()) - 45 * DAY
+
+        def unbatched():
+            server.db_writer.execute("DELETE FROM history WHERE stored_at < ?", (cutoff,))
+
+        cases = (
+            ("no cleanup", lambda: time.sleep(args.idle_seconds)),
+            ("retention pass", server._run_retention),
+            ("one DELETE", unbatched),
+        )
+        print(f"history rows: {args.rows}, expired: {args.rows // 2}")
+        print(f"{'cleanup':<16} {'seconds':>8} {'writes':>7} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        for i, (label, cleanup) in enumerate(cases):
+            db = Path(tmp) / f"case{i}.db"
+            shutil.copy(seed, db)
+            server.DB = str(db)
+            server.group_policy_store.reload()
+            latencies, elapsed = _writes_during(server, cleanup, args.interval_ms / 1000.0)
+            print(f"{label:<16} {elapsed:>8.1f} {len(latencies):>7} {percentile(latencies, 50):>8.2f} "
+                  f"{percentile(latencies, 99):>8.2f} {max(latencies):>8.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
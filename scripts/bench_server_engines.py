@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Compare the threaded and asyncio serving engines.
+
+For each engine and connection count the server is started fresh, N connections are
+opened and held idle (each one occupies a handler in the threaded engine exactly like
+an idle client does), then a set of logged-in sender/receiver pairs exchange direct
+messages. Reported: server RSS, server thread count and end-to-end msg latency.
+
+    python3 scripts/bench_server_engines.py --connections 1000,5000,10000
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from benchlib import LineClient, ServerProcess, percentile, raise_nofile_limit, seed_users
+
+
+async def _open_idle(port, count, batch=250):
+    conns = []
+    for start in range(0, count, batch):
+        chunk = await asyncio.gather(*[LineClient.connect(port) for _ in range(min(batch, count - start))])
+        conns.extend(chunk)
+    return conns
+
+
+async def _login_pairs(port, pairs):
+    async def login_pair(i):
+        sender = await LineClient.connect(port)
+        receiver = await LineClient.connect(port)
+        await sender.login(f"bench_s{i}")
+        await receiver.login(f"bench_r{i}")
+        return i, sender, receiver
+
+    return await asyncio.gather(*[login_pair(i) for i in range(pairs)])
+
+
+async def _pair_latencies(logged_in, messages):
+    latencies = []
+
+    async def run_pair(i, sender, receiver):
+        for n in range(messages):
+            sent_at = time.perf_counter()
+            await sender.send({"action": "msg", "from": f"bench_s{i}", "to": f"bench_r{i}", "time": "", "msg": f"ping {n}"})
+            await receiver.recv_action("msg")
+            latencies.append((time.perf_counter() - sent_at) * 1000.0)
+        await sender.close()
+        await receiver.close()
+
+    await asyncio.gather(*[run_pair(*pair) for pair in logged_in])
+    return latencies
+
+
+async def _run_case(server, connections, pairs, messages):
+    idle = await _open_idle(server.port, connections)
+    await asyncio.sleep(1.0)
+    rss_kib, threads = server.proc_status()
+    logged_in = await _login_pairs(server.port, pairs)
+    started = time.perf_counter()
+    latencies = await _pair_latencies(logged_in, messages)
+    elapsed = time.perf_counter() - started
+    for c in idle:
+        c.writer.close()
+    return {
+        "rss_mib": rss_kib / 1024.0,
+        "threads": threads,
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+        "msgs_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", default="1000,5000,10000")
+    parser.add_argument("--engines", default="threaded,asyncio")
+    parser.add_argument("--pairs", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=50)
+    args = parser.parse_args()
+
+    limit = raise_nofile_limit()
+    counts = [int(c) for c in args.connections.split(",") if c.strip()]
+    if max(counts) * 2 + 100 > limit:
+        print(f"WARNING: RLIMIT_NOFILE is {limit}; the largest case needs about {max(counts) * 2 + 100} descriptors.")
+
+    print(f"{'engine':<10} {'conns':>7} {'rss MiB':>9} {'threads':>8} {'p50 ms':>8} {'p99 ms':>8} {'msg/s':>9}")
+    for engine in [e.strip() for e in args.engines.split(",") if e.strip()]:
+        for count in counts:
+            server = ServerProcess({"server": {"engine": engine, "rate_limits": "false"}})
+            users = [f"bench_s{i}" for i in range(args.pairs)] + [f"bench_r{i}" for i in range(args.pairs)]
+            seed_users(server.db_path, users)
+            with server:
+                r = asyncio.run(_run_case(server, count, args.pairs, args.messages))
+            print(f"{engine:<10} {count:>7} {r['rss_mib']:>9.1f} {r['threads']:>8} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['msgs_per_sec']:>9.0f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Handshakes per second with and without TLS session resumption.
+
+Each connection does a TLS handshake, asks for the pre-login welcome info (a
+reply is needed before a TLS 1.3 ticket reaches the client) and closes. With
+resumption on, every connection offers the session saved by the one before it,
+the way the client does across reconnect attempts. Reported: client-side
+handshakes/sec, handshake latency and the server's CPU seconds and resumption rate.
+
+    python3 scripts/bench_tls_resumption.py --connections 500 --concurrency 8
+"""
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+
+from benchlib import ServerProcess, client_ssl_context, make_self_signed_cert, percentile
+
+
+def _server_stats(server):
+    server.proc.stdin.write(b"stats tls\n")
+    server.proc.stdin.flush()
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        text = server.log_path.read_text()
+        idx = text.rfind('{\n  "counters"')
+        if idx >= 0:
+            try:
+                return json.JSONDecoder().raw_decode(text[idx:])[0]
+            except ValueError:
+                pass
+        time.sleep(0.2)
+    return {}
+
+
+def _cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / 100.0
+
+
+def _worker(port, count, resume, latencies, lock):
+    context = client_ssl_context()
+    session = None
+    for _ in range(count):
+        started = time.perf_counter()
+        raw = socket.create_connection(("127.0.0.1", port))
+        ssock = context.wrap_socket(raw, server_hostname="localhost", session=session if resume else None)
+        elapsed = time.perf_counter() - started
+        ssock.sendall(b'{"action": "get_welcome"}\n')
+        ssock.makefile("rb").readline()
+        if resume:
+            session = ssock.session
+        ssock.close()
+        with lock:
+            latencies.append(elapsed * 1000.0)
+
+
+def _run_case(server, connections, concurrency, resume):
+    latencies, lock = [], threading.Lock()
+    per_thread = max(1, connections // concurrency)
+    cpu_before = _cpu_seconds(server.proc.pid)
+    started = time.perf_counter()
+    threads = [threading.Thread(target=_worker, args=(server.port, per_thread, resume, latencies, lock)) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    cpu = _cpu_seconds(server.proc.pid) - cpu_before
+    gauges = _server_stats(server).get("gauges", {})
+    return {
+        "per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+        "cpu_ms_per_conn": cpu * 1000.0 / max(1, len(latencies)),
+        "resumed": gauges.get("tls.resumption_rate", 0.0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--engines", default="threaded,asyncio")
+    args = parser.parse_args()
+
+    print(f"{'engine':<10} {'resume':<7} {'hs/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'srv cpu ms/conn':>16} {'resumed':>8}")
+    for engine in [e.strip() for e in args.engines.split(",") if e.strip()]:
+        for resume in (False, True):
+            server = ServerProcess({"server": {"engine": engine}})
+            cert, key = make_self_signed_cert(server.workdir)
+            server.sections["server"].update(certfile=str(cert), keyfile=str(key))
+            with server:
+                r = _run_case(server, args.connections, args.concurrency, resume)
+            print(f"{engine:<10} {'yes' if resume else 'no':<7} {r['per_sec']:>8.0f} {r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['cpu_ms_per_conn']:>16.2f} {r['resumed']:>8.1%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Username lookup time with a large users table, before and after username_norm.
+
+Builds a database in the pre-migration schema with N synthetic accounts, times the
+old case-insensitive login and create_account queries, runs init_db() (the
+username_norm migration) and times the indexed queries that replaced them.
+
+    python3 scripts/bench_username_lookup.py --users 1000000
+"""
+import argparse
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchlib import load_server_module
+
+OLD_LOGIN = ("SELECT username, password, banned_until, ban_reason, is_verified FROM users "
+             "WHERE username = ? COLLATE NOCASE ORDER BY CASE WHEN username = ? THEN 0 ELSE 1 END, username LIMIT 2")
+NEW_LOGIN = ("SELECT username, password, banned_until, ban_reason, is_verified FROM users "
+             "WHERE username_norm = ? ORDER BY CASE WHEN username = ? THEN 0 ELSE 1 END, username LIMIT 2")
+OLD_CREATE = "SELECT 1 FROM users WHERE LOWER(username)=LOWER(?)"
+NEW_CREATE = "SELECT 1 FROM users WHERE username_norm=?"
+
+
+def _build(db, users):
+    con = sqlite3.connect(db)
+    con.execute("CREATE TABLE users (username TEXT PRIMARY KEY, password TEXT, banned_until TEXT, ban_reason TEXT, "
+                "email TEXT, verification_code TEXT, is_verified INTEGER DEFAULT 1, reset_code TEXT, "
+                "verification_code_at TEXT, reset_code_at TEXT)")
+    con.executemany("INSERT INTO users(username, password) VALUES(?, 'x')", ((f"User{i:07d}",) for i in range(users)))
+    con.commit()
+    con.close()
+
+
+def _time_queries(db, sql, args_for, names):
+    con = sqlite3.connect(db)
+    started = time.perf_counter()
+    for name in names:
+        con.execute(sql, args_for(name)).fetchall()
+    elapsed = time.perf_counter() - started
+    con.close()
+    return elapsed * 1000.0 / len(names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--old-lookups", type=int, default=20)
+    parser.add_argument("--new-lookups", type=int, default=20000)
+    args = parser.parse_args()
+
+    server = load_server_module()
+    rng = random.Random(1)
+    names = [f"user{rng.randrange(args.users):07d}" for _ in range(max(args.old_lookups, args.new_lookups))]
+    with tempfile.TemporaryDirectory(prefix="thrive-bench-") as tmp:
+        db = str(Path(tmp) / "thrive.db")
+        started = time.perf_counter()
+        _build(db, args.users)
+        print(f"built {args.users} users in {time.perf_counter() - started:.1f}s")
+
+        old_login = _time_queries(db, OLD_LOGIN, lambda n: (n, n), names[:args.old_lookups])
+        old_create = _time_queries(db, OLD_CREATE, lambda n: (n,), names[:args.old_lookups])
+
+        server.DB = db
+        started = time.perf_counter()
+        server.init_db()
+        migrate_s = time.perf_counter() - started
+
+        new_login = _time_queries(db, NEW_LOGIN, lambda n: (server._norm_username(n), n), names[:args.new_lookups])
+        new_create = _time_queries(db, NEW_CREATE, lambda n: (server._norm_username(n),), names[:args.new_lookups])
+
+    print(f"migration (init_db): {migrate_s:.1f}s")
+    print(f"{'query':<16} {'before ms':>10} {'after ms':>10} {'speedup':>9}")
+    for label, before, after in (("login", old_login, new_login), ("create_account", old_create, new_create)):
+        print(f"{label:<16} {before:>10.3f} {after:>10.4f} {before / after:>8.0f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Message throughput against the number of server worker processes.
+
+For each worker count the server is started with --workers N, a set of sender/receiver
+pairs log in (so most pairs end up on different workers and exercise the bus), then
+every sender streams messages to its receiver as fast as the server accepts them.
+Reported: delivered msg/s, p50/p99 delivery latency and server RSS summed over all
+processes. Throughput only scales on a machine with spare cores.
+
+    python3 scripts/bench_workers.py --workers 1,2,4 --pairs 50 --messages 400
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from benchlib import LineClient, ServerProcess, percentile, raise_nofile_limit, seed_users
+
+
+async def _run_case(port, pairs, messages):
+    async def login(name):
+        c = await LineClient.connect(port)
+        await c.login(name)
+        return c
+
+    senders = await asyncio.gather(*[login(f"bench_s{i}") for i in range(pairs)])
+    receivers = await asyncio.gather(*[login(f"bench_r{i}") for i in range(pairs)])
+    # Let presence reach every worker before anyone sends.
+    await asyncio.sleep(1.0)
+    latencies = []
+
+    async def send_all(i, sender):
+        for n in range(messages):
+            await sender.send({"action": "msg", "from": f"bench_s{i}", "to": f"bench_r{i}", "time": repr(time.perf_counter()), "msg": f"load {n}"})
+
+    async def receive_all(receiver):
+        for _ in range(messages):
+            msg = await receiver.recv_action("msg")
+            latencies.append((time.perf_counter() - float(msg["time"])) * 1000.0)
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        *[send_all(i, s) for i, s in enumerate(senders)],
+        *[receive_all(r) for r in receivers],
+    )
+    elapsed = time.perf_counter() - started
+    for c in senders + receivers:
+        await c.close()
+    return len(latencies) / elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--engine", default="threaded")
+    parser.add_argument("--pairs", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=400)
+    args = parser.parse_args()
+    raise_nofile_limit()
+
+    print(f"cpus: {os.cpu_count()}")
+    print(f"{'workers':>7} {'msg/s':>9} {'p50 ms':>8} {'p99 ms':>9} {'rss MiB':>9}")
+    for workers in [int(w) for w in args.workers.split(",") if w.strip()]:
+        server = ServerProcess({"server": {"engine": args.engine, "rate_limits": "false"}}, args=("--workers", str(workers)))
+        users = [f"bench_s{i}" for i in range(args.pairs)] + [f"bench_r{i}" for i in range(args.pairs)]
+        seed_users(server.db_path, users)
+        with server:
+            # Give every worker time to bind before the first connection.
+            time.sleep(1.0 + 0.2 * workers)
+            rate, latencies = asyncio.run(_run_case(server.port, args.pairs, args.messages))
+            rss_kib, _ = server.proc_status()
+        print(f"{workers:>7} {rate:>9.0f} {percentile(latencies, 50):>8.2f} {percentile(latencies, 99):>9.2f} {rss_kib / 1024.0:>9.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""Shared helpers for the scripts/bench_*.py server benchmarks.
+
+Each benchmark launches srv/server.py as a subprocess inside a throwaway working
+directory (its own srv.conf and thrive.db) and drives it over real sockets.
+"""
+import asyncio
+import configparser
+import json
+import os
+import resource
+import socket
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ROOT = Path(__file__).resolve().parents[1]
+SERVER = ROOT / "srv" / "server.py"
+BENCH_PASSWORD = "bench-pass"
+
+
+def load_server_module():
+    sys.path.insert(0, str(SERVER.parent))
+    import server
+    return server
+
+
+def raise_nofile_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+def make_self_signed_cert(directory):
+    """Write server.crt/server.key for localhost into directory using the openssl CLI."""
+    directory = Path(directory)
+    cert, key = directory / "server.crt", directory / "server.key"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "2",
+         "-subj", "/CN=localhost", "-keyout", str(key), "-out", str(cert)],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return cert, key
+
+
+def client_ssl_context():
+    import ssl
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def seed_users(db_path, usernames, password=BENCH_PASSWORD, contacts=()):
+    """Create verified accounts sharing one argon2 hash so seeding stays fast."""
+    server = load_server_module()
+    server.DB = str(db_path)
+    server.init_db()
+    hashed = server._ph.hash(password)
+    con = sqlite3.connect(str(db_path))
+    con.executemany(
+        "INSERT OR IGNORE INTO users(username, password, is_verified) VALUES(?,?,1)",
+        [(u, hashed) for u in usernames],
+    )
+    con.executemany("INSERT OR IGNORE INTO contacts(owner, contact) VALUES(?,?)", list(contacts))
+    con.commit()
+    con.close()
+
+
+class ServerProcess:
+    """Run srv/server.py in a temporary directory with the given srv.conf sections."""
+
+    def __init__(self, sections=None, workdir=None, args=()):
+        self.port = free_port()
+        self.sections = {"server": {}, "bots": {"ollama_enabled": "false"}}
+        for name, values in (sections or {}).items():
+            self.sections.setdefault(name, {}).update(values)
+        self.sections["server"].setdefault("port", str(self.port))
+        self.port = int(self.sections["server"]["port"])
+        self._tmp = None if workdir else tempfile.TemporaryDirectory(prefix="thrive-bench-")
+        self.workdir = Path(workdir or self._tmp.name)
+        self.args = list(args)
+        self.proc = None
+        self.log_path = self.workdir / "server.log"
+
+    @property
+    def db_path(self):
+        return self.workdir / "thrive.db"
+
+    def write_config(self):
+        cfg = configparser.ConfigParser(interpolation=None)
+        for name, values in self.sections.items():
+            cfg[name] = {k: str(v) for k, v in values.items()}
+        with open(self.workdir / "srv.conf", "w") as f:
+            cfg.write(f)
+
+    def start(self, timeout=30):
+        self.write_config()
+        log = open(self.log_path, "w")
+        self.proc = subprocess.Popen(
+            [sys.executable, str(SERVER), *self.args],
+            cwd=str(self.workdir),
+            stdin=subprocess.PIPE,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"Server exited early, see {self.log_path}:\n{self.log_path.read_text()}")
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=0.5):
+                    return self
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError(f"Server did not start listening on port {self.port}")
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        if self._tmp:
+            self._tmp.cleanup()
+
+    def proc_status(self):
+        """Return (rss_kib, threads) summed over the server and any forked workers."""
+        rss = threads = 0
+        for pid in [self.proc.pid] + _child_pids(self.proc.pid):
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            rss += int(line.split()[1])
+                        elif line.startswith("Threads:"):
+                            threads += int(line.split()[1])
+            except OSError:
+                pass
+        return rss, threads
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _child_pids(pid):
+    # Each thread lists the children it started; workers respawned by the cluster
+    # parent's monitor thread aren't children of its main thread.
+    pids = []
+    for task in Path(f"/proc/{pid}/task").glob("*"):
+        try:
+            pids += [int(p) for p in (task / "children").read_text().split()]
+        except OSError:
+            pass
+    return sorted(pids)
+
+
+FRAME_HEADER = struct.Struct("!BI")
+
+
+class LineClient:
+    """Minimal asyncio client for driving the server: JSON lines, or binary frames
+    when login negotiated them."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.codec = "json"
+        self.wire_bytes = 0
+        self._inflate = None
+        self._buf = bytearray()
+
+    @classmethod
+    async def connect(cls, port, host="127.0.0.1", ssl_context=None):
+        reader, writer = await asyncio.open_connection(host, port, ssl=ssl_context, limit=64 * 1024 * 1024)
+        return cls(reader, writer)
+
+    async def send(self, payload):
+        if self.codec == "msgpack":
+            body = msgpack.packb(payload, use_bin_type=True)
+            self.writer.write(FRAME_HEADER.pack(0, len(body)) + body)
+        else:
+            self.writer.write((json.dumps(payload) + "\n").encode())
+        await self.writer.drain()
+
+    async def _fill(self):
+        chunk = await self.reader.read(65536)
+        if not chunk:
+            raise ConnectionError("Server closed the connection.")
+        self.wire_bytes += len(chunk)
+        self._buf += self._inflate.decompress(chunk)
+
+    async def _read_exactly(self, n):
+        if self._inflate is None:
+            try:
+                data = await self.reader.readexactly(n)
+            except asyncio.IncompleteReadError:
+                raise ConnectionError("Server closed the connection.")
+            self.wire_bytes += len(data)
+            return data
+        while len(self._buf) < n:
+            await self._fill()
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+        return data
+
+    async def _read_line(self):
+        if self._inflate is None:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError("Server closed the connection.")
+            self.wire_bytes += len(line)
+            return line
+        while b"\n" not in self._buf:
+            await self._fill()
+        i = self._buf.index(b"\n") + 1
+        line = bytes(self._buf[:i])
+        del self._buf[:i]
+        return line
+
+    async def recv(self):
+        if self.codec == "msgpack":
+            flags, length = FRAME_HEADER.unpack(await self._read_exactly(FRAME_HEADER.size))
+            return msgpack.unpackb(await self._read_exactly(length), raw=False)
+        return json.loads(await self._read_line())
+
+    async def recv_action(self, action):
+        while True:
+            msg = await self.recv()
+            if msg.get("action") == action:
+                return msg
+
+    async def login(self, username, password=BENCH_PASSWORD, **extra):
+        await self.send(dict({"action": "login", "user": username, "pass": password}, **extra))
+        resp = await self.recv()
+        if resp.get("status") != "ok":
+            raise RuntimeError(f"Login failed for {username}: {resp}")
+        caps = resp.get("caps") or {}
+        self.codec = caps.get("framing", "json")
+        if caps.get("compression") == "zlib":
+            self._inflate = zlib.decompressobj()
+        await self.recv_action("contact_list")
+        return resp
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Behaviour checks against a running server, for the cases that only show up over
+real sockets or across worker processes.
+
+Each check starts srv/server.py with the settings it needs, drives it with
+LineClient and raises AssertionError when the server gets it wrong. With no
+arguments every check runs; otherwise only the named ones.
+
+    python3 scripts/server_checks.py
+    python3 scripts/server_checks.py cluster_worker_lost
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sys
+import time
+
+from benchlib import LineClient, ServerProcess, _child_pids, seed_users
+
+CHECKS = {}
+
+
+def check(fn):
+    CHECKS[fn.__name__] = fn
+    return fn
+
+
+async def _until_closed_or(client, predicate, timeout):
+    """Read frames until one matches predicate ("match"), the server closes the
+    connection ("closed") or timeout passes ("timeout")."""
+    try:
+        while True:
+            msg = await asyncio.wait_for(client.recv(), timeout)
+            if predicate(msg):
+                return "match"
+    except asyncio.TimeoutError:  # before OSError, which it subclasses
+        return "timeout"
+    except (ConnectionError, OSError):
+        return "closed"
+
+
+@check
+def cluster_worker_lost():
+    """A worker that dies takes its users offline for contacts on the other workers."""
+    server = ServerProcess({"server": {"workers": "2"}})
+    seed_users(server.db_path, ["alice", "bob"], contacts=[("alice", "bob"), ("bob", "alice")])
+
+    async def attempt():
+        alice = await LineClient.connect(server.port)
+        await alice.login("alice")
+        bob = await LineClient.connect(server.port)
+        await bob.login("bob")
+        await asyncio.sleep(0.5)
+        os.kill(_child_pids(server.proc.pid)[0], signal.SIGKILL)
+        results = await asyncio.gather(*[
+            _until_closed_or(c, lambda m, peer=peer: m.get("action") == "contact_status"
+                             and m.get("user") == peer and m.get("online") is False, 5)
+            for c, peer in ((alice, "bob"), (bob, "alice"))
+        ])
+        await alice.close()
+        await bob.close()
+        return sorted(results)
+
+    with server:
+        # SO_REUSEPORT picks the worker, so retry until the two users land on different ones.
+        for _ in range(20):
+            results = asyncio.run(attempt())
+            if results.count("closed") == 1:
+                assert results == ["closed", "match"], f"watcher was not told its contact went offline: {results}"
+                return
+            time.sleep(2)  # let the parent respawn the killed worker
+        raise AssertionError("alice and bob never landed on different workers")
+
+
+def _over_cap(engine):
+    server = ServerProcess({"server": {"engine": engine, "max_connections": "1"}})
+    seed_users(server.db_path, ["alice"])
+
+    async def attempt():
+        first = await LineClient.connect(server.port)
+        await first.login("alice")
+        # Refused connections are reset, which may already fail the connect.
+        try:
+            second = await LineClient.connect(server.port)
+        except ConnectionError:
+            result = "closed"
+        else:
+            result = await _until_closed_or(second, lambda m: True, 5)
+            await second.close()
+        assert result == "closed", f"connection over max_connections was not refused: {result}"
+        await first.close()
+        assert "Traceback" not in server.log_path.read_text(), "the server raised while refusing a connection"
+
+    with server:
+        for _ in range(2):
+            time.sleep(0.5)  # let the last connection's slot come back
+            asyncio.run(attempt())
+
+
+@check
+def asyncio_over_cap():
+    """With max_connections reached, the asyncio engine refuses the next connection cleanly."""
+    _over_cap("asyncio")
+
+
+@check
+def threaded_over_cap():
+    """The same for the threaded engine."""
+    _over_cap("threaded")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("checks", nargs="*", choices=[[]] + sorted(CHECKS), metavar="check")
+    args = parser.parse_args()
+    failed = 0
+    for name in args.checks or sorted(CHECKS):
+        started = time.perf_counter()
+        try:
+            CHECKS[name]()
+            outcome = "ok"
+        except AssertionError as e:
+            failed += 1
+            outcome = f"FAILED: {e}"
+        print(f"{name:<28} {outcome} ({time.perf_counter() - started:.1f}s)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
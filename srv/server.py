@@ -1,8 +1,14 @@
 import sqlite3, threading, socket, json, datetime, sys, configparser, ssl, os, uuid, base64, time, subprocess, tempfile, glob, zipfile
+import abc, argparse, asyncio, bisect, collections, hashlib, hmac, math, selectors, struct, zlib
+from concurrent.futures import Future, ThreadPoolExecutor
 import smtplib, secrets
 import urllib.request, urllib.parse
 from email.mime.text import MIMEText
 from argon2 import PasswordHasher
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 from argon2.exceptions import VerifyMismatchError, VerificationError, InvalidHashError
 _ph = PasswordHasher()
 
@@ -36,6 +42,21 @@ restart_lock = threading.Lock()
 restart_scheduled_for = None
 group_call_sessions = {}
 group_call_lock = threading.Lock()
+engine_pools = {}
+connection_config = {}
+protocol_config = {}
+worker_id = 0
+bus = None
+cluster_workers = {}
+cluster_lock = threading.Lock()
+cluster_stopping = False
+open_connections = 0
+connections_lock = threading.Lock()
+login_limiters = {}
+password_config = {'workers': os.cpu_count() or 2, 'queue': 64}
+session_config = {'token_hours': 24, 'key_file': 'session.key'}
+rate_limit_config = {'enabled': False, 'msg_burst': 20, 'typing_per_minute': 60, 'typing_burst': 10,
+                     'signal_per_minute': 1200, 'signal_burst': 200, 'users_max': 100000}
 FEATURE_DEFAULTS = {
     "bots": {"enabled": True, "ui_visible": True, "scope": "all", "description": "Bot contacts and bot chat features."},
     "bot_rules": {"enabled": True, "ui_visible": True, "scope": "admin", "description": "Bot rules management features."},
@@ -71,10 +92,368 @@ GROUP_POLICY_SCHEMA = {
     "group_message_delete_undo_seconds": ("int", 20, "Undo window after deleting group messages."),
     "group_rate_limit_per_minute": ("int", 120, "Per-user group message rate limit per minute."),
     "group_slow_mode_seconds": ("int", 0, "Slow mode delay between messages (0 disables)."),
-    "group_retention_days": ("int", 0, "Message retention days (0 keeps indefinitely)."),
+    "group_retention_days": ("int", 0, "Message history retention days (0 keeps indefinitely)."),
     "group_require_verified_users": ("bool", False, "Require verified accounts for group participation."),
 }
 
+class _Metrics:
+    """Thread-safe counters, rates, gauges and histograms reported by the stats admin command."""
+    LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._hists = {}
+        self._rates = {}
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def mark(self, name, amount=1):
+        """Count an event and keep one-second buckets for the last minute, for per-second rates."""
+        now = int(time.time())
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+            r = self._rates.get(name)
+            if r is None:
+                r = self._rates[name] = {"buckets": collections.deque(maxlen=60), "peak": 0}
+            buckets = r["buckets"]
+            if buckets and buckets[-1][0] == now:
+                buckets[-1][1] += amount
+            else:
+                buckets.append([now, amount])
+            r["peak"] = max(r["peak"], buckets[-1][1])
+
+    def gauge(self, name, value):
+        # value may be a zero-argument callable, evaluated on every snapshot.
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS_MS):
+        with self._lock:
+            h = self._hists.get(name)
+            if h is None:
+                h = self._hists[name] = {"bounds": buckets, "counts": [0] * (len(buckets) + 1), "count": 0, "sum": 0.0, "max": 0.0}
+            h["counts"][bisect.bisect_left(h["bounds"], value)] += 1
+            h["count"] += 1
+            h["sum"] += value
+            h["max"] = max(h["max"], value)
+
+    @staticmethod
+    def _quantile(h, q):
+        target = q * h["count"]
+        seen = 0
+        for i, n in enumerate(h["counts"]):
+            seen += n
+            if n and seen >= target:
+                return h["bounds"][i] if i < len(h["bounds"]) else h["max"]
+        return h["max"]
+
+    def snapshot(self, prefix=""):
+        with self._lock:
+            counters = {k: v for k, v in self._counters.items() if k.startswith(prefix)}
+            gauges = {k: v for k, v in self._gauges.items() if k.startswith(prefix)}
+            hists = {
+                k: {
+                    "count": h["count"],
+                    "avg": round(h["sum"] / h["count"], 3) if h["count"] else 0,
+                    "p50": self._quantile(h, 0.50),
+                    "p99": self._quantile(h, 0.99),
+                    "max": round(h["max"], 3),
+                }
+                for k, h in self._hists.items() if k.startswith(prefix)
+            }
+            now = int(time.time())
+            rates = {}
+            for k, r in self._rates.items():
+                if not k.startswith(prefix):
+                    continue
+                last10 = sum(n for sec, n in r["buckets"] if now - sec < 10)
+                last60 = sum(n for sec, n in r["buckets"] if now - sec < 60)
+                rates[k] = {"per_sec_10s": round(last10 / 10.0, 2), "per_sec_60s": round(last60 / 60.0, 2), "peak_per_sec": r["peak"]}
+        for k, v in list(gauges.items()):
+            if callable(v):
+                try: gauges[k] = v()
+                except Exception: gauges[k] = None
+        return {"counters": dict(sorted(counters.items())), "rates": dict(sorted(rates.items())), "gauges": dict(sorted(gauges.items())), "histograms": dict(sorted(hists.items()))}
+
+metrics = _Metrics()
+metrics.gauge("sessions.online", lambda: len(clients))
+metrics.gauge("sessions.local", lambda: sum(1 for s in list(clients.values()) if isinstance(s, ClientSession)))
+
+db_config = {'synchronous': 'NORMAL', 'cache_kb': 8192, 'mmap_mb': 64, 'pool_size': 16, 'group_commit': False, 'commit_ms': 5, 'commit_max': 500}
+offline_config = {'enabled': True, 'max_messages': 500, 'max_kb': 1024, 'page_size': 500}
+history_config = {'enabled': False, 'page_max': 200}
+retention_config = {'interval_minutes': 60, 'batch': 100, 'pause_ms': 50, 'offline_days': 0}
+HISTORY_CURSOR_END = 2 ** 63 - 1
+
+class _PooledConnection:
+    """A sqlite3 connection lent out by _db_connect(). close() rolls back anything left
+    uncommitted, like closing a real connection would, and hands the connection back
+    to the pool."""
+    __slots__ = ("_con", "_pool", "_owner", "_path")
+
+    def __init__(self, con, pool, owner, path):
+        self._con = con
+        self._pool = pool
+        self._owner = owner
+        self._path = path
+
+    def close(self):
+        con, self._con = self._con, None
+        if con is None:
+            return
+        if con.in_transaction:
+            try: con.rollback()
+            except sqlite3.Error: pass
+        self._pool.release(con, self._owner, self._path)
+
+    def __del__(self):
+        # Dropped without close(), e.g. by an exception: free its slot in the pool and
+        # let the connection itself close once nothing else refers to it.
+        if self._con is not None:
+            self._con = None
+            self._pool.release(None, self._owner, self._path)
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+def _db_open():
+    con = sqlite3.connect(DB, cached_statements=256, check_same_thread=False)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute(f"PRAGMA synchronous={db_config['synchronous']}")
+    con.execute(f"PRAGMA cache_size=-{db_config['cache_kb']}")
+    con.execute(f"PRAGMA mmap_size={db_config['mmap_mb'] * 1024 * 1024}")
+    metrics.incr("db.connections_opened")
+    return con
+
+class _DbPool:
+    """Connections shared by every thread, lent out for one call at a time. At most
+    pool_size are open; a thread that needs one while all are lent out waits for one
+    to come back. A thread that already holds one never waits, since its caller can't
+    give it back first: it gets an extra connection, closed again when returned."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._idle = []
+        self._open = 0
+        self._path = None
+        self._holders = collections.Counter()
+
+    def acquire(self):
+        owner = threading.get_ident()
+        con = None
+        with self._cond:
+            if self._path != DB:
+                self._drain()
+                self._path = DB
+            path = self._path
+            if not self._idle and self._open >= db_config['pool_size'] and not self._holders[owner]:
+                metrics.incr("db.pool_waits")
+                started = time.perf_counter()
+                while not self._idle and self._open >= db_config['pool_size']:
+                    self._cond.wait()
+                metrics.observe("db.pool_wait_ms", (time.perf_counter() - started) * 1000.0)
+            if self._idle:
+                con = self._idle.pop()
+            else:
+                self._open += 1
+            self._holders[owner] += 1
+        if con is None:
+            try:
+                con = _db_open()
+            except BaseException:
+                self.release(None, owner, path)
+                raise
+        return _PooledConnection(con, self, owner, path)
+
+    def release(self, con, owner, path):
+        with self._cond:
+            self._holders[owner] -= 1
+            if not self._holders[owner]:
+                del self._holders[owner]
+            if path != self._path:
+                pass
+            elif con is not None and self._open <= db_config['pool_size']:
+                self._idle.append(con)
+                con = None
+            else:
+                self._open -= 1
+            self._cond.notify()
+        if con is not None:
+            con.close()
+
+    def _drain(self):
+        # DB changed (tests and benchmarks point it elsewhere): close what is idle and
+        # let connections still lent out be closed when they come back.
+        for con in self._idle:
+            con.close()
+        self._idle = []
+        self._open = 0
+
+    def in_use(self):
+        with self._cond:
+            return self._open - len(self._idle)
+
+db_pool = _DbPool()
+metrics.gauge("db.pool_open", lambda: db_pool._open)
+metrics.gauge("db.pool_in_use", db_pool.in_use)
+
+def _db_connect():
+    return db_pool.acquire()
+
+class _DbWriter:
+    """Every write to the database goes through here. With db_group_commit on, a single
+    thread applies queued writes in shared transactions: everything that arrives within
+    commit_ms is covered by one COMMIT and one sync. With it off (the default), each
+    write commits on its own on the caller's thread, which is faster when commits
+    don't wait for the disk (WAL with synchronous=NORMAL)."""
+    BATCH_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._thread = None
+        # SQLite takes one writer at a time; waiting here is cheaper and fairer than
+        # every thread polling for the database lock.
+        self._write_lock = threading.Lock()
+
+    def submit(self, sql, params=()):
+        """Queue a write. The returned Future resolves to its rowcount once committed."""
+        future = Future()
+        self._apply((sql, params, future))
+        return future
+
+    def execute(self, sql, params=()):
+        return self.submit(sql, params).result()
+
+    def transaction(self, statements):
+        """Apply (sql, params) pairs all or nothing; returns their rowcounts."""
+        future = Future()
+        self._apply((list(statements), None, future))
+        return future.result()
+
+    def post(self, sql, params=()):
+        """A write nobody waits for; failures are only logged."""
+        self._apply((sql, params, None))
+
+    def _apply(self, item):
+        if not db_config['group_commit']:
+            con = _db_connect()
+            try:
+                with self._write_lock:
+                    self._commit(con, [item])
+            finally:
+                con.close()
+            return
+        with self._cond:
+            self._queue.append(item)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        try:
+            self._loop()
+        finally:
+            # Only reached if the loop itself died: the next write starts a new thread.
+            with self._cond:
+                self._thread = None
+                if self._queue:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+
+    def _loop(self):
+        con, path = None, None
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                # Let concurrent writers join this transaction for up to commit_ms, but
+                # stop as soon as a millisecond passes with nothing new arriving.
+                deadline = time.monotonic() + db_config['commit_ms'] / 1000.0
+                while len(self._queue) < db_config['commit_max']:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._cond.wait(min(remaining, 0.001)):
+                        break
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), db_config['commit_max']))]
+            try:
+                if path != DB:
+                    if con is not None:
+                        con.close()
+                    con, path = None, None
+                    con = _db_open()
+                    con.isolation_level = None
+                    path = DB
+                self._commit(con, batch)
+            except Exception as e:
+                # Nothing that goes wrong with one batch may leave its writers waiting
+                # forever; start over with a fresh connection.
+                print(f"Database writer error: {e}")
+                self._resolve(batch, [(future, None, e) for _, _, future in batch])
+                path = None
+
+    @staticmethod
+    def _step(con, sql, params):
+        # Step to the end: PRAGMA incremental_vacuum frees one page per row.
+        cur = con.execute(sql, params)
+        cur.fetchall()
+        return cur.rowcount
+
+    def _commit(self, con, batch):
+        started = time.perf_counter()
+        results = []
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            for sql, params, future in batch:
+                try:
+                    if params is None:
+                        con.execute("SAVEPOINT item")
+                        try:
+                            value = [self._step(con, s, p) for s, p in sql]
+                        except Exception:
+                            if con.in_transaction:
+                                con.execute("ROLLBACK TO item")
+                                con.execute("RELEASE item")
+                            raise
+                        con.execute("RELEASE item")
+                    else:
+                        value = self._step(con, sql, params)
+                    results.append((future, value, None))
+                except Exception as e:
+                    # A failed statement only undoes itself unless SQLite gave up on the transaction.
+                    if not con.in_transaction:
+                        raise
+                    results.append((future, None, e))
+            con.execute("COMMIT")
+        except Exception as e:
+            if con.in_transaction:
+                try: con.execute("ROLLBACK")
+                except sqlite3.Error: pass
+            results = [(future, None, e) for _, _, future in batch]
+        metrics.observe("db.commit_ms", (time.perf_counter() - started) * 1000.0)
+        metrics.observe("db.batch_size", len(batch), buckets=self.BATCH_BUCKETS)
+        metrics.incr("db.writes", len(batch))
+        self._resolve(batch, results)
+
+    @staticmethod
+    def _resolve(batch, results):
+        for (sql, params, _), (future, value, error) in zip(batch, results):
+            if error is not None:
+                metrics.incr("db.write_errors")
+                if future is None:
+                    first = sql[0][0] if params is None else sql
+                    print(f"Database write failed ({error}): {first.strip().splitlines()[0]}")
+                elif not future.done():
+                    future.set_exception(error)
+            elif future is not None and not future.done():
+                future.set_result(value)
+
+db_writer = _DbWriter()
+
 def _group_policy_defaults():
     return {k: GROUP_POLICY_SCHEMA[k][1] for k in GROUP_POLICY_SCHEMA}
 
@@ -100,63 +479,129 @@ def _normalize_group_name(group_name):
     g = str(group_name or "").strip()
     return g if g else "__global__"
 
+def _parse_group_policy_json(raw):
+    """The keys a stored policy_json sets, coerced; unknown or bad values are dropped."""
+    try:
+        parsed = json.loads(str(raw or ""))
+    except ValueError:
+        return {}
+    if not isinstance(parsed, dict):
+        return {}
+    out = {}
+    for key, val in parsed.items():
+        if key in GROUP_POLICY_SCHEMA:
+            try:
+                out[key] = _coerce_group_policy_value(key, val)
+            except Exception:
+                pass
+    return out
+
+class _GroupPolicyStore:
+    """group_policies parsed into memory. Each row is kept as the keys it sets; the
+    effective policy of a group is the global policy with the group's keys laid over it.
+
+    Every change rebuilds the maps and swaps them in whole and bumps version, so reads
+    take no lock and return shared dicts that callers must not modify. A reload that
+    finds the same rows changes nothing.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._lock = threading.Lock()
+        self._state = None
+
+    def policy(self, scope, group_name):
+        state = self._state or self.reload()
+        return state["policies"].get((scope, group_name), state["defaults"])
+
+    def effective(self, group_name):
+        state = self._state or self.reload()
+        return state["effective"].get(group_name, state["global"])
+
+    def reload(self):
+        rows = self._read_rows()
+        if rows is None:
+            return self._build({})
+        with self._lock:
+            # Reloads follow every change another worker makes and every DB switch;
+            # when the rows read back are the ones already held, readers keep the same
+            # version and don't recompute anything.
+            if self._state is not None and self._state["rows"] == rows:
+                return self._state
+            self._state = self._build(rows)
+            self.version += 1
+            return self._state
+
+    def update(self, scope, group_name, updates, updated_by):
+        with self._lock:
+            state = self._state or self._build(self._read_rows() or {})
+            row = dict(state["rows"].get((scope, group_name), {}))
+            for key, raw in updates.items():
+                if key not in GROUP_POLICY_SCHEMA:
+                    raise ValueError(f"Unknown policy key: {key}")
+                row[key] = _coerce_group_policy_value(key, raw)
+            if scope == "global":
+                row = dict(_group_policy_defaults(), **row)
+            db_writer.execute(
+                """
+                INSERT OR REPLACE INTO group_policies(scope, group_name, policy_json, updated_by, updated_at)
+                VALUES(?,?,?,?,?)
+                """,
+                (scope, group_name, json.dumps(row, ensure_ascii=False), str(updated_by or "admin"), datetime.datetime.utcnow().isoformat()),
+            )
+            self._replace_row(state, (scope, group_name), row)
+            return self._state["policies"][(scope, group_name)]
+
+    def reset(self, scope, group_name):
+        with self._lock:
+            state = self._state or self._build(self._read_rows() or {})
+            db_writer.execute("DELETE FROM group_policies WHERE scope=? AND group_name=?", (scope, group_name))
+            self._replace_row(state, (scope, group_name), None)
+
+    def _replace_row(self, state, key, row):
+        rows = dict(state["rows"])
+        if row is None:
+            rows.pop(key, None)
+        else:
+            rows[key] = row
+        self._state = self._build(rows)
+        self.version += 1
+        _bus_publish({"t": "state", "kind": "group_policy"})
+
+    @staticmethod
+    def _read_rows():
+        try:
+            con = _db_connect()
+            rows = con.execute("SELECT scope, group_name, policy_json FROM group_policies").fetchall()
+            con.close()
+        except sqlite3.Error as e:
+            print(f"Could not load group policies: {e}")
+            return None
+        return {(scope, g): _parse_group_policy_json(raw) for scope, g, raw in rows}
+
+    @staticmethod
+    def _build(rows):
+        defaults = _group_policy_defaults()
+        policies = {key: dict(defaults, **row) for key, row in rows.items()}
+        glob = policies.get(("global", "__global__"), defaults)
+        effective = {g: dict(glob, **row) for (scope, g), row in rows.items() if scope == "group"}
+        return {"rows": rows, "defaults": defaults, "policies": policies, "global": glob, "effective": effective}
+
+group_policy_store = _GroupPolicyStore()
+
 def _fetch_group_policy(scope="global", group_name=None):
     scope = "group" if str(scope).lower() == "group" else "global"
-    group_name = _normalize_group_name(group_name)
-    defaults = _group_policy_defaults()
-    try:
-        con = sqlite3.connect(DB)
-        row = con.execute(
-            "SELECT policy_json FROM group_policies WHERE scope=? AND group_name=?",
-            (scope, group_name),
-        ).fetchone()
-        con.close()
-        if not row or not row[0]:
-            return defaults
-        parsed = json.loads(str(row[0]))
-        if not isinstance(parsed, dict):
-            return defaults
-        out = defaults.copy()
-        for key, val in parsed.items():
-            if key in GROUP_POLICY_SCHEMA:
-                try:
-                    out[key] = _coerce_group_policy_value(key, val)
-                except Exception:
-                    pass
-        return out
-    except Exception:
-        return defaults
+    return group_policy_store.policy(scope, _normalize_group_name(group_name))
 
 def _upsert_group_policy(scope="global", group_name=None, updates=None, updated_by="admin"):
     scope = "group" if str(scope).lower() == "group" else "global"
     group_name = _normalize_group_name(group_name)
-    updates = updates or {}
-    current = _fetch_group_policy(scope, group_name)
-    merged = current.copy()
-    for key, raw in updates.items():
-        if key not in GROUP_POLICY_SCHEMA:
-            raise ValueError(f"Unknown policy key: {key}")
-        merged[key] = _coerce_group_policy_value(key, raw)
-    payload = json.dumps(merged, ensure_ascii=False)
-    con = sqlite3.connect(DB)
-    con.execute(
-        """
-        INSERT OR REPLACE INTO group_policies(scope, group_name, policy_json, updated_by, updated_at)
-        VALUES(?,?,?,?,?)
-        """,
-        (scope, group_name, payload, str(updated_by or "admin"), datetime.datetime.utcnow().isoformat()),
-    )
-    con.commit()
-    con.close()
-    return merged
+    return group_policy_store.update(scope, group_name, updates or {}, updated_by)
 
 def _reset_group_policy(scope="global", group_name=None):
     scope = "group" if str(scope).lower() == "group" else "global"
     group_name = _normalize_group_name(group_name)
-    con = sqlite3.connect(DB)
-    con.execute("DELETE FROM group_policies WHERE scope=? AND group_name=?", (scope, group_name))
-    con.commit()
-    con.close()
+    group_policy_store.reset(scope, group_name)
 
 def _policy_schema_payload():
     return {
@@ -179,7 +624,9 @@ def _is_valid_feature_scope(scope):
     return str(scope or "").strip().lower() in ("all", "admin", "allowlist")
 
 def _seed_feature_defaults():
-    con = sqlite3.connect(DB)
+    # Like init_db, runs once at startup before anything is served, so it writes
+    # directly instead of going through db_writer.
+    con = _db_connect()
     for key, meta in FEATURE_DEFAULTS.items():
         row = con.execute("SELECT 1 FROM feature_policies WHERE feature_key=?", (key,)).fetchone()
         if row:
@@ -202,98 +649,221 @@ def _seed_feature_defaults():
     con.commit()
     con.close()
 
+FEATURE_BITS = {fk: 1 << i for i, fk in enumerate(sorted(FEATURE_DEFAULTS))}
+FEATURE_BIT_KEYS = {bit: fk for fk, bit in FEATURE_BITS.items()}
+
+class _FeatureCaps:
+    """Feature policies compiled into one FEATURE_BITS mask per user.
+
+    The policy, allowlist and access group tables and the admin list are read into a
+    snapshot once, and masks are worked out then: one for every user the snapshot
+    names (admins, allowlisted users, access group members) and one shared default for
+    everybody else. A snapshot is never written to after it is built.
+    invalidate() throws the snapshot away; the admin registry calls it whenever the
+    admin set changes. A snapshot's version is a digest of its contents, so every
+    worker gives the same state the same number; the last few snapshots are kept so
+    a client's caps can be diffed against the version it already has.
+    """
+    HISTORY = 8
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._history = collections.OrderedDict()
+
+    @property
+    def version(self):
+        return self._current()["version"]
+
+    def invalidate(self, publish=True):
+        with self._lock:
+            self._snapshot = None
+        if publish:
+            _bus_publish({"t": "state", "kind": "feature_caps"})
+
+    def policy(self, feature_key):
+        return self._current()["policies"].get(feature_key)
+
+    def mask(self, username):
+        return self._mask(self._current(), username)
+
+    def caps(self, username):
+        """(version, caps) for one user, in the feature_caps frame layout."""
+        snap = self._current()
+        return snap["version"], self._caps(snap, username, FEATURE_BITS.values())
+
+    def delta(self, base_version, username):
+        """(version, caps) holding only the features whose caps differ from what the
+        user had at base_version, or None if that snapshot is no longer kept."""
+        snap = self._current()
+        base = snap if base_version == snap["version"] else self._history.get(base_version)
+        if base is None:
+            return None
+        if base is snap:
+            return snap["version"], {}
+        changed = self._mask(base, username) ^ self._mask(snap, username)
+        for fk, bit in FEATURE_BITS.items():
+            old, new = base["policies"][fk], snap["policies"][fk]
+            if (old["enabled"], old["ui_visible"], old["scope"]) != (new["enabled"], new["ui_visible"], new["scope"]):
+                changed |= bit
+        return snap["version"], self._caps(snap, username, [b for b in FEATURE_BITS.values() if changed & b])
+
+    def _caps(self, snap, username, bits):
+        m = self._mask(snap, username)
+        out = {}
+        for bit in bits:
+            fk = FEATURE_BIT_KEYS[bit]
+            p = snap["policies"][fk]
+            out[fk] = {"enabled": p["enabled"], "ui_visible": p["ui_visible"], "scope": p["scope"], "can_use": bool(m & bit)}
+        return out
+
+    @staticmethod
+    def _mask(snap, username):
+        return snap["masks"].get(username, snap["default_mask"])
+
+    def _current(self):
+        admins = admin_registry.get()  # notices admins.txt edits, which invalidate us
+        snap = self._snapshot
+        if snap is None:
+            with self._lock:
+                if self._snapshot is None:
+                    loaded = self._load(admins)
+                    # An unchanged state keeps its old snapshot and the masks built on it.
+                    self._snapshot = self._history.get(loaded["version"], loaded)
+                    self._history[loaded["version"]] = self._snapshot
+                    self._history.move_to_end(loaded["version"])
+                    while len(self._history) > self.HISTORY:
+                        self._history.popitem(last=False)
+                snap = self._snapshot
+        return snap
+
+    def _load(self, admins):
+        con = _db_connect()
+        rows = {r[0]: r[1:] for r in con.execute("SELECT feature_key, enabled, ui_visible, scope, description FROM feature_policies")}
+        allow_users, allow_groups, member_of = {}, {}, {}
+        for fk, uname in con.execute("SELECT feature_key, username FROM feature_allow_users"):
+            allow_users.setdefault(fk, set()).add(uname)
+        for fk, gname in con.execute("SELECT feature_key, group_name FROM feature_allow_groups"):
+            allow_groups.setdefault(fk, set()).add(gname)
+        for gname, uname in con.execute("SELECT group_name, username FROM user_access_groups"):
+            member_of.setdefault(uname, set()).add(gname)
+        con.close()
+        policies = {}
+        for fk, meta in FEATURE_DEFAULTS.items():
+            row = rows.get(fk)
+            if not row:
+                policies[fk] = {
+                    "feature_key": fk,
+                    "enabled": bool(meta.get("enabled", True)),
+                    "ui_visible": bool(meta.get("ui_visible", True)),
+                    "scope": str(meta.get("scope", "all")),
+                    "description": str(meta.get("description", "")),
+                }
+            else:
+                policies[fk] = {
+                    "feature_key": fk,
+                    "enabled": bool(int(row[0] or 0)),
+                    "ui_visible": bool(int(row[1] or 0)),
+                    "scope": str(row[2] or "all"),
+                    "description": str(row[3] or ""),
+                }
+        digest = hashlib.blake2b(digest_size=6)
+        digest.update(json.dumps([
+            policies,
+            {fk: sorted(v) for fk, v in allow_users.items()},
+            {fk: sorted(v) for fk, v in allow_groups.items()},
+            {u: sorted(v) for u, v in member_of.items()},
+            sorted(admins),
+        ], sort_keys=True).encode())
+        metrics.incr("feature_caps.rebuilds")
+        snap = {
+            "version": int.from_bytes(digest.digest(), "big"),
+            "policies": policies,
+            "allow_users": allow_users,
+            "allow_groups": allow_groups,
+            "member_of": member_of,
+            "admins": admins,
+        }
+        named = set(admins).union(member_of, *allow_users.values())
+        snap["masks"] = {u: self._compile(snap, u) for u in named}
+        snap["default_mask"] = self._compile(snap, None)
+        return snap
+
+    def _compile(self, snap, username):
+        is_admin = username in snap["admins"]
+        groups = snap["member_of"].get(username, ())
+        mask = 0
+        for fk, bit in FEATURE_BITS.items():
+            policy = snap["policies"][fk]
+            if not policy["enabled"]:
+                continue
+            scope = policy["scope"].lower()
+            if scope == "all":
+                mask |= bit
+            elif scope == "admin":
+                if is_admin:
+                    mask |= bit
+            elif scope == "allowlist":
+                if (is_admin or username in snap["allow_users"].get(fk, ())
+                        or not snap["allow_groups"].get(fk, set()).isdisjoint(groups)):
+                    mask |= bit
+        return mask
+
+feature_caps = _FeatureCaps()
+
 def _feature_policy_row(feature_key):
     fk = str(feature_key or "").strip()
     if fk not in FEATURE_DEFAULTS:
         return None
-    con = sqlite3.connect(DB)
-    row = con.execute(
-        "SELECT enabled, ui_visible, scope, description FROM feature_policies WHERE feature_key=?",
-        (fk,),
-    ).fetchone()
-    con.close()
-    if not row:
-        meta = FEATURE_DEFAULTS[fk]
-        return {
-            "feature_key": fk,
-            "enabled": bool(meta.get("enabled", True)),
-            "ui_visible": bool(meta.get("ui_visible", True)),
-            "scope": str(meta.get("scope", "all")),
-            "description": str(meta.get("description", "")),
-        }
-    return {
-        "feature_key": fk,
-        "enabled": bool(int(row[0] or 0)),
-        "ui_visible": bool(int(row[1] or 0)),
-        "scope": str(row[2] or "all"),
-        "description": str(row[3] or ""),
-    }
-
-def _feature_user_allowed(feature_key, username):
-    con = sqlite3.connect(DB)
-    row = con.execute(
-        "SELECT 1 FROM feature_allow_users WHERE feature_key=? AND username=?",
-        (feature_key, username),
-    ).fetchone()
-    con.close()
-    return bool(row)
-
-def _feature_group_allowed(feature_key, username):
-    con = sqlite3.connect(DB)
-    groups = [r[0] for r in con.execute("SELECT group_name FROM user_access_groups WHERE username=?", (username,)).fetchall()]
-    if not groups:
-        con.close()
-        return False
-    placeholders = ",".join(["?"] * len(groups))
-    params = [feature_key] + groups
-    row = con.execute(
-        f"SELECT 1 FROM feature_allow_groups WHERE feature_key=? AND group_name IN ({placeholders}) LIMIT 1",
-        params,
-    ).fetchone()
-    con.close()
-    return bool(row)
+    return dict(feature_caps.policy(fk))
 
 def _can_user_use_feature(username, feature_key):
-    policy = _feature_policy_row(feature_key)
-    if not policy:
-        return False
-    if not policy.get("enabled", False):
-        return False
-    scope = str(policy.get("scope", "all")).lower()
-    is_admin = username in get_admins()
-    if scope == "all":
-        return True
-    if scope == "admin":
-        return is_admin
-    if scope == "allowlist":
-        if is_admin:
-            return True
-        return _feature_user_allowed(feature_key, username) or _feature_group_allowed(feature_key, username)
-    return False
+    return bool(feature_caps.mask(username) & FEATURE_BITS.get(feature_key, 0))
 
 def _feature_caps_for_user(username):
-    caps = {}
-    for fk in sorted(FEATURE_DEFAULTS.keys()):
-        p = _feature_policy_row(fk) or {}
-        caps[fk] = {
-            "enabled": bool(p.get("enabled", False)),
-            "ui_visible": bool(p.get("ui_visible", False)),
-            "scope": str(p.get("scope", "all")),
-            "can_use": bool(_can_user_use_feature(username, fk)),
-        }
-    return caps
+    return feature_caps.caps(username)[1]
+
+def _send_feature_caps(sock, username, since=None):
+    """Send a user's caps: only what changed since the given version when the client
+    negotiated caps_delta and that version is still known, otherwise all of them."""
+    found = feature_caps.delta(since, username) if since is not None and sock.caps.get("caps_delta") else None
+    if found is not None:
+        version, caps = found
+        frame = {"action": "feature_caps_delta", "version": version, "caps": caps}
+    else:
+        version, caps = feature_caps.caps(username)
+        frame = {"action": "feature_caps", "version": version, "caps": caps}
+    sock.feature_caps_version = version
+    try:
+        sock.send(frame)
+    except Exception:
+        pass
 
-def _send_feature_caps(sock, username):
+def _push_feature_caps_changes(sock, username):
+    # Caps changed: tell this session about its features that differ from what it was last sent.
+    found = feature_caps.delta(sock.feature_caps_version, username)
+    if found is None:
+        _send_feature_caps(sock, username)
+        return
+    version, caps = found
+    sock.feature_caps_version = version
+    if not caps:
+        return
+    metrics.incr("feature_caps.pushes")
     try:
-        sock.sendall((json.dumps({"action": "feature_caps", "caps": _feature_caps_for_user(username)}) + "\n").encode())
+        if sock.caps.get("caps_delta"):
+            sock.send({"action": "feature_caps_delta", "version": version, "caps": caps})
+        else:
+            sock.send({"action": "feature_caps", "version": version, "caps": feature_caps.caps(username)[1]})
     except Exception:
         pass
 
 def _broadcast_feature_caps():
+    # Each worker pushes to its own sessions; the others hear about the change on the bus.
     with lock:
-        targets = list(clients.items())
+        targets = [(u, s) for u, s in clients.items() if isinstance(s, ClientSession)]
     for uname, sock in targets:
-        _send_feature_caps(sock, uname)
+        _push_feature_caps_changes(sock, uname)
 
 def _group_call_broadcast(group_name, payload, exclude=None):
     targets = []
@@ -306,12 +876,7 @@ def _group_call_broadcast(group_name, payload, exclude=None):
             s = clients.get(uname)
             if s:
                 targets.append(s)
-    wire = (json.dumps(payload) + "\n").encode()
-    for s in targets:
-        try:
-            s.sendall(wire)
-        except Exception:
-            pass
+    _broadcast_frame(targets, payload)
 
 def _remove_user_from_all_group_calls(username):
     events = []
@@ -431,7 +996,7 @@ def _get_admin_bot_rules(owner, bot_name):
     if not owner or not bot_name:
         return ""
     try:
-        con = sqlite3.connect(DB)
+        con = _db_connect()
         row = con.execute(
             "SELECT rules FROM bot_rule_overrides WHERE owner=? AND bot=?",
             (owner, bot_name),
@@ -448,16 +1013,13 @@ def _set_admin_bot_rules(owner, bot_name, rules):
     if not owner or not bot_name:
         return False
     try:
-        con = sqlite3.connect(DB)
-        con.execute(
+        db_writer.execute(
             """
             INSERT OR REPLACE INTO bot_rule_overrides(owner, bot, rules, updated_at)
             VALUES(?,?,?,?)
             """,
             (owner, bot_name, rules, datetime.datetime.utcnow().isoformat()),
         )
-        con.commit()
-        con.close()
         return True
     except Exception:
         return False
@@ -468,10 +1030,7 @@ def _clear_admin_bot_rules(owner, bot_name):
     if not owner or not bot_name:
         return False
     try:
-        con = sqlite3.connect(DB)
-        con.execute("DELETE FROM bot_rule_overrides WHERE owner=? AND bot=?", (owner, bot_name))
-        con.commit()
-        con.close()
+        db_writer.execute("DELETE FROM bot_rule_overrides WHERE owner=? AND bot=?", (owner, bot_name))
         return True
     except Exception:
         return False
@@ -603,7 +1162,7 @@ def _maybe_send_bot_reply(sender_sock, sender_user, to_user, text):
     if tts_payload:
         payload.update(tts_payload)
     try:
-        sender_sock.sendall((json.dumps(payload) + "\n").encode())
+        sender_sock.send(payload)
     except Exception:
         pass
     return True
@@ -763,6 +1322,10 @@ def _synthesize_bot_tts(bot_name, text):
 def _schedule_restart(delay_seconds, requested_by="admin"):
     global restart_scheduled_for
     delay_seconds = max(1, int(delay_seconds))
+    if worker_id:
+        # Workers hand restarts to the cluster parent, which restarts everything.
+        _bus_publish({"t": "control", "op": "restart", "seconds": delay_seconds, "by": requested_by})
+        return
     with restart_lock:
         restart_scheduled_for = time.time() + delay_seconds
 
@@ -773,27 +1336,21 @@ def _schedule_restart(delay_seconds, requested_by="admin"):
         time.sleep(delay_seconds)
         with restart_lock:
             restart_scheduled_for = None
-        os.execv(sys.executable, [sys.executable] + sys.argv)
+        _restart_process()
 
     threading.Thread(target=_worker, daemon=True).start()
 
 def _upsert_bot_token(owner, bot_name):
     token = secrets.token_urlsafe(24)
     created = datetime.datetime.utcnow().isoformat()
-    con = sqlite3.connect(DB)
-    con.execute(
+    db_writer.execute(
         "INSERT OR REPLACE INTO bot_tokens(owner, bot, token, created_at) VALUES(?,?,?,?)",
         (owner, bot_name, token, created),
     )
-    con.commit()
-    con.close()
     return token
 
 def _revoke_bot_token(owner, bot_name):
-    con = sqlite3.connect(DB)
-    con.execute("DELETE FROM bot_tokens WHERE owner=? AND bot=?", (owner, bot_name))
-    con.commit()
-    con.close()
+    db_writer.post("DELETE FROM bot_tokens WHERE owner=? AND bot=?", (owner, bot_name))
 
 class EmailManager:
     @staticmethod
@@ -851,44 +1408,129 @@ class FlexPBXManager:
         except Exception as e:
             return False, str(e)
 
-def get_admins():
+ADMIN_RECHECK_SECS = 1.0
+
+def _admin_file_stamp():
+    try:
+        st = os.stat(ADMIN_FILE)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _read_admin_file():
     try:
         with open(ADMIN_FILE, 'r') as f: return {line.strip() for line in f if line.strip()}
     except FileNotFoundError: return set()
 
+class _AdminRegistry:
+    """The admin set, kept in memory as a frozenset that is replaced whole on change.
+
+    With admin_store=file it comes from admins.txt and is reloaded when the file's
+    inode, mtime or size changes (looked at no more than once a second). With
+    admin_store=db it comes from the admins table. add_admin/remove_admin write
+    through and tell the other workers to reload.
+    """
+
+    def __init__(self):
+        self.store = "file"
+        self.version = 0
+        self._admins = frozenset()
+        self._stamp = None
+        self._stale = True
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._stale:
+            self.reload()
+        elif self.store == "file":
+            now = time.monotonic()
+            if now - self._checked >= ADMIN_RECHECK_SECS:
+                self._checked = now
+                if _admin_file_stamp() != self._stamp:
+                    self.reload()
+        return self._admins
+
+    def reload(self):
+        with self._lock:
+            changed = self._load()
+        if changed:
+            feature_caps.invalidate(publish=False)
+
+    def set_admin(self, username, is_admin):
+        """Add or remove one admin. Returns False if nothing changed."""
+        with self._lock:
+            self._load()
+            if (username in self._admins) == is_admin:
+                return False
+            admins = set(self._admins)
+            if is_admin:
+                admins.add(username)
+            else:
+                admins.discard(username)
+            if self.store == "db":
+                if is_admin:
+                    db_writer.execute("INSERT OR IGNORE INTO admins(username) VALUES(?)", (username,))
+                else:
+                    db_writer.execute("DELETE FROM admins WHERE username=?", (username,))
+            else:
+                # Write a new file and rename it over the old one so readers never see half a list.
+                tmp = ADMIN_FILE + ".tmp"
+                with open(tmp, 'w') as f:
+                    for admin in sorted(admins): f.write(admin + '\n')
+                os.replace(tmp, ADMIN_FILE)
+                self._stamp = _admin_file_stamp()
+            self._admins = frozenset(admins)
+            self.version += 1
+        feature_caps.invalidate(publish=False)
+        _bus_publish({"t": "state", "kind": "admins"})
+        return True
+
+    def _load(self):
+        # Stat before reading so an edit racing the read is caught by the next check.
+        self._stamp = _admin_file_stamp() if self.store == "file" else None
+        self._checked = time.monotonic()
+        if self.store == "db":
+            con = _db_connect()
+            admins = frozenset(r[0] for r in con.execute("SELECT username FROM admins"))
+            con.close()
+        else:
+            admins = frozenset(_read_admin_file())
+        self._stale = False
+        if admins == self._admins:
+            return False
+        self._admins = admins
+        self.version += 1
+        return True
+
+admin_registry = _AdminRegistry()
+
+def get_admins():
+    return admin_registry.get()
+
 def broadcast_admin_status_change(username, is_admin):
     print(f"Broadcasting admin status change for {username}: {is_admin}")
-    msg = json.dumps({"action": "admin_status_change", "user": username, "is_admin": is_admin}) + "\n"
     with lock:
-        for sock in list(clients.values()):
-            try: sock.sendall(msg.encode())
-            except: pass
+        targets = list(clients.values())
+    _broadcast_frame(targets, {"action": "admin_status_change", "user": username, "is_admin": is_admin})
 
 def add_admin(username):
-    admins = get_admins()
-    if username in admins: return
-    admins.add(username)
-    with open(ADMIN_FILE, 'w') as f:
-        for admin in sorted(list(admins)): f.write(admin + '\n')
+    if not admin_registry.set_admin(username, True): return
     print(f"User '{username}' added to admin list.")
+    _broadcast_feature_caps()
     broadcast_admin_status_change(username, True)
 
 def remove_admin(username):
-    admins = get_admins()
-    if username not in admins: return
-    admins.discard(username)
-    with open(ADMIN_FILE, 'w') as f:
-        for admin in sorted(list(admins)): f.write(admin + '\n')
+    if not admin_registry.set_admin(username, False): return
     print(f"User '{username}' removed from admin list.")
+    _broadcast_feature_caps()
     broadcast_admin_status_change(username, False)
 
 def broadcast_alert(message):
     print(f"Broadcasting alert: {message}")
-    msg = json.dumps({"action": "server_alert", "message": message}) + "\n"
     with lock:
-        for sock in list(clients.values()):
-            try: sock.sendall(msg.encode())
-            except: pass
+        targets = list(clients.values())
+    _broadcast_frame(targets, {"action": "server_alert", "message": message})
 
 def _parse_duration(s):
     """Parse a duration string like '5m', '1h', '30m' into (seconds, human_readable).
@@ -985,15 +1627,135 @@ def load_config():
         'piper_default_voice': config.get('bots', 'piper_default_voice', fallback='en_US-lessac-medium'),
         'piper_timeout': config.getint('bots', 'piper_timeout', fallback=12),
     }
+    ClientSession.max_queue_bytes = max(64 * 1024, config.getint('server', 'outbound_queue_bytes', fallback=4 * 1024 * 1024))
+    ClientSession.write_timeout = max(1, config.getint('server', 'write_timeout', fallback=30))
+    global connection_config, protocol_config, db_config
+    db_config = {
+        'synchronous': config.get('server', 'db_synchronous', fallback='NORMAL').strip().upper(),
+        'cache_kb': max(256, config.getint('server', 'db_cache_kb', fallback=8192)),
+        'mmap_mb': max(0, config.getint('server', 'db_mmap_mb', fallback=64)),
+        'pool_size': max(1, config.getint('server', 'db_pool_size', fallback=16)),
+        'group_commit': config.getboolean('server', 'db_group_commit', fallback=False),
+        'commit_ms': max(0, config.getint('server', 'db_commit_ms', fallback=5)),
+        'commit_max': max(1, config.getint('server', 'db_commit_max', fallback=500)),
+    }
+    global offline_config
+    offline_config = {
+        'enabled': config.getboolean('server', 'offline_messages', fallback=True),
+        'max_messages': max(1, config.getint('server', 'offline_max_messages', fallback=500)),
+        'max_kb': max(1, config.getint('server', 'offline_max_kb', fallback=1024)),
+        'page_size': max(1, config.getint('server', 'offline_page_size', fallback=500)),
+    }
+    global history_config
+    history_config = {
+        'enabled': config.getboolean('server', 'history', fallback=False),
+        'page_max': max(1, config.getint('server', 'history_page_max', fallback=200)),
+    }
+    global retention_config
+    retention_config = {
+        'interval_minutes': max(0, config.getint('server', 'retention_interval_minutes', fallback=60)),
+        'batch': max(1, config.getint('server', 'retention_batch', fallback=100)),
+        'pause_ms': max(0, config.getint('server', 'retention_pause_ms', fallback=50)),
+        'offline_days': max(0, config.getint('server', 'retention_offline_days', fallback=0)),
+    }
+    if db_config['synchronous'] not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+        print(f"WARNING: Unknown db_synchronous '{db_config['synchronous']}', using NORMAL.")
+        db_config['synchronous'] = "NORMAL"
+    protocol_config = {
+        'binary_framing': config.getboolean('server', 'binary_framing', fallback=True),
+        'compression_level': min(9, max(0, config.getint('server', 'compression_level', fallback=6))),
+        'event_batch_ms': max(0, config.getint('server', 'event_batch_ms', fallback=50)),
+        'event_batch_max': max(1, config.getint('server', 'event_batch_max', fallback=100)),
+        'heartbeat_interval': max(0, config.getint('server', 'heartbeat_interval', fallback=30)),
+        'heartbeat_misses': max(1, config.getint('server', 'heartbeat_misses', fallback=3)),
+    }
+    ClientSession.batch_interval = max(1, protocol_config['event_batch_ms']) / 1000.0
+    ClientSession.batch_max = protocol_config['event_batch_max']
+    if protocol_config['binary_framing'] and msgpack is None:
+        print("Note: msgpack is not installed; clients will use JSON lines.")
+    connection_config = {
+        'max_connections': max(0, config.getint('server', 'max_connections', fallback=10000)),
+        'handshake_timeout': max(1.0, config.getfloat('server', 'handshake_timeout', fallback=10.0)),
+    }
+    block_cache.max_entries = max(1000, config.getint('server', 'block_cache_entries', fallback=200000))
+    admin_store = config.get('server', 'admin_store', fallback='file').strip().lower()
+    if admin_store not in ("file", "db"):
+        print(f"WARNING: Unknown admin_store '{admin_store}', using file.")
+        admin_store = "file"
+    admin_registry.store = admin_store
+    admin_registry._stale = True
+    global login_limiters
+    buckets_max = max(1000, config.getint('server', 'login_buckets_max', fallback=100000))
+    login_limiters = {
+        'ip': _TokenBuckets(config.getint('server', 'login_ip_burst', fallback=50),
+                            config.getfloat('server', 'login_ip_per_minute', fallback=60.0), buckets_max),
+        'user': _TokenBuckets(config.getint('server', 'login_user_burst', fallback=5),
+                              config.getfloat('server', 'login_user_per_minute', fallback=5.0), buckets_max),
+        'resume': _TokenBuckets(config.getint('server', 'login_resume_burst', fallback=200),
+                                config.getfloat('server', 'login_resume_per_minute', fallback=600.0), buckets_max),
+    }
+    global password_config, _ph
+    password_config = {
+        'workers': max(1, config.getint('server', 'password_workers', fallback=os.cpu_count() or 2)),
+        'queue': max(0, config.getint('server', 'password_queue', fallback=64)),
+    }
+    global rate_limit_config
+    rate_limit_config = {
+        'enabled': config.getboolean('server', 'rate_limits', fallback=False),
+        'msg_burst': max(1, config.getint('server', 'rate_msg_burst', fallback=20)),
+        'typing_per_minute': max(1, config.getint('server', 'rate_typing_per_minute', fallback=60)),
+        'typing_burst': max(1, config.getint('server', 'rate_typing_burst', fallback=10)),
+        'signal_per_minute': max(1, config.getint('server', 'rate_signal_per_minute', fallback=1200)),
+        'signal_burst': max(1, config.getint('server', 'rate_signal_burst', fallback=200)),
+        'users_max': max(1000, config.getint('server', 'rate_limit_users_max', fallback=100000)),
+    }
+    action_limiter.reset()
+    global session_config
+    session_config = {
+        'token_hours': max(0, config.getint('server', 'session_token_hours', fallback=24)),
+        'key_file': config.get('server', 'session_key_file', fallback='session.key'),
+    }
+    defaults = PasswordHasher()
+    _ph = PasswordHasher(
+        time_cost=max(1, config.getint('server', 'argon2_time_cost', fallback=defaults.time_cost)),
+        memory_cost=max(8, config.getint('server', 'argon2_memory_kib', fallback=defaults.memory_cost)),
+        parallelism=max(1, config.getint('server', 'argon2_parallelism', fallback=defaults.parallelism)),
+    )
+    engine = config.get('server', 'engine', fallback='threaded').strip().lower()
+    if engine not in ("threaded", "asyncio"):
+        print(f"WARNING: Unknown serving engine '{engine}', falling back to threaded.")
+        engine = "threaded"
     return {
         'port': config.getint('server', 'port', fallback=2005),
         'certfile': config.get('server', 'certfile', fallback='server.crt'),
         'keyfile': config.get('server', 'keyfile', fallback='server.key'),
+        'engine': engine,
+        'executor_workers': max(1, config.getint('server', 'executor_workers', fallback=32)),
+        'auth_workers': max(1, config.getint('server', 'auth_workers', fallback=32)),
+        'bot_workers': max(1, config.getint('server', 'bot_workers', fallback=4)),
+        'listen_backlog': max(5, config.getint('server', 'listen_backlog', fallback=1024)),
+        'tls_session_tickets': max(0, config.getint('server', 'tls_session_tickets', fallback=2)),
+        'handshake_workers': max(1, config.getint('server', 'handshake_workers', fallback=16)),
+        'workers': max(1, config.getint('server', 'workers', fallback=1)),
     }
 
+_ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+def _norm_username(name):
+    # Must match SQLite's LOWER(), which users.username_norm is built from.
+    return str(name).translate(_ASCII_LOWER)
+
 def init_db():
-    conn = sqlite3.connect(DB)
+    # Schema setup and migrations run before anything is served, on one connection of
+    # their own rather than through db_writer.
+    conn = _db_connect()
     cur = conn.cursor()
+    if not cur.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+        # A new database: let retention hand freed pages back to the filesystem. WAL
+        # mode has already written the header, so the setting needs a VACUUM (instant
+        # while empty) to take effect.
+        cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cur.execute("VACUUM")
     # Check for columns and add if missing (Migration)
     cur.execute('''CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT, banned_until TEXT, ban_reason TEXT)''')
     
@@ -1005,6 +1767,21 @@ def init_db():
     if 'reset_code' not in existing_cols: cur.execute("ALTER TABLE users ADD COLUMN reset_code TEXT")
     if 'verification_code_at' not in existing_cols: cur.execute("ALTER TABLE users ADD COLUMN verification_code_at TEXT")
     if 'reset_code_at' not in existing_cols: cur.execute("ALTER TABLE users ADD COLUMN reset_code_at TEXT")
+    # username_norm is LOWER(username), the same ASCII-only folding as NOCASE, so
+    # case-insensitive lookups can use an index. The triggers keep it current for any writer.
+    if 'username_norm' not in existing_cols: cur.execute("ALTER TABLE users ADD COLUMN username_norm TEXT")
+    cur.execute("CREATE TRIGGER IF NOT EXISTS users_norm_insert AFTER INSERT ON users BEGIN UPDATE users SET username_norm=LOWER(NEW.username) WHERE rowid=NEW.rowid; END")
+    cur.execute("CREATE TRIGGER IF NOT EXISTS users_norm_update AFTER UPDATE OF username ON users BEGIN UPDATE users SET username_norm=LOWER(NEW.username) WHERE rowid=NEW.rowid; END")
+    try:
+        cur.execute("UPDATE users SET username_norm=LOWER(username) WHERE username_norm IS NULL")
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS users_username_norm ON users(username_norm)")
+        cur.execute("DROP INDEX IF EXISTS users_username_norm_dup")
+    except sqlite3.IntegrityError:
+        # Older databases can hold names differing only by case; login reports those as ambiguous.
+        cur.execute("UPDATE users SET username_norm=LOWER(username) WHERE username_norm IS NULL")
+        cur.execute("CREATE INDEX IF NOT EXISTS users_username_norm_dup ON users(username_norm)")
+        dupes = cur.execute("SELECT COUNT(*) FROM (SELECT 1 FROM users GROUP BY username_norm HAVING COUNT(*) > 1)").fetchone()[0]
+        print(f"WARNING: {dupes} usernames exist in more than one letter case; rename or delete them to enable the unique username index.")
 
     cur.execute('''CREATE TABLE IF NOT EXISTS contacts (owner TEXT, contact TEXT, blocked INTEGER DEFAULT 0, PRIMARY KEY(owner, contact))''')
     cur.execute('''CREATE TABLE IF NOT EXISTS bot_tokens (owner TEXT, bot TEXT, token TEXT, created_at TEXT, PRIMARY KEY(owner, bot))''')
@@ -1020,27 +1797,890 @@ def init_db():
     if 'file_type' not in fb_cols: cur.execute("ALTER TABLE file_bans ADD COLUMN file_type TEXT")
     if 'until_date' not in fb_cols: cur.execute("ALTER TABLE file_bans ADD COLUMN until_date TEXT")
     if 'reason' not in fb_cols: cur.execute("ALTER TABLE file_bans ADD COLUMN reason TEXT")
+    cur.execute('''CREATE TABLE IF NOT EXISTS admins (username TEXT PRIMARY KEY)''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS offline_messages (id INTEGER PRIMARY KEY AUTOINCREMENT, recipient TEXT NOT NULL, sender TEXT, sent_at TEXT, body TEXT, bytes INTEGER NOT NULL, stored_at INTEGER)''')
+    _add_stored_at(cur, "offline_messages")
+    cur.execute("CREATE INDEX IF NOT EXISTS offline_messages_recipient ON offline_messages(recipient)")
+    if not cur.execute("SELECT 1 FROM sqlite_master WHERE name='offline_mailboxes'").fetchone():
+        cur.execute("CREATE TABLE offline_mailboxes (recipient TEXT PRIMARY KEY, messages INTEGER NOT NULL, bytes INTEGER NOT NULL) WITHOUT ROWID")
+        cur.execute("INSERT INTO offline_mailboxes SELECT recipient, COUNT(*), SUM(bytes) FROM offline_messages GROUP BY recipient")
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS offline_mailboxes_insert AFTER INSERT ON offline_messages BEGIN
+        INSERT INTO offline_mailboxes(recipient, messages, bytes) VALUES (new.recipient, 1, new.bytes)
+        ON CONFLICT(recipient) DO UPDATE SET messages=messages+1, bytes=bytes+excluded.bytes; END''')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS offline_mailboxes_delete AFTER DELETE ON offline_messages BEGIN
+        UPDATE offline_mailboxes SET messages=messages-1, bytes=bytes-old.bytes WHERE recipient=old.recipient;
+        DELETE FROM offline_mailboxes WHERE recipient=old.recipient AND messages<=0; END''')
+    cur.execute('''CREATE TABLE IF NOT EXISTS session_tokens (digest TEXT PRIMARY KEY, username TEXT NOT NULL, expires_at INTEGER NOT NULL)''')
+    cur.execute("CREATE INDEX IF NOT EXISTS session_tokens_username ON session_tokens(username)")
+    cur.execute("DELETE FROM session_tokens WHERE expires_at <= ?", (int(time.time()),))
+    if history_config['enabled']:
+        try:
+            _init_history_tables(cur)
+        except sqlite3.OperationalError as e:
+            print(f"WARNING: Message history needs SQLite with FTS5 ({e}); history is off.")
+            history_config['enabled'] = False
+    if admin_registry.store == "db" and not cur.execute("SELECT 1 FROM admins LIMIT 1").fetchone():
+        # First start with admin_store=db: carry over whoever admins.txt lists.
+        cur.executemany("INSERT OR IGNORE INTO admins(username) VALUES(?)", [(a,) for a in sorted(_read_admin_file())])
     conn.commit()
     _seed_feature_defaults()
     conn.close()
 
+# Binary frames (negotiated at login): 1 byte of flags, 4 byte body length, msgpack body.
+FRAME_HEADER = struct.Struct("!BI")
+
+def _encode_frame(payload, codec="json"):
+    if codec == "msgpack":
+        body = msgpack.packb(payload, use_bin_type=True)
+        return FRAME_HEADER.pack(0, len(body)) + body
+    return (json.dumps(payload) + "\n").encode()
+
+def _max_frame_bytes():
+    # file_data frames carry base64 payloads, so leave headroom above the upload limit.
+    return max(64 * 1024 * 1024, file_config.get('size_limit', 0) * 2)
+
+def _decode_frame_body(flags, body):
+    if flags:
+        raise ValueError(f"Unsupported frame flags {flags:#x}")
+    return msgpack.unpackb(body, raw=False)
+
+def _read_frame(f, codec):
+    """Read one frame from a binary file object. Returns None at end of stream."""
+    if codec == "msgpack":
+        header = f.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            return None
+        flags, length = FRAME_HEADER.unpack(header)
+        if length > _max_frame_bytes():
+            raise ValueError(f"Frame of {length} bytes is over the limit")
+        body = f.read(length)
+        if len(body) < length:
+            return None
+        return _decode_frame_body(flags, body)
+    line = f.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+def _frames_for(payload):
+    """Encode a payload lazily, at most once per codec."""
+    cache = {}
+    def wire(codec):
+        if codec not in cache:
+            cache[codec] = _encode_frame(payload, codec)
+        return cache[codec]
+    return wire
+
+def _negotiate_caps(sock, req):
+    """Agree connection options with what the client offered in its login frame."""
+    offered = req.get("caps") or {}
+    agreed = {}
+    if protocol_config.get('binary_framing', True) and msgpack is not None and "msgpack" in (offered.get("framing") or []):
+        agreed["framing"] = "msgpack"
+    if protocol_config.get('compression_level', 0) > 0 and "zlib" in (offered.get("compression") or []):
+        agreed["compression"] = "zlib"
+    if protocol_config.get('event_batch_ms', 0) > 0 and offered.get("batching"):
+        agreed["batching"] = True
+    if protocol_config.get('heartbeat_interval', 0) > 0 and offered.get("heartbeat"):
+        agreed["heartbeat"] = {"interval": protocol_config['heartbeat_interval'], "misses": protocol_config['heartbeat_misses']}
+    if offline_config['enabled'] and offered.get("offline_ack"):
+        agreed["offline_ack"] = True
+    if session_config['token_hours'] > 0 and offered.get("resume"):
+        agreed["resume"] = True
+    if offered.get("caps_delta"):
+        agreed["caps_delta"] = True
+        # A reconnecting client says which feature caps version it already holds.
+        if isinstance(offered.get("caps_version"), int):
+            sock.feature_caps_version = offered["caps_version"]
+    sock.caps = agreed
+
+def _broadcast_frame(sessions, payload, event_key=None):
+    # Encode once per codec; each session only queues the shared bytes. Users on
+    # other workers get one bus message per worker. With an event_key, sessions that
+    # negotiated batching get the payload as a coalescable event instead.
+    wire = _frames_for(payload)
+    remote = {}
+    for s in sessions:
+        if isinstance(s, _RemoteSession):
+            remote.setdefault(s.worker, []).append(s.user)
+            continue
+        try:
+            if event_key is not None and s.batching:
+                s.send_event(payload, event_key)
+            else:
+                s.sendall(wire(s.codec))
+        except Exception: pass
+    header = {"t": "deliver"}
+    if event_key is not None:
+        header["event_key"] = event_key
+    for wid, users in remote.items():
+        _bus_publish(dict(header, worker=wid, users=users), wire("json"))
+
+class _EventBatcher:
+    """A single thread that flushes every session's pending events once per batch interval."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._thread = None
+
+    def schedule(self, session):
+        with self._lock:
+            self._pending.add(session)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(ClientSession.batch_interval)
+            with self._lock:
+                pending, self._pending = self._pending, set()
+            for session in pending:
+                try: session.flush_events()
+                except Exception: pass
+
+event_batcher = _EventBatcher()
+
+class _IdleReaper:
+    """A single sweeper that pings quiet heartbeat sessions and closes the ones that
+    stopped answering. Sessions without the heartbeat cap rely on TCP keepalive."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None and protocol_config.get('heartbeat_interval', 0) > 0:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        interval = protocol_config['heartbeat_interval']
+        misses = protocol_config['heartbeat_misses']
+        while True:
+            time.sleep(interval / 2.0)
+            now = time.monotonic()
+            with lock:
+                sessions = [s for s in clients.values() if isinstance(s, ClientSession) and s.caps.get("heartbeat")]
+            for session in sessions:
+                idle = now - session.last_seen
+                if idle >= interval * misses:
+                    print(f"Reaping idle session for {session.user} ({session.addr}): silent for {idle:.0f}s.")
+                    metrics.incr("sessions.reaped")
+                    try: session.abort()
+                    except Exception: pass
+                elif idle >= interval and now - session.last_ping >= interval:
+                    session.last_ping = now
+                    metrics.incr("heartbeat.pings_sent")
+                    try: session.send({"action": "ping"})
+                    except Exception: pass
+
+idle_reaper = _IdleReaper()
+
+def _set_keepalive(sock):
+    # Catches half-open connections from clients that predate the heartbeat cap.
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 15)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4)
+    except (OSError, AttributeError):
+        pass
+
+def _set_send_timeout(sock, seconds):
+    # SO_SNDTIMEO bounds a blocked write without also putting the reader's recv on a timeout.
+    try:
+        if sys.platform == "win32":
+            value = struct.pack("L", int(seconds * 1000))
+        else:
+            value = struct.pack("ll", int(seconds), 0)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+    except (OSError, AttributeError, struct.error):
+        pass
+
+class ClientSession(abc.ABC):
+    """A connected client and its bounded outbound queue.
+
+    send()/sendall() only append pre-encoded frames; a per-session writer drains the
+    queue, so a peer with a full TCP window stalls nobody but itself. A peer that lets
+    its queue grow past max_queue_bytes is disconnected.
+    """
+    max_queue_bytes = 4 * 1024 * 1024
+    write_timeout = 30
+    max_write_bytes = 256 * 1024
+    batch_interval = 0.05
+    batch_max = 100
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.user = None
+        self.codec = "json"
+        self.caps = {}
+        self.connected_at = time.time()
+        self.last_seen = time.monotonic()
+        self.last_ping = 0.0
+        self.feature_caps_version = None
+        self.offline_sent_upto = 0
+        self.offline_acked_upto = 0
+        self.offline_lock = threading.Lock()
+        self.resumed = False
+        self.resume_digest = None
+        self._lock = threading.Lock()
+        self._queue = collections.deque()
+        self._queued_bytes = 0
+        self._closing = False
+        self.high_water_bytes = 0
+        self.frames_queued = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.writes = 0
+        self._compressor = None
+        self._compress_from = 0
+        self._frames_taken = 0
+        self._events = None
+
+    @property
+    def batching(self):
+        return self._events is not None
+
+    @property
+    def closing(self):
+        """True once the server has started closing this connection."""
+        return self._closing
+
+    def send(self, payload):
+        self.sendall(_encode_frame(payload, self.codec))
+
+    def enable_batching(self):
+        self._events = collections.OrderedDict()
+
+    def send_event(self, payload, key=None):
+        """Hold a broadcast event for the next events frame. A newer event with the same
+        key replaces the pending one, so only the latest presence per user is sent."""
+        if self._events is None:
+            return self.send(payload)
+        with self._lock:
+            if self._closing:
+                raise BrokenPipeError("Session is closed.")
+            if key is None:
+                key = object()
+            elif key in self._events:
+                del self._events[key]
+                metrics.incr("events.coalesced")
+            self._events[key] = payload
+            pending = len(self._events)
+        metrics.incr("events.queued")
+        if pending >= self.batch_max:
+            self.flush_events()
+        elif pending == 1:
+            event_batcher.schedule(self)
+
+    def flush_events(self):
+        self._enqueue(None)
+
+    def sendall(self, data):
+        self._enqueue(data)
+
+    def _enqueue(self, data):
+        overflow = False
+        with self._lock:
+            if self._closing:
+                raise BrokenPipeError("Session is closed.")
+            frames = []
+            if self._events:
+                # Held events go out ahead of any direct frame, under the same lock, so
+                # a message never arrives before the event showing its sender online.
+                frames.append(_encode_frame({"action": "events", "events": list(self._events.values())}, self.codec))
+                self._events.clear()
+            if data is not None:
+                frames.append(data)
+            if not frames:
+                return
+            size = sum(len(f) for f in frames)
+            if self._queued_bytes + size > self.max_queue_bytes:
+                overflow = True
+            else:
+                self._queue.extend(frames)
+                self._queued_bytes += size
+                self.frames_queued += len(frames)
+                if self._queued_bytes > self.high_water_bytes:
+                    self.high_water_bytes = self._queued_bytes
+        if overflow:
+            metrics.incr("outbound.overflow_disconnects")
+            print(f"Outbound queue for {self.user or self.addr} passed {self.max_queue_bytes} bytes; disconnecting slow client.")
+            self.abort()
+            raise BrokenPipeError("Outbound queue overflow.")
+        if len(frames) > 1 or data is None:
+            metrics.incr("events.frames")
+        metrics.incr("outbound.frames_queued", len(frames))
+        self._wake()
+
+    def close(self):
+        """Flush whatever is already queued, then close the connection."""
+        with self._lock:
+            if self._closing:
+                return
+            self._closing = True
+        self._wake()
+
+    def abort(self):
+        """Drop anything still queued and close the connection now."""
+        with self._lock:
+            self._closing = True
+            self._queue.clear()
+            self._queued_bytes = 0
+        self._wake()
+        self._close_transport()
+
+    def enable_compression(self, level):
+        """Deflate everything queued from now on as one zlib stream, sync-flushed per write."""
+        with self._lock:
+            self._compressor = zlib.compressobj(level)
+            self._compress_from = self.frames_queued
+
+    def stats(self):
+        with self._lock:
+            return {
+                "user": self.user,
+                "addr": f"{self.addr[0]}:{self.addr[1]}" if isinstance(self.addr, tuple) else str(self.addr),
+                "queued_frames": len(self._queue),
+                "queued_bytes": self._queued_bytes,
+                "high_water_bytes": self.high_water_bytes,
+                "frames_queued": self.frames_queued,
+                "frames_sent": self.frames_sent,
+                "bytes_sent": self.bytes_sent,
+                "writes": self.writes,
+            }
+
+    def _take_batch(self):
+        # Caller holds self._lock. Coalesces queued frames into one write; a batch never
+        # straddles the start of compression. The writer deflates outside the lock.
+        batch = []
+        size = 0
+        limit = None
+        if self._compressor is not None and self._frames_taken < self._compress_from:
+            limit = self._compress_from - self._frames_taken
+        while self._queue and (limit is None or len(batch) < limit) and (not batch or size + len(self._queue[0]) <= self.max_write_bytes):
+            frame = self._queue.popleft()
+            batch.append(frame)
+            size += len(frame)
+        self._queued_bytes -= size
+        compress = self._compressor is not None and self._frames_taken >= self._compress_from
+        self._frames_taken += len(batch)
+        return batch, b"".join(batch), compress
+
+    def _deflate(self, data):
+        started = time.perf_counter()
+        out = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        metrics.incr("compression.cpu_us", int((time.perf_counter() - started) * 1e6))
+        metrics.incr("compression.bytes_in", len(data))
+        metrics.incr("compression.bytes_out", len(out))
+        metrics.incr("compression.bytes_saved", len(data) - len(out))
+        return out
+
+    def _record_write(self, frames, size):
+        self.frames_sent += frames
+        self.bytes_sent += size
+        self.writes += 1
+        metrics.incr("outbound.frames_sent", frames)
+        metrics.incr("outbound.bytes_sent", size)
+        metrics.incr("outbound.writes")
+
+    def _writer_stopped(self):
+        with self._lock:
+            self._closing = True
+            self._queue.clear()
+            self._queued_bytes = 0
+
+    @abc.abstractmethod
+    def _wake(self):
+        """Called from any thread once frames are queued or the session is closing:
+        get this engine's writer to drain the queue."""
+
+    @abc.abstractmethod
+    def _close_transport(self):
+        """Close the socket or stream from any thread, waking whatever reads it."""
+
+class _ThreadedSession(ClientSession):
+    def __init__(self, sock, addr):
+        super().__init__(addr)
+        self.sock = sock
+        self._cond = threading.Condition(self._lock)
+        self._writer = None
+        _set_send_timeout(sock, self.write_timeout)
+        _set_keepalive(sock)
+
+    def _wake(self):
+        with self._cond:
+            # Connections that never get past the handshake don't need a writer thread.
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+                self._writer.start()
+            self._cond.notify()
+
+    def _writer_loop(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closing:
+                    self._cond.wait()
+                batch, data, compress = self._take_batch()
+            if not batch:
+                break
+            if compress:
+                data = self._deflate(data)
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                break
+            self._record_write(len(batch), len(data))
+        self._writer_stopped()
+        self._close_transport()
+
+    def _close_transport(self):
+        # shutdown() wakes the reader thread blocked in readline(); close() alone may not.
+        try: self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+        try: self.sock.close()
+        except OSError: pass
+
+def _stats_report(prefix=""):
+    return json.dumps(metrics.snapshot(prefix), indent=2)
+
+def _queues_report(limit=10):
+    with lock:
+        sessions = list(clients.values())
+    rows = sorted((s.stats() for s in sessions if isinstance(s, ClientSession)), key=lambda r: (r["queued_bytes"], r["high_water_bytes"]), reverse=True)
+    if not rows:
+        return "No sessions online."
+    lines = [f"{'user':<20} {'queued':>8} {'bytes':>10} {'high water':>10} {'sent':>8}"]
+    for r in rows[:limit]:
+        lines.append(f"{str(r['user']):<20} {r['queued_frames']:>8} {r['queued_bytes']:>10} {r['high_water_bytes']:>10} {r['frames_sent']:>8}")
+    return "\n".join(lines)
+
+class _RemoteSession:
+    """Stand-in for a session held by another worker; frames are routed over the bus."""
+    def __init__(self, user, worker):
+        self.user = user
+        self.worker = worker
+
+    def send(self, payload):
+        self.sendall(_encode_frame(payload))
+
+    def sendall(self, data):
+        _bus_publish({"t": "deliver", "worker": self.worker, "users": [self.user]}, data)
+
+    def close(self):
+        _bus_publish({"t": "close", "worker": self.worker, "user": self.user})
+
+    abort = close
+
+    def check_offline(self):
+        """Have the owning worker send this user any offline messages it hasn't yet."""
+        _bus_publish({"t": "offline", "worker": self.worker, "user": self.user})
+
 def broadcast_contact_status(user, online):
     with lock:
         status_text = client_statuses.get(user, "offline") if online else "offline"
-    msg = json.dumps({"action":"contact_status","user":user,"online":online,"status_text":status_text}) + "\n"
+    if worker_id:
+        _bus_publish({"t": "presence", "user": user, "worker": worker_id, "online": online, "status": status_text})
+    _deliver_contact_status(user, online, status_text)
+
+def _deliver_contact_status(user, online, status_text, local_only=False):
+    with contact_index_lock:
+        watchers = list(contact_watchers.get(user, ()))
     with lock:
-        for owner, sock in clients.items():
-            db = sqlite3.connect(DB)
-            r = db.execute("SELECT blocked FROM contacts WHERE owner=? AND contact=?", (owner, user)).fetchone()
-            db.close()
-            if r and r[0] == 0:
-                try: sock.sendall(msg.encode())
-                except: pass
+        allowed = [clients[owner] for owner in watchers if owner in clients]
+    if local_only:
+        allowed = [s for s in allowed if isinstance(s, ClientSession)]
+    _broadcast_frame(allowed, {"action":"contact_status","user":user,"online":online,"status_text":status_text}, event_key=f"contact_status:{user}")
+
+# Reverse contact index: contact -> owners who have that contact and have not blocked it.
+# Loaded once at startup and kept current by the contact mutations (and, across
+# workers, by bus state messages), so presence fan-out never touches the database.
+contact_watchers = {}
+contact_index_lock = threading.Lock()
+
+def _load_contact_index():
+    index = {}
+    con = _db_connect()
+    for owner, contact in con.execute("SELECT owner, contact FROM contacts WHERE blocked=0"):
+        index.setdefault(contact, set()).add(owner)
+    con.close()
+    global contact_watchers
+    with contact_index_lock:
+        contact_watchers = index
+    print(f"Loaded contact index: {sum(len(v) for v in index.values())} entries for {len(index)} contacts.")
+
+class _BlockCache:
+    """Bounded LRU of (owner, contact) -> blocked flag, or None when owner has no such
+    contact. Contact mutations write through it; misses read the contacts table."""
+    _MISSING = object()
+
+    def __init__(self, max_entries=200000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._writes = 0
+
+    def blocked(self, owner, contact):
+        key = (owner, contact)
+        with self._lock:
+            value = self._entries.get(key, self._MISSING)
+            if value is not self._MISSING:
+                self._entries.move_to_end(key)
+            seq = self._writes
+        if value is not self._MISSING:
+            metrics.incr("block_cache.hits")
+            return value
+        metrics.incr("block_cache.misses")
+        con = _db_connect()
+        row = con.execute("SELECT blocked FROM contacts WHERE owner=? AND contact=?", (owner, contact)).fetchone()
+        con.close()
+        value = row[0] if row else None
+        with self._lock:
+            # Skip the fill if a mutation landed while we were reading; it may be newer.
+            if self._writes == seq:
+                self._store(key, value)
+        return value
+
+    def set(self, owner, contact, blocked):
+        with self._lock:
+            self._writes += 1
+            self._store((owner, contact), blocked)
+
+    def forget_user(self, user):
+        with self._lock:
+            self._writes += 1
+            for key in [k for k in self._entries if user in k]:
+                del self._entries[key]
+
+    def _store(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            metrics.incr("block_cache.evictions")
+
+    def __len__(self):
+        return len(self._entries)
+
+block_cache = _BlockCache()
+metrics.gauge("block_cache.entries", lambda: len(block_cache))
+
+def _contact_changed(owner, contact, blocked, publish=True):
+    """Record a contact row's new blocked flag (None once deleted) in the block cache
+    and the reverse index, and tell the other workers."""
+    block_cache.set(owner, contact, blocked)
+    with contact_index_lock:
+        if blocked == 0:
+            contact_watchers.setdefault(contact, set()).add(owner)
+        else:
+            owners = contact_watchers.get(contact)
+            if owners is not None:
+                owners.discard(owner)
+                if not owners:
+                    del contact_watchers[contact]
+    if publish:
+        _bus_publish({"t": "state", "kind": "contact_edge", "owner": owner, "contact": contact, "blocked": blocked})
+
+def _forget_user_contacts(user, contacts, publish=True):
+    # An account is going away: drop it as a watched contact and as a watcher.
+    block_cache.forget_user(user)
+    with contact_index_lock:
+        contact_watchers.pop(user, None)
+        for contact in contacts:
+            owners = contact_watchers.get(contact)
+            if owners is not None:
+                owners.discard(user)
+                if not owners:
+                    del contact_watchers[contact]
+    if publish:
+        _bus_publish({"t": "state", "kind": "contact_forget", "user": user, "contacts": list(contacts)})
+
+metrics.gauge("contacts.index_entries", lambda: sum(len(v) for v in list(contact_watchers.values())))
+
+# Store-and-forward for messages to offline users. Each recipient's mailbox is capped
+# by message count and bytes, checked inside the INSERT so every worker's writes
+# agree; a full mailbox refuses the message and the sender is told. Triggers keep a
+# per-recipient count and size in offline_mailboxes, so neither the cap check nor the
+# stats gauges add up the messages themselves.
+OFFLINE_INSERT = """
+    INSERT INTO offline_messages(recipient, sender, sent_at, body, bytes, stored_at)
+    SELECT ?,?,?,?,?, CAST(strftime('%s','now') AS INTEGER)
+    WHERE COALESCE((SELECT messages FROM offline_mailboxes WHERE recipient=?), 0) < ?
+    AND COALESCE((SELECT bytes FROM offline_mailboxes WHERE recipient=?), 0) + ? <= ?
+"""
+
+def _user_exists(username):
+    con = _db_connect()
+    row = con.execute("SELECT 1 FROM users WHERE username=?", (username,)).fetchone()
+    con.close()
+    return row is not None
+
+def _store_offline_message(to, frm, sent_at, body):
+    """Queue a message for a user who is offline. Returns False if their mailbox is full."""
+    size = len(body.encode("utf-8"))
+    stored = db_writer.execute(OFFLINE_INSERT, (
+        to, frm, sent_at, body, size,
+        to, offline_config['max_messages'],
+        to, size, offline_config['max_kb'] * 1024,
+    ))
+    metrics.incr("offline.stored" if stored else "offline.rejected")
+    if stored:
+        # They may have logged in while we were writing, here or on another worker;
+        # their login fetch could have missed it.
+        with lock: sock_to = clients.get(to)
+        if isinstance(sock_to, ClientSession):
+            _deliver_offline_messages(sock_to, to)
+        elif isinstance(sock_to, _RemoteSession):
+            sock_to.check_offline()
+    return bool(stored)
+
+def _deliver_offline_messages(sock, user):
+    """Send stored messages a page at a time. Clients with the offline_ack cap have one
+    page out at a time: its ack deletes it and pulls the next. Other clients get every
+    page at once, deleted when they disconnect cleanly (see _settle_offline_messages)."""
+    page = offline_config['page_size']
+    acked = sock.caps.get("offline_ack")
+    with sock.offline_lock:
+        while True:
+            if acked and sock.offline_acked_upto < sock.offline_sent_upto:
+                # The last page is still waiting for its ack, which sends the next.
+                return
+            con = _db_connect()
+            rows = con.execute(
+                "SELECT id, sender, sent_at, body FROM offline_messages WHERE recipient=? AND id>? ORDER BY id LIMIT ?",
+                (user, sock.offline_sent_upto, page + 1),
+            ).fetchall()
+            con.close()
+            if not rows:
+                return
+            more = len(rows) > page
+            rows = rows[:page]
+            sock.offline_sent_upto = rows[-1][0]
+            frame = {"action": "offline_messages",
+                     "messages": [{"from": s, "to": user, "time": t, "msg": b} for _, s, t, b in rows]}
+            if acked:
+                frame.update(ack=sock.offline_sent_upto, more=more)
+            try:
+                sock.send(frame)
+            except Exception:
+                return
+            metrics.incr("offline.delivered", len(rows))
+            if acked or not more:
+                return
+
+def _settle_offline_messages(sock, user):
+    """A client without offline_ack hung up cleanly, so it has the pages it was sent.
+    After a dropped connection they stay stored and are sent again at the next login."""
+    if not sock.caps.get("offline_ack") and sock.offline_sent_upto:
+        db_writer.post("DELETE FROM offline_messages WHERE recipient=? AND id<=?", (user, sock.offline_sent_upto))
+
+_offline_usage_cache = [0.0, None]
+
+def _offline_usage():
+    # One query serves the three gauges of a stats snapshot.
+    if _offline_usage_cache[1] is None or time.monotonic() - _offline_usage_cache[0] > 1.0:
+        con = _db_connect()
+        row = con.execute("SELECT COALESCE(SUM(messages), 0), COALESCE(SUM(bytes), 0), COUNT(*) FROM offline_mailboxes").fetchone()
+        con.close()
+        _offline_usage_cache[:] = [time.monotonic(), row]
+    return _offline_usage_cache[1]
+
+metrics.gauge("offline.messages", lambda: _offline_usage()[0])
+metrics.gauge("offline.bytes", lambda: _offline_usage()[1])
+metrics.gauge("offline.mailboxes", lambda: _offline_usage()[2])
+
+# Optional server-side message history. Rows are clustered by (conversation, seq) so
+# a conversation's pages are contiguous; id is a global message number that doubles
+# as the rowid of the contentless FTS5 index. A conversation id is the sorted pair of
+# participant tokens ("u" + hex of the username), which the index also holds so a
+# search can be limited to the caller's conversations inside MATCH. Ids and seqs
+# come from history_counters (name '' for ids, the conversation id for its seqs),
+# which only move forward, so cursors stay valid when the newest rows are deleted.
+HISTORY_INSERT = """
+    INSERT INTO history(conversation, seq, id, sender, sent_at, body, stored_at)
+    SELECT ?, COALESCE((SELECT last FROM history_counters WHERE name=?), 0) + 1,
+           COALESCE((SELECT last FROM history_counters WHERE name=''), 0) + 1, ?, ?, ?, CAST(strftime('%s','now') AS INTEGER)
+"""
+
+def _member_token(username):
+    return "u" + username.encode("utf-8").hex()
+
+def _conversation_id(a, b):
+    return " ".join(sorted((_member_token(a), _member_token(b))))
+
+def _conversation_peer(conversation, user):
+    names = [bytes.fromhex(t[1:]).decode("utf-8") for t in conversation.split()]
+    return next((n for n in names if n != user), user)
+
+def _record_history(frm, to, sent_at, body):
+    conversation = _conversation_id(frm, to)
+    db_writer.post(HISTORY_INSERT, (conversation, conversation, frm, sent_at, body))
+    metrics.incr("history.recorded")
+
+def _history_match(user, query, peer=None):
+    """An FTS5 MATCH expression for the words in query, within user's conversations."""
+    phrases = []
+    for term in str(query or "").split()[:16]:
+        prefix = term.endswith("*") and len(term) > 1
+        term = term.rstrip("*")
+        if term:
+            phrases.append('"' + term.replace('"', '""') + '"' + ("*" if prefix else ""))
+    if not phrases:
+        return None
+    match = f"conversation:{_member_token(user)} AND body:({' '.join(phrases)})"
+    if peer:
+        match += f" AND conversation:{_member_token(peer)}"
+    return match
+
+def _history_fetch(user, peer, before, limit):
+    con = _db_connect()
+    rows = con.execute(
+        "SELECT seq, sender, sent_at, body FROM history WHERE conversation=? AND seq<? ORDER BY seq DESC LIMIT ?",
+        (_conversation_id(user, peer), before, limit),
+    ).fetchall()
+    con.close()
+    return rows
+
+def _history_search(match, before, limit):
+    con = _db_connect()
+    rows = con.execute(
+        """
+        SELECT f.rowid, h.conversation, h.seq, h.sender, h.sent_at, h.body
+        FROM history_fts f JOIN history h ON h.id = f.rowid
+        WHERE history_fts MATCH ? AND f.rowid < ? ORDER BY f.rowid DESC LIMIT ?
+        """,
+        (match, before, limit),
+    ).fetchall()
+    con.close()
+    return rows
+
+def _init_history_tables(cur):
+    cur.execute('''CREATE TABLE IF NOT EXISTS history (conversation TEXT NOT NULL, seq INTEGER NOT NULL, id INTEGER NOT NULL, sender TEXT, sent_at TEXT, body TEXT, stored_at INTEGER, PRIMARY KEY(conversation, seq)) WITHOUT ROWID''')
+    _add_stored_at(cur, "history")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS history_id ON history(id)")
+    if not cur.execute("SELECT 1 FROM sqlite_master WHERE name='history_counters'").fetchone():
+        cur.execute("CREATE TABLE history_counters (name TEXT PRIMARY KEY, last INTEGER NOT NULL) WITHOUT ROWID")
+        # History from before the counters existed carries on from its highest numbers.
+        cur.execute("INSERT INTO history_counters SELECT '', MAX(id) FROM history HAVING MAX(id) IS NOT NULL")
+        cur.execute("INSERT INTO history_counters SELECT conversation, MAX(seq) FROM history GROUP BY conversation")
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS history_counters_insert AFTER INSERT ON history BEGIN
+        INSERT INTO history_counters(name, last) VALUES ('', new.id), (new.conversation, new.seq)
+        ON CONFLICT(name) DO UPDATE SET last=MAX(last, excluded.last); END''')
+    cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(body, conversation, content='')")
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN
+        INSERT INTO history_fts(rowid, body, conversation) VALUES (new.id, new.body, new.conversation); END''')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN
+        INSERT INTO history_fts(history_fts, rowid, body, conversation) VALUES ('delete', old.id, old.body, old.conversation); END''')
+
+# Retention: when the global group policy sets group_retention_days, history older than
+# that is deleted by a background pass. Offline messages haven't reached their reader
+# yet, so they only expire after retention_offline_days, and by default never. Ids only
+# grow, so expired rows are always the lowest ids; each batch is an id range found by
+# walking the id index, and batches go through the writer with pauses so message
+# writes are never held up long. The pass runs in one process only: the cluster parent
+# under --workers, which follows policy changes over the bus like the workers do.
+RETENTION_TABLES = ("offline_messages", "history")
+RETENTION_VACUUM_PAGES = 256
+
+def _add_stored_at(cur, table):
+    if 'stored_at' not in [row[1] for row in cur.execute(f"PRAGMA table_info({table})")]:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN stored_at INTEGER")
+        # Older rows have no time of their own; their retention period starts now.
+        cur.execute(f"UPDATE {table} SET stored_at=CAST(strftime('%s','now') AS INTEGER)")
+
+def _retention_days():
+    return max(0, int(group_policy_store.effective(_normalize_group_name(None)).get("group_retention_days") or 0))
+
+def _retention_periods():
+    return {"offline_messages": retention_config['offline_days'], "history": _retention_days()}
+
+def _db_pages():
+    con = _db_connect()
+    pages = {k: con.execute(f"PRAGMA {k}").fetchone()[0] for k in ("page_size", "page_count", "freelist_count", "auto_vacuum")}
+    con.close()
+    return pages
+
+def _retention_pause(started):
+    # Sleep at least as long as the batch took, so retention uses at most half the writer.
+    time.sleep(max(retention_config['pause_ms'] / 1000.0, time.monotonic() - started))
+
+def _expired_id_range(table, cutoff, limit):
+    con = _db_connect()
+    ids = []
+    for rid, stored_at in con.execute(f"SELECT id, stored_at FROM {table} ORDER BY id LIMIT ?", (limit,)):
+        if stored_at is None or stored_at >= cutoff:
+            break
+        ids.append(rid)
+    con.close()
+    return (ids[0], ids[-1], len(ids)) if ids else None
+
+def _run_retention():
+    """One retention pass: delete expired rows, then return freed pages to the filesystem."""
+    periods = _retention_periods()
+    report = {"days": periods, "rows": {}, "freed_bytes": 0, "returned_bytes": 0, "seconds": 0.0}
+    if not any(periods.values()):
+        return report
+    started = time.monotonic()
+    con = _db_connect()
+    tables = [t for t in RETENTION_TABLES if periods[t] and con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (t,)).fetchone()]
+    con.close()
+    before = _db_pages()
+    for table in tables:
+        cutoff = int(time.time()) - periods[table] * 86400
+        deleted = 0
+        while True:
+            batch_started = time.monotonic()
+            expired = _expired_id_range(table, cutoff, retention_config['batch'])
+            if not expired:
+                break
+            deleted += db_writer.execute(f"DELETE FROM {table} WHERE id BETWEEN ? AND ?", expired[:2])
+            _retention_pause(batch_started)
+            if expired[2] < retention_config['batch']:
+                break
+        report["rows"][table] = deleted
+        metrics.incr(f"retention.deleted.{table}", deleted)
+    after = _db_pages()
+    report["freed_bytes"] = max(0, after["freelist_count"] - before["freelist_count"]) * after["page_size"]
+    if after["auto_vacuum"] == 2:
+        while after["freelist_count"] > 0:
+            batch_started = time.monotonic()
+            db_writer.execute(f"PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES})")
+            _retention_pause(batch_started)
+            prev, after = after, _db_pages()
+            if after["freelist_count"] >= prev["freelist_count"]:
+                break
+        report["returned_bytes"] = max(0, before["page_count"] - after["page_count"]) * after["page_size"]
+    report["seconds"] = round(time.monotonic() - started, 3)
+    metrics.incr("retention.runs")
+    metrics.incr("retention.freed_bytes", report["freed_bytes"])
+    metrics.incr("retention.returned_bytes", report["returned_bytes"])
+    rows = ", ".join(f"{n} {t} (over {periods[t]} days)" for t, n in report["rows"].items()) or "nothing"
+    print(f"Retention: deleted {rows}; freed {report['freed_bytes'] // 1024} KB, "
+          f"returned {report['returned_bytes'] // 1024} KB to the filesystem in {report['seconds']}s.")
+    return report
+
+def _retention_worker():
+    delay = min(60, retention_config['interval_minutes'] * 60)
+    while True:
+        time.sleep(delay)
+        delay = retention_config['interval_minutes'] * 60
+        try:
+            _run_retention()
+        except Exception as e:
+            # Keep the schedule: the next pass picks up whatever this one left.
+            print(f"Retention pass failed: {e}")
 
 def kick_if_banned(user):
     with lock: s = clients.get(user)
-    if s:
-        try: s.sendall(json.dumps({"action":"banned_kick"}).encode() + b"\n")
+    if isinstance(s, _RemoteSession):
+        # The owning worker ends the session and announces the user offline.
+        s.send({"action":"banned_kick"})
+        s.close()
+    elif s:
+        try: s.send({"action":"banned_kick"})
         except: pass
         s.close()
         with lock:
@@ -1048,1167 +2688,1646 @@ def kick_if_banned(user):
             client_statuses.pop(user, None)
         broadcast_contact_status(user, False)
 
-def handle_client(cs, addr):
-    sock = cs
-    f = sock.makefile("r")
-    user = None
-    try:
+class _TokenBuckets:
+    """Token buckets keyed by address or username. Only the max_keys most recently used
+    keys are kept; an evicted key simply starts again with a full bucket."""
+    def __init__(self, burst, per_minute, max_keys):
+        self.burst = max(1, burst)
+        self.rate = max(0.001, per_minute) / 60.0
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = collections.OrderedDict()
+
+    def take(self, key):
+        """Spend a token for key. Returns 0 if one was available, otherwise the seconds
+        until the next token."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                tokens = float(self.burst)
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                tokens = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+            wait = 0.0
+            if tokens >= 1.0:
+                tokens -= 1.0
+            else:
+                wait = (1.0 - tokens) / self.rate
+            self._buckets[key] = [tokens, now]
+            return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+metrics.gauge("login.buckets", lambda: sum(len(b) for b in login_limiters.values()))
+
+# Chatty post-login actions and the limiter class each one spends from.
+RATE_LIMITED_ACTIONS = {"msg": "msg", "typing": "typing", "group_call_signal": "signal"}
+
+class _ActionLimiter:
+    """Per-user token buckets for the actions in RATE_LIMITED_ACTIONS, one set per class.
+
+    Messages follow the global group policy: group_rate_limit_per_minute, tightened to one
+    message per group_slow_mode_seconds when slow mode is on. Typing and call signalling
+    use the rate_* settings. Like the buckets, the throttled counts are kept only for the
+    users_max most recently seen users.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._throttled = collections.OrderedDict()
+        self._policy_version = None
+        self._msg_limited = True
+
+    def reset(self):
+        cfg = rate_limit_config
+        with self._lock:
+            self._buckets = {
+                "msg": _TokenBuckets(cfg['msg_burst'], 120, cfg['users_max']),
+                "typing": _TokenBuckets(cfg['typing_burst'], cfg['typing_per_minute'], cfg['users_max']),
+                "signal": _TokenBuckets(cfg['signal_burst'], cfg['signal_per_minute'], cfg['users_max']),
+            }
+            self._throttled.clear()
+            self._policy_version = None
+
+    def _msg_limits(self, buckets):
+        version = group_policy_store.version
+        if self._policy_version == version:
+            return self._msg_limited
+        policy = group_policy_store.effective(_normalize_group_name(None))
+        per_minute = int(policy.get("group_rate_limit_per_minute") or 0)
+        slow = int(policy.get("group_slow_mode_seconds") or 0)
+        burst = rate_limit_config['msg_burst']
+        if slow > 0:
+            per_minute = min(per_minute, 60.0 / slow) if per_minute > 0 else 60.0 / slow
+            burst = 1
+        # The version goes last, so a caller that sees it also sees the limits it stands for.
+        with self._lock:
+            buckets.burst = burst
+            buckets.rate = per_minute / 60.0
+            self._msg_limited = per_minute > 0
+            self._policy_version = version
+        return per_minute > 0
+
+    def take(self, user, cls):
+        """0 if user may go ahead with an action of this class, otherwise seconds to wait."""
+        if not self._buckets:
+            self.reset()
+        buckets = self._buckets[cls]
+        if cls == "msg" and not self._msg_limits(buckets):
+            return 0.0
+        wait = buckets.take(user)
+        if wait:
+            metrics.incr(f"ratelimit.{cls}")
+            with self._lock:
+                counts = self._throttled.pop(user, None) or {}
+                counts[cls] = counts.get(cls, 0) + 1
+                self._throttled[user] = counts
+                if len(self._throttled) > rate_limit_config['users_max']:
+                    self._throttled.popitem(last=False)
+        return wait
+
+    def throttled(self):
+        with self._lock:
+            return {u: dict(c) for u, c in self._throttled.items()}
+
+action_limiter = _ActionLimiter()
+
+def _ratelimits_report(arg=""):
+    counts = action_limiter.throttled()
+    if arg and not arg.isdigit():
+        c = counts.get(arg)
+        return f"{arg}: " + (", ".join(f"{k} {v}" for k, v in sorted(c.items())) if c else "not throttled.")
+    rows = sorted(counts.items(), key=lambda kv: sum(kv[1].values()), reverse=True)
+    if not rows:
+        return "No actions have been rate limited."
+    lines = [f"{'user':<20} {'msg':>8} {'typing':>8} {'signal':>8}"]
+    for u, c in rows[:int(arg) if arg else 10]:
+        lines.append(f"{str(u):<20} {c.get('msg', 0):>8} {c.get('typing', 0):>8} {c.get('signal', 0):>8}")
+    return "\n".join(lines)
+
+class _ServerBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"The server is busy. Try again in {retry_after} seconds.")
+        self.retry_after = retry_after
+
+    def reply(self, **fields):
+        return dict(fields, reason=str(self), retry_after=self.retry_after)
+
+class _PasswordPool:
+    """Runs argon2 hashing and verification on a fixed number of threads.
+
+    argon2-cffi releases the GIL while it hashes, so the threads use every core. A burst
+    of logins waits in a bounded queue instead of running hundreds of hashes at once.
+    When the queue is full, callers get _ServerBusy immediately. It carries an estimate
+    of when to retry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+        self._avg_ms = 50.0
+
+    def run(self, fn, *args):
+        workers = password_config['workers']
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="argon2")
+            if self._pending >= workers + password_config['queue']:
+                metrics.incr("auth.rejected")
+                raise _ServerBusy(max(1, int(math.ceil(self._pending * self._avg_ms / workers / 1000.0))))
+            self._pending += 1
+        return self._executor.submit(self._task, time.perf_counter(), fn, args).result()
+
+    def _task(self, queued, fn, args):
+        started = time.perf_counter()
+        metrics.observe("auth.queue_wait_ms", (started - queued) * 1000.0)
         try:
-            line = f.readline()
-            if not line: return 
-            req = json.loads(line)
-        except (UnicodeDecodeError, json.JSONDecodeError): return
+            return fn(*args)
+        finally:
+            ms = (time.perf_counter() - started) * 1000.0
+            metrics.observe("auth.hash_ms", ms)
+            with self._lock:
+                self._pending -= 1
+                self._avg_ms += (ms - self._avg_ms) * 0.1
+
+    def pending(self):
+        return self._pending
+
+password_pool = _PasswordPool()
+metrics.gauge("auth.pending", password_pool.pending)
+
+def _check_password(stored, password):
+    """(ok, needs_rehash) for a stored password; legacy plaintext always needs rehashing."""
+    if not stored.startswith("$argon2"):
+        ok = stored == password
+        return ok, ok
+    try: _ph.verify(stored, password)
+    except (VerifyMismatchError, VerificationError, InvalidHashError): return False, False
+    return True, _ph.check_needs_rehash(stored)
+
+def verify_password(stored, password):
+    if not stored.startswith("$argon2"):
+        return _check_password(stored, password)
+    return password_pool.run(_check_password, stored, password)
+
+def hash_password(password):
+    return password_pool.run(lambda p: _ph.hash(p), password)
+
+class _SessionTokens:
+    """Resume tokens. A password login can be handed a random token that a reconnect
+    presents instead of the password. Only an HMAC of the token under the server's
+    session key is stored. Resuming therefore costs one HMAC, plus one indexed lookup
+    when the token isn't cached, instead of an argon2 verify.
+
+    Live tokens are cached per process. Revoking a user's tokens deletes their rows,
+    evicts them from every worker's cache, and bumps a per-user generation. A resume
+    that was reading the old row at that moment is then turned away.
+    """
+    MAX_CACHED = 100000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._cache = collections.OrderedDict()
+        self._generation = {}
+
+    def key(self):
+        if self._key is None:
+            path = session_config['key_file']
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, "wb") as f:
+                    f.write(secrets.token_bytes(32))
+            except FileExistsError:
+                pass
+            with open(path, "rb") as f:
+                self._key = f.read()
+        return self._key
+
+    def _digest(self, token):
+        return hmac.new(self.key(), token.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def _remember(self, digest, username, expires_at):
+        with self._lock:
+            self._cache[digest] = (username, expires_at)
+            self._cache.move_to_end(digest)
+            while len(self._cache) > self.MAX_CACHED:
+                self._cache.popitem(last=False)
+
+    def issue(self, username):
+        """A new token for username: returns (token, digest, seconds until it expires)."""
+        token = secrets.token_urlsafe(32)
+        digest = self._digest(token)
+        now = int(time.time())
+        expires_at = now + session_config['token_hours'] * 3600
+        db_writer.post("DELETE FROM session_tokens WHERE username=? AND expires_at<=?", (username, now))
+        db_writer.post("INSERT INTO session_tokens(digest, username, expires_at) VALUES(?,?,?)", (digest, username, expires_at))
+        self._remember(digest, username, expires_at)
+        metrics.incr("resume.issued")
+        return token, digest, expires_at - now
+
+    def resume(self, token):
+        """(username, digest) for a live token, or (None, None)."""
+        if not token or len(token) > 128:
+            return None, None
+        digest = self._digest(token)
+        with self._lock:
+            entry = self._cache.get(digest)
+        if entry is None:
+            con = _db_connect()
+            row = con.execute("SELECT username, expires_at FROM session_tokens WHERE digest=?", (digest,)).fetchone()
+            con.close()
+            if not row:
+                return None, None
+            with self._lock:
+                generation = self._generation.get(row[0], 0)
+            entry = (row[0], row[1])
+            self._remember(digest, *entry)
+            with self._lock:
+                if self._generation.get(row[0], 0) != generation:
+                    self._cache.pop(digest, None)
+                    return None, None
+        if entry[1] <= time.time():
+            self.revoke(digest)
+            return None, None
+        return entry[0], digest
+
+    def revoke(self, digest):
+        with self._lock:
+            self._cache.pop(digest, None)
+        db_writer.post("DELETE FROM session_tokens WHERE digest=?", (digest,))
+
+    def revoke_user(self, username):
+        db_writer.execute("DELETE FROM session_tokens WHERE username=?", (username,))
+        self.forget_user(username)
+        _bus_publish({"t": "state", "kind": "session_revoke", "user": username})
+
+    def forget_user(self, username):
+        with self._lock:
+            self._generation[username] = self._generation.get(username, 0) + 1
+            for digest in [d for d, (u, _) in self._cache.items() if u == username]:
+                del self._cache[digest]
+
+session_tokens = _SessionTokens()
+
+def _admit_login(sock, req):
+    """Throttle login attempts per address and per username before any password work,
+    and resume attempts per address in a bucket of their own, so a burst of cheap
+    resumes after a restart doesn't use up the address's logins. Returns False once a
+    rejection carrying retry_after has been sent."""
+    action = req.get("action")
+    if action not in ("login", "resume") or not login_limiters:
+        return True
+    metrics.mark("login.attempts")
+    ip = sock.addr[0] if sock.addr else ""
+    kind = "ip" if action == "login" else "resume"
+    wait = login_limiters[kind].take(ip)
+    if not wait and action == "login":
+        wait = login_limiters['user'].take(_norm_username(str(req.get("user", "")).strip()))
+        kind = "user"
+    if not wait:
+        return True
+    metrics.incr(f"login.throttled_{kind}")
+    retry_after = int(math.ceil(wait))
+    try: sock.send({"status": "error", "reason": f"Too many login attempts. Try again in {retry_after} seconds.", "retry_after": retry_after})
+    except Exception: pass
+    return False
 
-        action = req.get("action")
+def _handle_handshake(sock, req):
+    """Handle the first frame of a connection. Returns the canonical username on a
+    successful login, or None once a pre-login request has been answered."""
+    action = req.get("action")
+
+    # --- Welcome Message (pre-login safe endpoint) ---
+    if action == "get_welcome":
+        sock.send({
+            "action": "welcome_info",
+            "enabled": bool(welcome_config.get('enabled', False)),
+            "pre_login": welcome_config.get('pre_login', '') if welcome_config.get('enabled', False) else '',
+            "post_login": welcome_config.get('post_login', '') if welcome_config.get('enabled', False) else '',
+        })
+        return
 
-        # --- Welcome Message (pre-login safe endpoint) ---
-        if action == "get_welcome":
-            sock.sendall((json.dumps({
-                "action": "welcome_info",
-                "enabled": bool(welcome_config.get('enabled', False)),
-                "pre_login": welcome_config.get('pre_login', '') if welcome_config.get('enabled', False) else '',
-                "post_login": welcome_config.get('post_login', '') if welcome_config.get('enabled', False) else '',
-            }) + "\n").encode())
+    # --- Create Account ---
+    if action == "create_account":
+        new_user = req.get("user")
+        new_pass = req.get("pass")
+        email = req.get("email", "")
+        if not new_user or not new_pass: 
+            sock.send({"action": "create_account_failed", "reason": "Missing fields."})
             return
-        
-        # --- Create Account ---
-        if action == "create_account":
-            new_user = req.get("user")
-            new_pass = req.get("pass")
-            email = req.get("email", "")
-            if not new_user or not new_pass: 
-                sock.sendall((json.dumps({"action": "create_account_failed", "reason": "Missing fields."}) + "\n").encode())
-                return
-            
-            con = sqlite3.connect(DB)
-            row = con.execute("SELECT is_verified FROM users WHERE username=?", (new_user,)).fetchone()
-            
-            # Allow overwriting unverified users
-            if row and (row[0] == 1 or not smtp_config['enabled']):
-                sock.sendall((json.dumps({"action": "create_account_failed", "reason": "Username is already taken."}) + "\n").encode())
-                con.close(); return
-            
-            # Logic: If SMTP is on, set verified=0, gen code, send email. Else verified=1.
-            verified = 1 if not smtp_config['enabled'] else 0
-            code = EmailManager.generate_code() if not verified else None
-            code_at = datetime.datetime.utcnow().isoformat() if code else None
 
-            hashed_pass = _ph.hash(new_pass)
-            if row: # Overwriting unverified
-                con.execute("UPDATE users SET password=?, email=?, verification_code=?, verification_code_at=?, is_verified=? WHERE username=?", (hashed_pass, email, code, code_at, verified, new_user))
-            else:
-                con.execute("INSERT INTO users(username, password, email, verification_code, verification_code_at, is_verified) VALUES(?,?,?,?,?,?)", (new_user, hashed_pass, email, code, code_at, verified))
-            con.commit()
-            con.close()
+        con = _db_connect()
+        row = con.execute("SELECT is_verified, username FROM users WHERE username_norm=?", (_norm_username(new_user),)).fetchone()
+        con.close()
 
-            if not verified:
-                expire_human = smtp_config.get('code_expires_human', '5 minutes')
-                if EmailManager.send_email(email, "Thrive Messenger - Verify Account", f"Your verification code is: {code}\n\nThis code will expire in {expire_human}."):
-                    sock.sendall((json.dumps({"action": "verify_pending"}) + "\n").encode())
-                else:
-                    # Fallback if email fails? For now just say success but maybe log it.
-                    print("Failed to send verification email.")
-                    sock.sendall((json.dumps({"action": "create_account_failed", "reason": "Could not send verification email."}) + "\n").encode())
-            else:
-                sock.sendall((json.dumps({"action": "create_account_success"}) + "\n").encode())
-                if email:
-                    EmailManager.send_email(
-                        email,
-                        "Welcome to Thrive Messenger",
-                        f"Hi {new_user}, your account is ready to use on {server_identity}."
-                    )
+        # Allow overwriting unverified users
+        if row and (row[0] == 1 or not smtp_config['enabled']):
+            sock.send({"action": "create_account_failed", "reason": "Username is already taken."})
             return
 
-        # --- Verify Account ---
-        if action == "verify_account":
-            u_ver = req.get("user")
-            code_ver = req.get("code")
-            con = sqlite3.connect(DB)
-            row = con.execute("SELECT verification_code, verification_code_at FROM users WHERE username=?", (u_ver,)).fetchone()
-            if row and row[0] == code_ver:
-                # Check expiration
-                if row[1]:
-                    elapsed = (datetime.datetime.utcnow() - datetime.datetime.fromisoformat(row[1])).total_seconds()
-                    if elapsed > smtp_config.get('code_expires', 300):
-                        con.execute("UPDATE users SET verification_code=NULL, verification_code_at=NULL WHERE username=?", (u_ver,))
-                        con.commit(); con.close()
-                        sock.sendall(json.dumps({"status": "error", "reason": "Code has expired."}).encode() + b"\n")
-                        return
-                con.execute("UPDATE users SET is_verified=1, verification_code=NULL, verification_code_at=NULL WHERE username=?", (u_ver,))
-                con.commit(); con.close()
-                sock.sendall(json.dumps({"status": "ok"}).encode() + b"\n")
-            else:
-                con.close()
-                sock.sendall(json.dumps({"status": "error", "reason": "Invalid code"}).encode() + b"\n")
-            return
+        # Logic: If SMTP is on, set verified=0, gen code, send email. Else verified=1.
+        verified = 1 if not smtp_config['enabled'] else 0
+        code = EmailManager.generate_code() if not verified else None
+        code_at = datetime.datetime.utcnow().isoformat() if code else None
 
-        # --- Request Password Reset ---
-        if action == "request_reset":
-            ident = req.get("identifier")
-            con = sqlite3.connect(DB)
-            # Find user by email or username
-            row = con.execute("SELECT username, email FROM users WHERE username=? OR email=?", (ident, ident)).fetchone()
-            if row:
-                t_user, t_email = row
-                if t_email:
-                    code = EmailManager.generate_code()
-                    con.execute("UPDATE users SET reset_code=?, reset_code_at=? WHERE username=?", (code, datetime.datetime.utcnow().isoformat(), t_user))
-                    con.commit()
-                    expire_human = smtp_config.get('code_expires_human', '5 minutes')
-                    EmailManager.send_email(t_email, "Thrive Messenger - Password Reset", f"Your password reset code is: {code}\n\nThis code will expire in {expire_human}.")
-                    # Return OK even if email fails to prevent enumeration, mostly.
-                    sock.sendall(json.dumps({"status": "ok", "user": t_user}).encode() + b"\n")
-                else:
-                    sock.sendall(json.dumps({"status": "error", "reason": "No email on file."}).encode() + b"\n")
+        try: hashed_pass = hash_password(new_pass)
+        except _ServerBusy as e:
+            sock.send(e.reply(action="create_account_failed"))
+            return
+        try:
+            if row: # Overwriting unverified
+                db_writer.execute("UPDATE users SET username=?, password=?, email=?, verification_code=?, verification_code_at=?, is_verified=? WHERE username=?", (new_user, hashed_pass, email, code, code_at, verified, row[1]))
             else:
-                # Security: Don't reveal user existence? For this app, we'll just say ok to pretend.
-                sock.sendall(json.dumps({"status": "ok"}).encode() + b"\n")
-            con.close()
+                db_writer.execute("INSERT INTO users(username, password, email, verification_code, verification_code_at, is_verified) VALUES(?,?,?,?,?,?)", (new_user, hashed_pass, email, code, code_at, verified))
+        except sqlite3.IntegrityError:
+            sock.send({"action": "create_account_failed", "reason": "Username is already taken."})
             return
 
-        # --- Perform Password Reset ---
-        if action == "reset_password":
-            t_user = req.get("user")
-            t_code = req.get("code")
-            new_p = req.get("new_pass")
-            con = sqlite3.connect(DB)
-            row = con.execute("SELECT reset_code, reset_code_at FROM users WHERE username=?", (t_user,)).fetchone()
-            if row and row[0] == t_code and t_code:
-                # Check expiration
-                if row[1]:
-                    elapsed = (datetime.datetime.utcnow() - datetime.datetime.fromisoformat(row[1])).total_seconds()
-                    if elapsed > smtp_config.get('code_expires', 300):
-                        con.execute("UPDATE users SET reset_code=NULL, reset_code_at=NULL WHERE username=?", (t_user,))
-                        con.commit(); con.close()
-                        sock.sendall(json.dumps({"status": "error", "reason": "Code has expired."}).encode() + b"\n")
-                        return
-                con.execute("UPDATE users SET password=?, reset_code=NULL, reset_code_at=NULL WHERE username=?", (_ph.hash(new_p), t_user))
-                con.commit(); con.close()
-                sock.sendall(json.dumps({"status": "ok"}).encode() + b"\n")
+        if not verified:
+            expire_human = smtp_config.get('code_expires_human', '5 minutes')
+            if EmailManager.send_email(email, "Thrive Messenger - Verify Account", f"Your verification code is: {code}\n\nThis code will expire in {expire_human}."):
+                sock.send({"action": "verify_pending"})
             else:
-                con.close()
-                sock.sendall(json.dumps({"status": "error", "reason": "Invalid code"}).encode() + b"\n")
-            return
+                # Fallback if email fails? For now just say success but maybe log it.
+                print("Failed to send verification email.")
+                sock.send({"action": "create_account_failed", "reason": "Could not send verification email."})
+        else:
+            sock.send({"action": "create_account_success"})
+            if email:
+                EmailManager.send_email(
+                    email,
+                    "Welcome to Thrive Messenger",
+                    f"Hi {new_user}, your account is ready to use on {server_identity}."
+                )
+        return
 
-        # --- File data on a dedicated connection (no login needed) ---
-        if action == "file_data":
-            transfer_id = req.get("transfer_id")
-            file_token = req.get("file_token")
-            with transfer_lock: transfer = pending_transfers.pop(transfer_id, None)
-            if not transfer or transfer.get("file_token") != file_token:
-                sock.sendall(b'{"status":"error","reason":"Invalid transfer"}\n')
-                return
-            recipient = transfer["to"]
-            with lock: sock_to = clients.get(recipient)
-            if sock_to:
-                name_map = {f["filename"]: f["filename"] for f in transfer["files"]}
-                safe_files = [dict(fd, filename=name_map.get(fd["filename"], fd["filename"])) for fd in req.get("files", [])
-                              if '/' not in fd["filename"] and '\\' not in fd["filename"]]
-                try: sock_to.sendall((json.dumps({"action": "file_data", "from": transfer["from"], "files": safe_files}) + "\n").encode())
-                except: pass
-            sock.sendall(b'{"status":"ok"}\n')
-            return
+    # --- Verify Account ---
+    if action == "verify_account":
+        u_ver = req.get("user")
+        code_ver = req.get("code")
+        con = _db_connect()
+        row = con.execute("SELECT verification_code, verification_code_at FROM users WHERE username=?", (u_ver,)).fetchone()
+        con.close()
+        if row and row[0] == code_ver:
+            # Check expiration
+            if row[1]:
+                elapsed = (datetime.datetime.utcnow() - datetime.datetime.fromisoformat(row[1])).total_seconds()
+                if elapsed > smtp_config.get('code_expires', 300):
+                    db_writer.execute("UPDATE users SET verification_code=NULL, verification_code_at=NULL WHERE username=?", (u_ver,))
+                    sock.send({"status": "error", "reason": "Code has expired."})
+                    return
+            db_writer.execute("UPDATE users SET is_verified=1, verification_code=NULL, verification_code_at=NULL WHERE username=?", (u_ver,))
+            sock.send({"status": "ok"})
+        else:
+            sock.send({"status": "error", "reason": "Invalid code"})
+        return
 
-        if action != "login":
-            sock.sendall(b'{"status":"error","reason":"Expected login"}\n')
-            return
+    # --- Request Password Reset ---
+    if action == "request_reset":
+        ident = req.get("identifier")
+        con = _db_connect()
+        # Find user by email or username
+        row = con.execute("SELECT username, email FROM users WHERE username=? OR email=?", (ident, ident)).fetchone()
+        con.close()
+        if row:
+            t_user, t_email = row
+            if t_email:
+                code = EmailManager.generate_code()
+                db_writer.execute("UPDATE users SET reset_code=?, reset_code_at=? WHERE username=?", (code, datetime.datetime.utcnow().isoformat(), t_user))
+                expire_human = smtp_config.get('code_expires_human', '5 minutes')
+                EmailManager.send_email(t_email, "Thrive Messenger - Password Reset", f"Your password reset code is: {code}\n\nThis code will expire in {expire_human}.")
+                # Return OK even if email fails to prevent enumeration, mostly.
+                sock.send({"status": "ok", "user": t_user})
+            else:
+                sock.send({"status": "error", "reason": "No email on file."})
+        else:
+            # Security: Don't reveal user existence? For this app, we'll just say ok to pretend.
+            sock.send({"status": "ok"})
+        return
 
-        db = sqlite3.connect(DB)
-        cur = db.cursor()
+    # --- Perform Password Reset ---
+    if action == "reset_password":
+        t_user = req.get("user")
+        t_code = req.get("code")
+        new_p = req.get("new_pass")
+        con = _db_connect()
+        row = con.execute("SELECT reset_code, reset_code_at FROM users WHERE username=?", (t_user,)).fetchone()
+        con.close()
+        if row and row[0] == t_code and t_code:
+            # Check expiration
+            if row[1]:
+                elapsed = (datetime.datetime.utcnow() - datetime.datetime.fromisoformat(row[1])).total_seconds()
+                if elapsed > smtp_config.get('code_expires', 300):
+                    db_writer.execute("UPDATE users SET reset_code=NULL, reset_code_at=NULL WHERE username=?", (t_user,))
+                    sock.send({"status": "error", "reason": "Code has expired."})
+                    return
+            try: hashed = hash_password(new_p)
+            except _ServerBusy as e:
+                sock.send(e.reply(status="error"))
+                return
+            db_writer.execute("UPDATE users SET password=?, reset_code=NULL, reset_code_at=NULL WHERE username=?", (hashed, t_user))
+            session_tokens.revoke_user(t_user)
+            sock.send({"status": "ok"})
+        else:
+            sock.send({"status": "error", "reason": "Invalid code"})
+        return
 
-        input_user = str(req.get("user", "")).strip()
-        if not input_user:
-            sock.sendall(b'{"status":"error","reason":"Invalid credentials"}\n')
-            db.close()
+    # --- File data on a dedicated connection (no login needed) ---
+    if action == "file_data":
+        transfer_id = req.get("transfer_id")
+        file_token = req.get("file_token")
+        transfer = _transfer_pop(transfer_id)
+        if not transfer or transfer.get("file_token") != file_token:
+            sock.send({"status": "error", "reason": "Invalid transfer"})
             return
+        recipient = transfer["to"]
+        with lock: sock_to = clients.get(recipient)
+        if sock_to:
+            name_map = {f["filename"]: f["filename"] for f in transfer["files"]}
+            safe_files = [dict(fd, filename=name_map.get(fd["filename"], fd["filename"])) for fd in req.get("files", [])
+                          if '/' not in fd["filename"] and '\\' not in fd["filename"]]
+            try: sock_to.send({"action": "file_data", "from": transfer["from"], "files": safe_files})
+            except: pass
+        sock.send({"status": "ok"})
+        return
+
+    # --- Resume with a token from an earlier password login ---
+    if action == "resume":
+        user, digest = session_tokens.resume(str(req.get("token", "")))
+        refusal = None
+        if user:
+            # The same account checks as a password login: a ban or deletion that
+            # didn't revoke the token (banfile, a direct edit, a race) still applies.
+            con = _db_connect()
+            row = con.execute("SELECT banned_until, ban_reason, is_verified FROM users WHERE username=?", (user,)).fetchone()
+            con.close()
+            refusal = _account_refusal(*row) if row else {"status": "error", "reason": "Invalid credentials"}
+            if refusal:
+                session_tokens.revoke_user(user)
+        if not user or refusal:
+            metrics.incr("resume.rejected")
+            sock.send(dict(refusal or {"status": "error", "reason": "Your session has expired. Please log in again."}, resume="invalid"))
+            return
+        metrics.incr("resume.accepted")
+        sock.resumed = True
+        sock.resume_digest = digest
+        return user
+
+    if action != "login":
+        sock.send({"status": "error", "reason": "Expected login"})
+        return
+
+    input_user = str(req.get("user", "")).strip()
+    if not input_user:
+        sock.send({"status": "error", "reason": "Invalid credentials"})
+        return
+
+    # Case-insensitive username login with canonical identity from DB.
+    # If multiple usernames differ only by case, reject to avoid ambiguous auth.
+    db = _db_connect()
+    rows = db.execute(
+        """
+        SELECT username, password, banned_until, ban_reason, is_verified
+        FROM users
+        WHERE username_norm = ?
+        ORDER BY CASE WHEN username = ? THEN 0 ELSE 1 END, username
+        LIMIT 2
+        """,
+        (_norm_username(input_user), input_user),
+    ).fetchall()
+    # Give the connection back before the password check, which can wait on the hashing pool.
+    db.close()
+    if len(rows) > 1:
+        sock.send({"status": "error", "reason": "Ambiguous username. Contact admin."})
+        return
+    row = rows[0] if rows else None
+
+    if not row:
+        sock.send({"status": "error", "reason": "Invalid credentials"})
+        return
+    password = str(req.get("pass", ""))
+    try: ok, needs_rehash = verify_password(row[1], password)
+    except _ServerBusy as e:
+        sock.send(e.reply(status="error"))
+        return
+    if ok and needs_rehash:
+        # Legacy plaintext, or a hash made with older argon2 settings. When the pool
+        # is busy the rehash waits for the next login.
+        try: db_writer.post("UPDATE users SET password=? WHERE username=?", (hash_password(password), row[0]))
+        except _ServerBusy: pass
+    if not ok:
+        sock.send({"status": "error", "reason": "Invalid credentials"})
+        return
+
+    refusal = _account_refusal(row[2], row[3], row[4])
+    if refusal:
+        sock.send(refusal)
+        return
+    return row[0]
+
+def _account_refusal(banned_until, ban_reason, verified):
+    """The reply refusing a login to an unverified or banned account, or None."""
+    if smtp_config['enabled'] and verified == 0:
+        return {"status": "error", "reason": "Account not verified. Please recreate account to verify."}
+    if banned_until:
+        until = datetime.datetime.strptime(banned_until, "%Y-%m-%d")
+        if until > datetime.datetime.now():
+            return {"status": "banned", "until": banned_until, "reason": ban_reason}
+    return None
+
+def _start_session(sock, user):
+    sock.user = user
+    # The reply is always a JSON line; negotiated framing applies from the next frame.
+    # Switch before registering so no frame for this user is encoded the old way.
+    reply = dict({"status": "ok"}, caps=sock.caps) if sock.caps else {"status": "ok"}
+    if sock.caps.get("resume") and not sock.resumed:
+        token, sock.resume_digest, expires_in = session_tokens.issue(user)
+        reply["resume"] = {"token": token, "expires_in": expires_in}
+    sock.send(reply)
+    sock.codec = sock.caps.get("framing", "json")
+    if sock.caps.get("compression") == "zlib":
+        sock.enable_compression(protocol_config['compression_level'])
+    if sock.caps.get("batching"):
+        sock.enable_batching()
+    if sock.caps.get("heartbeat"):
+        idle_reaper.start()
+    with lock:
+        clients[user] = sock
+        client_statuses[user] = "online"
+
+    db = _db_connect()
+    admins = get_admins()
+    rows = db.execute("SELECT contact,blocked FROM contacts WHERE owner=?", (user,)).fetchall()
+    db.close()
+    contacts = [{"user":c, "blocked":b, "online": _is_online_user(c), "is_admin": (c in admins), "status_text": _status_for_user(c)} for c,b in rows]
+    sock.send({"action":"contact_list","contacts":contacts})
+    _send_feature_caps(sock, user, since=sock.feature_caps_version)
+    if offline_config['enabled']:
+        _deliver_offline_messages(sock, user)
+    broadcast_contact_status(user, True)
+
+def _end_session(sock, user):
+    try: sock.close()
+    except: pass
+    with lock:
+        # A newer login (possibly on another worker) may already own this name.
+        current = user in clients and clients[user] is sock
+        if current:
+            del clients[user]
+            client_statuses.pop(user, None)
+    if user:
+        _remove_user_from_all_group_calls(user)
+        if current:
+            broadcast_contact_status(user, False)
+
+def _dispatch_timed(sock, user, msg):
+    sock.last_seen = time.monotonic()
+    started = time.perf_counter()
+    try:
+        return _handle_session_action(sock, user, msg)
+    finally:
+        metrics.incr("dispatch.frames")
+        metrics.observe("dispatch.latency_ms", (time.perf_counter() - started) * 1000.0)
+
+def _handle_session_action(sock, user, msg):
+    """Dispatch one post-login frame. Returns False when the session should end."""
+    action = msg.get("action")
+    limited = RATE_LIMITED_ACTIONS.get(action)
+    if limited and rate_limit_config['enabled']:
+        wait = action_limiter.take(user, limited)
+        if wait:
+            retry_after = round(wait, 1)
+            sock.send({"action": "rate_limited", "for": action, "to": msg.get("to"), "retry_after": retry_after,
+                       "reason": f"You're doing that too often. Try again in {retry_after} seconds."})
+            return True
+    def _deny_feature(feature_key, action_name=None):
+        try:
+            sock.send({
+                "action": action_name or "feature_denied",
+                "ok": False,
+                "reason": f"Feature '{feature_key}' is not enabled for your account.",
+                "feature": feature_key
+            })
+        except Exception:
+            pass
 
-        # Case-insensitive username login with canonical identity from DB.
-        # If multiple usernames differ only by case, reject to avoid ambiguous auth.
-        cur.execute(
+    if action == "ping":
+        sock.send({"action": "pong"})
+
+    elif action == "pong":
+        pass
+
+    elif action in ("history_fetch", "history_search"):
+        reply = "history" if action == "history_fetch" else "history_results"
+        if not history_config['enabled']:
+            sock.send({"action": reply, "ok": False, "reason": "Message history is not kept on this server."})
+            return True
+        peer = str(msg.get("with", "") or "").strip()
+        try:
+            limit = min(history_config['page_max'], max(1, int(msg.get("limit", 50))))
+            before = int(msg.get("before") or HISTORY_CURSOR_END)
+        except (TypeError, ValueError):
+            sock.send({"action": reply, "ok": False, "reason": "limit and before must be numbers."})
+            return True
+        if action == "history_fetch":
+            if not peer:
+                sock.send({"action": reply, "ok": False, "reason": "Missing conversation."})
+                return True
+            rows = _history_fetch(user, peer, before, limit)
+            sock.send({
+                "action": reply, "ok": True, "with": peer,
+                "messages": [{"seq": q, "from": f, "time": t, "msg": b} for q, f, t, b in reversed(rows)],
+                "next": rows[-1][0] if len(rows) == limit else None,
+            })
+        else:
+            match = _history_match(user, msg.get("query", ""), peer or None)
+            if not match:
+                sock.send({"action": reply, "ok": False, "reason": "Nothing to search for."})
+                return True
+            try:
+                rows = _history_search(match, before, limit)
+            except sqlite3.OperationalError as e:
+                sock.send({"action": reply, "ok": False, "reason": f"Search failed: {e}"})
+                return True
+            sock.send({
+                "action": reply, "ok": True, "query": msg.get("query", ""),
+                "messages": [{"id": i, "with": _conversation_peer(c, user), "seq": q, "from": f, "time": t, "msg": b}
+                             for i, c, q, f, t, b in rows],
+                "next": rows[-1][0] if len(rows) == limit else None,
+            })
+
+    elif action == "offline_ack":
+        try: upto = min(int(msg.get("upto", 0)), sock.offline_sent_upto)
+        except (TypeError, ValueError): return True
+        db_writer.post("DELETE FROM offline_messages WHERE recipient=? AND id<=?", (user, upto))
+        with sock.offline_lock:
+            sock.offline_acked_upto = max(sock.offline_acked_upto, upto)
+        _deliver_offline_messages(sock, user)
+
+    elif action == "get_feature_caps":
+        since = msg.get("since")
+        _send_feature_caps(sock, user, since=since if isinstance(since, int) else None)
+
+    elif action == "get_feature_policies":
+        if not _is_admin(user):
+            _deny_feature("admin_console", "feature_policy_result")
+            return True
+        rows = []
+        for fk in sorted(FEATURE_DEFAULTS.keys()):
+            p = _feature_policy_row(fk) or {}
+            rows.append(p)
+        try:
+            sock.send({"action": "feature_policies", "ok": True, "policies": rows})
+        except Exception:
+            pass
+
+    elif action == "set_feature_policy":
+        if not _is_admin(user):
+            _deny_feature("admin_console", "feature_policy_result")
+            return True
+        fk = str(msg.get("feature_key", "")).strip()
+        if fk not in FEATURE_DEFAULTS:
+            try:
+                sock.send({"action": "feature_policy_result", "ok": False, "reason": "Unknown feature key."})
+            except Exception:
+                pass
+            return True
+        enabled = 1 if bool(msg.get("enabled", True)) else 0
+        ui_visible = 1 if bool(msg.get("ui_visible", True)) else 0
+        scope = str(msg.get("scope", "all") or "all").strip().lower()
+        if not _is_valid_feature_scope(scope):
+            scope = "all"
+        desc = str(msg.get("description", FEATURE_DEFAULTS[fk].get("description", "")) or "").strip()
+        db_writer.execute(
             """
-            SELECT username, password, banned_until, ban_reason, is_verified
-            FROM users
-            WHERE username = ? COLLATE NOCASE
-            ORDER BY CASE WHEN username = ? THEN 0 ELSE 1 END, username
-            LIMIT 2
+            INSERT OR REPLACE INTO feature_policies(feature_key, enabled, ui_visible, scope, description, updated_by, updated_at)
+            VALUES(?,?,?,?,?,?,?)
             """,
-            (input_user, input_user),
+            (fk, enabled, ui_visible, scope, desc, user, datetime.datetime.utcnow().isoformat()),
         )
-        rows = cur.fetchall()
-        if len(rows) > 1:
-            sock.sendall(b'{"status":"error","reason":"Ambiguous username. Contact admin."}\n')
-            db.close()
-            return
-        row = rows[0] if rows else None
+        feature_caps.invalidate()
+        _broadcast_feature_caps()
+        try:
+            sock.send({"action": "feature_policy_result", "ok": True, "policy": _feature_policy_row(fk)})
+        except Exception:
+            pass
 
-        if not row:
-            sock.sendall(b'{"status":"error","reason":"Invalid credentials"}\n')
-            db.close()
-            return
-        stored = row[1]
-        ok = False
-        needs_rehash = False
-        if stored.startswith("$argon2"):
-            try: _ph.verify(stored, req["pass"]); ok = True; needs_rehash = _ph.check_needs_rehash(stored)
-            except (VerifyMismatchError, VerificationError, InvalidHashError): pass
+    elif action == "feature_allow_user_add":
+        if not _is_admin(user):
+            _deny_feature("admin_console", "feature_allow_result")
+            return True
+        fk = str(msg.get("feature_key", "")).strip()
+        target_user = str(msg.get("username", "")).strip()
+        if fk not in FEATURE_DEFAULTS or not target_user:
+            sock.send({"action": "feature_allow_result", "ok": False, "reason": "feature_key and username are required."})
+            return True
+        db_writer.execute("INSERT OR IGNORE INTO feature_allow_users(feature_key, username) VALUES(?,?)", (fk, target_user))
+        feature_caps.invalidate()
+        _broadcast_feature_caps()
+        sock.send({"action": "feature_allow_result", "ok": True, "feature_key": fk, "username": target_user})
+
+    elif action == "feature_allow_user_remove":
+        if not _is_admin(user):
+            _deny_feature("admin_console", "feature_allow_result")
+            return True
+        fk = str(msg.get("feature_key", "")).strip()
+        target_user = str(msg.get("username", "")).strip()
+        if fk not in FEATURE_DEFAULTS or not target_user:
+            sock.send({"action": "feature_allow_result", "ok": False, "reason": "feature_key and username are required."})
+            return True
+        db_writer.execute("DELETE FROM feature_allow_users WHERE feature_key=? AND username=?", (fk, target_user))
+        feature_caps.invalidate()
+        _broadcast_feature_caps()
+        sock.send({"action": "feature_allow_result", "ok": True, "feature_key": fk, "username": target_user})
+
+    elif action == "feature_access_group_add":
+        if not _is_admin(user):
+            _deny_feature("admin_console", "feature_group_result")
+            return True
+        gname = str(msg.get("group_name", "")).strip()
+        target_user = str(msg.get("username", "")).strip()
+        if not gname or not target_user:
+            sock.send({"action": "feature_group_result", "ok": False, "reason": "group_name and username are required."})
+            return True
+        db_writer.execute("INSERT OR IGNORE INTO user_access_groups(group_name, username) VALUES(?,?)", (gname, target_user))
+        feature_caps.invalidate()
+        _broadcast_feature_caps()
+        sock.send({"action": "feature_group_result", "ok": True, "group_name": gname, "username": target_user})
+
+    elif action == "feature_access_group_remove":
+        if not _is_admin(user):
+            _deny_feature("admin_console", "feature_group_result")
+            return True
+        gname = str(msg.get("group_name", "")).strip()
+        target_user = str(msg.get("username", "")).strip()
+        if not gname or not target_user:
+            sock.send({"action": "feature_group_result", "ok": False, "reason": "group_name and username are required."})
+            return True
+        db_writer.execute("DELETE FROM user_access_groups WHERE group_name=? AND username=?", (gname, target_user))
+        feature_caps.invalidate()
+        _broadcast_feature_caps()
+        sock.send({"action": "feature_group_result", "ok": True, "group_name": gname, "username": target_user})
+
+    elif action == "feature_allow_group_add":
+        if not _is_admin(user):
+            _deny_feature("admin_console", "feature_allow_group_result")
+            return True
+        fk = str(msg.get("feature_key", "")).strip()
+        gname = str(msg.get("group_name", "")).strip()
+        if fk not in FEATURE_DEFAULTS or not gname:
+            sock.send({"action": "feature_allow_group_result", "ok": False, "reason": "feature_key and group_name are required."})
+            return True
+        db_writer.execute("INSERT OR IGNORE INTO feature_allow_groups(feature_key, group_name) VALUES(?,?)", (fk, gname))
+        feature_caps.invalidate()
+        _broadcast_feature_caps()
+        sock.send({"action": "feature_allow_group_result", "ok": True, "feature_key": fk, "group_name": gname})
+
+    elif action == "feature_allow_group_remove":
+        if not _is_admin(user):
+            _deny_feature("admin_console", "feature_allow_group_result")
+            return True
+        fk = str(msg.get("feature_key", "")).strip()
+        gname = str(msg.get("group_name", "")).strip()
+        if fk not in FEATURE_DEFAULTS or not gname:
+            sock.send({"action": "feature_allow_group_result", "ok": False, "reason": "feature_key and group_name are required."})
+            return True
+        db_writer.execute("DELETE FROM feature_allow_groups WHERE feature_key=? AND group_name=?", (fk, gname))
+        feature_caps.invalidate()
+        _broadcast_feature_caps()
+        sock.send({"action": "feature_allow_group_result", "ok": True, "feature_key": fk, "group_name": gname})
+
+    elif action == "feature_access_groups_list":
+        if not _is_admin(user):
+            _deny_feature("admin_console", "feature_group_list")
+            return True
+        target_user = str(msg.get("username", "")).strip()
+        if not target_user:
+            sock.send({"action": "feature_group_list", "ok": False, "reason": "username is required."})
+            return True
+        con = _db_connect()
+        groups = [r[0] for r in con.execute("SELECT group_name FROM user_access_groups WHERE username=? ORDER BY group_name", (target_user,)).fetchall()]
+        con.close()
+        sock.send({"action": "feature_group_list", "ok": True, "username": target_user, "groups": groups})
+
+    elif action == "add_contact":
+        contact_to_add = msg["to"]
+        con = _db_connect()
+        # Match names case-insensitively like login does, and store the account's own spelling.
+        rows = con.execute(
+            "SELECT username FROM users WHERE username_norm=? ORDER BY CASE WHEN username=? THEN 0 ELSE 1 END LIMIT 2",
+            (_norm_username(contact_to_add), contact_to_add),
+        ).fetchall()
+        exists = rows[0] if rows and (len(rows) == 1 or rows[0][0] == contact_to_add) else None
+        if exists:
+            contact_to_add = exists[0]
+        if contact_to_add == user: 
+            reason = "You cannot add yourself as a contact."
+            sock.send({"action": "add_contact_failed", "reason": reason})
+            con.close()
+            return True
+        is_bot = _is_registered_bot(contact_to_add)
+        if is_bot and not _can_user_use_feature(user, "bots"):
+            reason = "Bot contacts are disabled for your account."
+            sock.send({"action": "add_contact_failed", "reason": reason})
+            con.close()
+            return True
+        if not exists and not is_bot:
+            reason = f"User '{contact_to_add}' does not exist."
+            sock.send({
+                "action": "add_contact_failed",
+                "reason": reason,
+                "suggest_invite": True,
+                "invite_methods": [
+                    m for m, ok in [("email", smtp_config.get("enabled", False)), ("sms", flexpbx_config.get("enabled", False))] if ok
+                ],
+            })
         else:
-            # Legacy plaintext — verify and rehash immediately
-            ok = (stored == req["pass"])
-            if ok: needs_rehash = True
-        if ok and needs_rehash:
-            db.execute("UPDATE users SET password=? WHERE username=?", (_ph.hash(req["pass"]), row[0]))
-            db.commit()
-        if not ok:
-            sock.sendall(b'{"status":"error","reason":"Invalid credentials"}\n')
-            db.close()
-            return
+            db_writer.execute("INSERT OR IGNORE INTO contacts(owner,contact) VALUES(?,?)", (user, contact_to_add))
+            # The row may already have existed, blocked.
+            row = con.execute("SELECT blocked FROM contacts WHERE owner=? AND contact=?", (user, contact_to_add)).fetchone()
+            _contact_changed(user, contact_to_add, row[0] if row else None)
+            is_online = _is_online_user(contact_to_add)
+            contact_status_text = _status_for_user(contact_to_add)
+            admins = get_admins()
+            if is_bot:
+                _ensure_admin_bot_rules_seed(user, contact_to_add)
+            rules_text = _effective_rules_for_bot(contact_to_add, user) if is_bot else ""
+            contact_data = {
+                "user": contact_to_add,
+                "blocked": 0,
+                "online": is_online,
+                "is_admin": contact_to_add in admins,
+                "status_text": contact_status_text,
+                "is_bot": bool(is_bot),
+                "bot_origin": "local" if _is_virtual_bot(contact_to_add) else ("external" if is_bot else "user"),
+                "bot_rules_available": bool(rules_text),
+                "bot_rules_preview": rules_text[:1000] if rules_text else "",
+                "bot_rules_editable": bool(is_bot and _is_admin(user)),
+            }
+            if _is_virtual_bot(contact_to_add) and str(contact_to_add).lower() == "openclaw-bot":
+                token = _upsert_bot_token(user, contact_to_add)
+                contact_data["bot_auth_token"] = token
+                contact_data["bot_auth_type"] = "openclaw"
+            sock.send({"action": "add_contact_success", "contact": contact_data})
+        con.close()
 
-        user = row[0]
-        bi, br, verified = row[2], row[3], row[4]
-        
-        if smtp_config['enabled'] and verified == 0:
-            sock.sendall(b'{"status":"error","reason":"Account not verified. Please recreate account to verify."}\n')
-            db.close()
-            return
+    elif action == "invite_user":
+        target_user = str(msg.get("username", "")).strip()
+        method = str(msg.get("method", "email")).strip().lower()
+        target = str(msg.get("target", "")).strip()
+        include_link = bool(msg.get("include_link", True))
+        if not target_user or not target:
+            sock.send({
+                "action": "invite_result",
+                "ok": False,
+                "method": method,
+                "target": target,
+                "reason": "Invite target username and destination are required."
+            })
+            return True
+        if method not in ("email", "sms"):
+            method = "email" if "@" in target else "sms"
+        invite_text = f"{user} invited you to join Thrive Messenger on {server_identity}."
+        if include_link:
+            invite_text += " Visit https://im.tappedin.fm/ for setup and sign-in."
+        ok = False
+        reason = "Unsupported invite method."
+        if method == "email":
+            ok = EmailManager.send_email(target, "You're invited to Thrive Messenger", invite_text)
+            reason = "Invite email sent." if ok else "Email delivery is unavailable or failed."
+        elif method == "sms":
+            ok, sms_reason = FlexPBXManager.send_sms(target, invite_text)
+            reason = "Invite SMS sent." if ok else sms_reason
+        sock.send({
+            "action": "invite_result",
+            "ok": ok,
+            "method": method,
+            "target": target,
+            "reason": reason
+        })
+
+    elif action in ("block_contact","unblock_contact"):
+        flag = 1 if action=="block_contact" else 0
+        if block_cache.blocked(user, msg["to"]) is not None:
+            db_writer.post("UPDATE contacts SET blocked=? WHERE owner=? AND contact=?", (flag,user,msg["to"]))
+            _contact_changed(user, msg["to"], flag)
+
+    elif action == "delete_contact":
+        deleted_name = msg["to"]
+        db_writer.post("DELETE FROM contacts WHERE owner=? AND contact=?", (user,deleted_name))
+        _contact_changed(user, deleted_name, None)
+        if _is_virtual_bot(deleted_name):
+            _revoke_bot_token(user, deleted_name)
+            try:
+                sock.send({
+                    "action": "bot_token_revoked",
+                    "bot": deleted_name
+                })
+            except Exception:
+                pass
 
-        if bi:
-            until = datetime.datetime.strptime(bi, "%Y-%m-%d")
-            if until > datetime.datetime.now(): 
-                sock.sendall(json.dumps({"status":"banned","until":bi,"reason":br}).encode() + b"\n")
-                db.close()
-                return
+    elif action == "admin_cmd":
+        if not _can_user_use_feature(user, "admin_console"):
+            response = "Error: Admin console is disabled for your account."
+        elif user not in get_admins(): 
+            response = "Error: You are not authorized to use admin commands."
+        else:
+            cmd_parts = msg.get("cmd", "").split()
+            command = cmd_parts[0].lower() if cmd_parts else ""
+            if command == "exit" and len(cmd_parts) == 1 and worker_id:
+                _bus_publish({"t": "control", "op": "shutdown", "by": user})
+                response = f"Server is shutting down in {shutdown_timeout} seconds..."
+            elif command == "exit" and len(cmd_parts) == 1:
+                print(f"Shutdown initiated by admin: {user}")
+                broadcast_alert(f"The server is shutting down in {shutdown_timeout} seconds.")
+                time.sleep(shutdown_timeout)
+                os._exit(0)
+            elif command == "restart" and len(cmd_parts) == 1:
+                response = f"Server is restarting in {shutdown_timeout} seconds..."
+                _schedule_restart(shutdown_timeout, requested_by=user)
+            elif command == "alert" and len(cmd_parts) >= 2:
+                alert_message = " ".join(cmd_parts[1:])
+                broadcast_alert(alert_message)
+                response = "Alert sent to all online users."
+            elif command == "create" and len(cmd_parts) in (3, 4):
+                email = cmd_parts[3] if len(cmd_parts) == 4 else ""
+                try:
+                    if handle_create(cmd_parts[1], cmd_parts[2], email):
+                        response = f"User '{cmd_parts[1]}' created."
+                    else:
+                        response = f"Error: Username '{cmd_parts[1]}' is already taken."
+                except _ServerBusy as e:
+                    response = f"Error: {e}"
+            elif command == "ban" and len(cmd_parts) >= 4: 
+                handle_ban(cmd_parts[1], cmd_parts[2], " ".join(cmd_parts[3:]))
+                response = f"User '{cmd_parts[1]}' banned."
+            elif command == "unban" and len(cmd_parts) == 2: 
+                handle_unban(cmd_parts[1])
+                response = f"User '{cmd_parts[1]}' unbanned."
+            elif command == "del" and len(cmd_parts) == 2: 
+                handle_delete(cmd_parts[1])
+                response = f"User '{cmd_parts[1]}' deleted."
+            elif command == "admin" and len(cmd_parts) == 2: 
+                add_admin(cmd_parts[1])
+                response = f"User '{cmd_parts[1]}' is now an admin."
+            elif command == "unadmin" and len(cmd_parts) == 2:
+                remove_admin(cmd_parts[1])
+                response = f"User '{cmd_parts[1]}' is no longer an admin."
+            elif command == "banfile" and len(cmd_parts) >= 4:
+                date_str = None
+                try:
+                    datetime.datetime.strptime(cmd_parts[3], "%m/%d/%Y")
+                    date_str = cmd_parts[3]
+                    reason = " ".join(cmd_parts[4:]) if len(cmd_parts) >= 5 else "No reason given"
+                except (ValueError, IndexError):
+                    reason = " ".join(cmd_parts[3:])
+                handle_banfile(cmd_parts[1], cmd_parts[2], date_str, reason)
+                if date_str:
+                    response = f"User '{cmd_parts[1]}' banned from sending '{cmd_parts[2]}' files until {date_str}."
+                else:
+                    response = f"User '{cmd_parts[1]}' permanently banned from sending '{cmd_parts[2]}' files."
+            elif command == "unbanfile" and len(cmd_parts) >= 2:
+                file_type = cmd_parts[2] if len(cmd_parts) >= 3 else None
+                handle_unbanfile(cmd_parts[1], file_type)
+                if file_type:
+                    response = f"User '{cmd_parts[1]}' file ban for '{file_type}' removed."
+                else:
+                    response = f"All file bans for user '{cmd_parts[1]}' removed."
+            elif command == "stats" and len(cmd_parts) <= 2:
+                response = _stats_report(cmd_parts[1] if len(cmd_parts) == 2 else "")
+            elif command == "ratelimits" and len(cmd_parts) <= 2:
+                response = _ratelimits_report(cmd_parts[1] if len(cmd_parts) == 2 else "")
+            elif command == "queues" and len(cmd_parts) <= 2:
+                try: limit = int(cmd_parts[1]) if len(cmd_parts) == 2 else 10
+                except ValueError: limit = 10
+                response = _queues_report(limit)
+            elif command == "gpolicy" and len(cmd_parts) >= 2:
+                sub = cmd_parts[1].lower()
+                if sub == "show":
+                    # /gpolicy show [group_name]
+                    target_group = cmd_parts[2] if len(cmd_parts) >= 3 else "__global__"
+                    scope = "group" if target_group != "__global__" else "global"
+                    policy = _fetch_group_policy(scope=scope, group_name=target_group)
+                    response = json.dumps({
+                        "scope": scope,
+                        "group": target_group,
+                        "version": group_policy_store.version,
+                        "policy": policy
+                    }, ensure_ascii=False)
+                elif sub == "set" and len(cmd_parts) >= 4:
+                    # /gpolicy set key value [group_name]
+                    key = cmd_parts[2]
+                    value = cmd_parts[3]
+                    target_group = cmd_parts[4] if len(cmd_parts) >= 5 else "__global__"
+                    scope = "group" if target_group != "__global__" else "global"
+                    merged = _upsert_group_policy(scope=scope, group_name=target_group, updates={key: value}, updated_by=user)
+                    response = f"Group policy updated for {scope}:{target_group}. {key}={merged.get(key)}"
+                elif sub == "reset":
+                    # /gpolicy reset [group_name]
+                    target_group = cmd_parts[2] if len(cmd_parts) >= 3 else "__global__"
+                    scope = "group" if target_group != "__global__" else "global"
+                    _reset_group_policy(scope=scope, group_name=target_group)
+                    response = f"Group policy reset for {scope}:{target_group}."
+                elif sub == "keys":
+                    response = json.dumps(_policy_schema_payload(), ensure_ascii=False)
+                else:
+                    response = "Error: gpolicy syntax: /gpolicy show [group], /gpolicy set <key> <value> [group], /gpolicy reset [group], /gpolicy keys"
+            else:
+                response = "Error: Unknown command or incorrect syntax."
+        try: sock.send({"action":"admin_response", "response": response})
+        except: pass
+
+    elif action == "schedule_restart":
+        if not _can_user_use_feature(user, "admin_console"):
+            try:
+                sock.send({"action": "admin_response", "response": "Error: Admin console is disabled for your account."})
+            except Exception:
+                pass
+            return True
+        if user not in get_admins():
+            try:
+                sock.send({"action": "admin_response", "response": "Error: You are not authorized to schedule restarts."})
+            except Exception:
+                pass
+            return True
+        try:
+            delay = int(msg.get("seconds", shutdown_timeout))
+        except Exception:
+            delay = shutdown_timeout
+        _schedule_restart(delay, requested_by=user)
+        try:
+            sock.send({"action": "admin_response", "response": f"Server restart scheduled in {max(1, delay)} seconds."})
+        except Exception:
+            pass
 
-        sock.sendall(b'{"status":"ok"}\n')
+    elif action == "server_info":
+        con = _db_connect()
+        total_users = con.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        con.close()
+        admins = get_admins()
         with lock:
-            clients[user] = sock
-            client_statuses[user] = "online"
+            online_count = len(clients)
+            online_admins = sum(1 for uname in clients.keys() if uname in admins)
+        uptime_seconds = int(max(0, time.time() - server_started_at))
+        info = {
+            "action": "server_info_response",
+            "port": server_port,
+            "ssl": use_ssl,
+            "total_users": total_users,
+            "online_users": online_count,
+            "online_admin_users": online_admins,
+            "uptime_seconds": uptime_seconds,
+            "size_limit": file_config.get('size_limit', 0),
+            "blackfiles": file_config.get('blackfiles', []),
+            "max_status_length": max_status_length
+        }
+        try: sock.send(info)
+        except: pass
 
+    elif action == "user_directory":
+        con = _db_connect()
+        all_users = con.execute("SELECT username FROM users WHERE is_verified=1").fetchall()
+        user_contacts = {row[0]: row[1] for row in con.execute("SELECT contact, blocked FROM contacts WHERE owner=?", (user,)).fetchall()}
+        con.close()
         admins = get_admins()
-        rows = db.execute("SELECT contact,blocked FROM contacts WHERE owner=?", (user,)).fetchall()
-        contacts = [{"user":c, "blocked":b, "online": _is_online_user(c), "is_admin": (c in admins), "status_text": _status_for_user(c)} for c,b in rows]
-        sock.sendall((json.dumps({"action":"contact_list","contacts":contacts})+"\n").encode())
-        _send_feature_caps(sock, user)
-        db.close()
-        
-        broadcast_contact_status(user, True)
-        
-        for line in f:
-            msg = json.loads(line)
-            action = msg.get("action")
-            def _deny_feature(feature_key, action_name=None):
-                try:
-                    sock.sendall((json.dumps({
-                        "action": action_name or "feature_denied",
-                        "ok": False,
-                        "reason": f"Feature '{feature_key}' is not enabled for your account.",
-                        "feature": feature_key
-                    }) + "\n").encode())
-                except Exception:
-                    pass
-            
-            if action == "get_feature_caps":
-                _send_feature_caps(sock, user)
+        directory = []
+        include_bots = _can_user_use_feature(user, "bots")
+        known = {uname for (uname,) in all_users}
+        extra = set()
+        if include_bots:
+            extra = set(bot_usernames) | set(bot_external_usernames)
+        for uname in sorted(known | extra):
+            directory.append({
+                "user": uname,
+                "online": _is_online_user(uname),
+                "status_text": _status_for_user(uname),
+                "is_admin": uname in admins,
+                "is_contact": uname in user_contacts,
+                "is_blocked": user_contacts.get(uname, 0) == 1,
+                "server": server_identity,
+                "is_bot": _is_registered_bot(uname),
+                "bot_origin": "local" if _is_virtual_bot(uname) else ("external" if _is_registered_bot(uname) else "user")
+            })
+        try: sock.send({"action": "user_directory_response", "users": directory})
+        except: pass
 
-            elif action == "get_feature_policies":
-                if not _is_admin(user):
-                    _deny_feature("admin_console", "feature_policy_result")
-                    continue
-                rows = []
-                for fk in sorted(FEATURE_DEFAULTS.keys()):
-                    p = _feature_policy_row(fk) or {}
-                    rows.append(p)
-                try:
-                    sock.sendall((json.dumps({"action": "feature_policies", "ok": True, "policies": rows}) + "\n").encode())
-                except Exception:
-                    pass
+    elif action == "get_bot_rules":
+        if not _can_user_use_feature(user, "bot_rules"):
+            try:
+                sock.send({"action": "bot_rules", "ok": False, "reason": "Bot rules are disabled for your account."})
+            except Exception:
+                pass
+            return True
+        bot_name = str(msg.get("bot", "")).strip()
+        if not bot_name or not _is_registered_bot(bot_name):
+            try:
+                sock.send({"action": "bot_rules", "ok": False, "reason": "Unknown bot."})
+            except Exception:
+                pass
+            return True
+        if _is_admin(user):
+            _ensure_admin_bot_rules_seed(user, bot_name)
+        rules_text = _effective_rules_for_bot(bot_name, user)
+        try:
+            sock.send({
+                "action": "bot_rules",
+                "ok": True,
+                "bot": bot_name,
+                "rules": rules_text,
+                "rules_available": bool(rules_text),
+                "editable": bool(_is_admin(user)),
+                "scope": "admin_override" if (_is_admin(user) and bool(_get_admin_bot_rules(user, bot_name))) else "global",
+            })
+        except Exception:
+            pass
 
-            elif action == "set_feature_policy":
-                if not _is_admin(user):
-                    _deny_feature("admin_console", "feature_policy_result")
-                    continue
-                fk = str(msg.get("feature_key", "")).strip()
-                if fk not in FEATURE_DEFAULTS:
-                    try:
-                        sock.sendall((json.dumps({"action": "feature_policy_result", "ok": False, "reason": "Unknown feature key."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                enabled = 1 if bool(msg.get("enabled", True)) else 0
-                ui_visible = 1 if bool(msg.get("ui_visible", True)) else 0
-                scope = str(msg.get("scope", "all") or "all").strip().lower()
-                if not _is_valid_feature_scope(scope):
-                    scope = "all"
-                desc = str(msg.get("description", FEATURE_DEFAULTS[fk].get("description", "")) or "").strip()
-                con = sqlite3.connect(DB)
-                con.execute(
-                    """
-                    INSERT OR REPLACE INTO feature_policies(feature_key, enabled, ui_visible, scope, description, updated_by, updated_at)
-                    VALUES(?,?,?,?,?,?,?)
-                    """,
-                    (fk, enabled, ui_visible, scope, desc, user, datetime.datetime.utcnow().isoformat()),
-                )
-                con.commit()
-                con.close()
-                _broadcast_feature_caps()
-                try:
-                    sock.sendall((json.dumps({"action": "feature_policy_result", "ok": True, "policy": _feature_policy_row(fk)}) + "\n").encode())
-                except Exception:
-                    pass
+    elif action == "get_group_policy":
+        if not _can_user_use_feature(user, "group_policy"):
+            try:
+                sock.send({"action": "group_policy", "ok": False, "reason": "Group policy is disabled for your account."})
+            except Exception:
+                pass
+            return True
+        group_name = str(msg.get("group", "") or "").strip()
+        scope = "group" if group_name else "global"
+        policy = _fetch_group_policy(scope=scope, group_name=group_name or "__global__")
+        payload = {
+            "action": "group_policy",
+            "ok": True,
+            "scope": scope,
+            "group": group_name or "__global__",
+            "policy": policy,
+            "schema": _policy_schema_payload(),
+            "editable": bool(user in get_admins()),
+        }
+        try:
+            sock.send(payload)
+        except Exception:
+            pass
 
-            elif action == "feature_allow_user_add":
-                if not _is_admin(user):
-                    _deny_feature("admin_console", "feature_allow_result")
-                    continue
-                fk = str(msg.get("feature_key", "")).strip()
-                target_user = str(msg.get("username", "")).strip()
-                if fk not in FEATURE_DEFAULTS or not target_user:
-                    sock.sendall((json.dumps({"action": "feature_allow_result", "ok": False, "reason": "feature_key and username are required."}) + "\n").encode())
-                    continue
-                con = sqlite3.connect(DB)
-                con.execute("INSERT OR IGNORE INTO feature_allow_users(feature_key, username) VALUES(?,?)", (fk, target_user))
-                con.commit()
-                con.close()
-                _broadcast_feature_caps()
-                sock.sendall((json.dumps({"action": "feature_allow_result", "ok": True, "feature_key": fk, "username": target_user}) + "\n").encode())
+    elif action == "set_group_policy":
+        if not _can_user_use_feature(user, "group_policy"):
+            try:
+                sock.send({"action": "group_policy_update", "ok": False, "reason": "Group policy is disabled for your account."})
+            except Exception:
+                pass
+            return True
+        if user not in get_admins():
+            try:
+                sock.send({"action": "group_policy_update", "ok": False, "reason": "Admin only."})
+            except Exception:
+                pass
+            return True
+        group_name = str(msg.get("group", "") or "").strip()
+        scope = "group" if group_name else "global"
+        updates = msg.get("updates", {})
+        if not isinstance(updates, dict):
+            try:
+                sock.send({"action": "group_policy_update", "ok": False, "reason": "Invalid updates payload."})
+            except Exception:
+                pass
+            return True
+        try:
+            merged = _upsert_group_policy(scope=scope, group_name=group_name or "__global__", updates=updates, updated_by=user)
+            sock.send({
+                "action": "group_policy_update",
+                "ok": True,
+                "scope": scope,
+                "group": group_name or "__global__",
+                "policy": merged
+            })
+        except Exception as e:
+            try:
+                sock.send({"action": "group_policy_update", "ok": False, "reason": str(e)})
+            except Exception:
+                pass
 
-            elif action == "feature_allow_user_remove":
-                if not _is_admin(user):
-                    _deny_feature("admin_console", "feature_allow_result")
-                    continue
-                fk = str(msg.get("feature_key", "")).strip()
-                target_user = str(msg.get("username", "")).strip()
-                if fk not in FEATURE_DEFAULTS or not target_user:
-                    sock.sendall((json.dumps({"action": "feature_allow_result", "ok": False, "reason": "feature_key and username are required."}) + "\n").encode())
-                    continue
-                con = sqlite3.connect(DB)
-                con.execute("DELETE FROM feature_allow_users WHERE feature_key=? AND username=?", (fk, target_user))
-                con.commit()
-                con.close()
-                _broadcast_feature_caps()
-                sock.sendall((json.dumps({"action": "feature_allow_result", "ok": True, "feature_key": fk, "username": target_user}) + "\n").encode())
+    elif action == "reset_group_policy":
+        if not _can_user_use_feature(user, "group_policy"):
+            try:
+                sock.send({"action": "group_policy_update", "ok": False, "reason": "Group policy is disabled for your account."})
+            except Exception:
+                pass
+            return True
+        if user not in get_admins():
+            try:
+                sock.send({"action": "group_policy_update", "ok": False, "reason": "Admin only."})
+            except Exception:
+                pass
+            return True
+        group_name = str(msg.get("group", "") or "").strip()
+        scope = "group" if group_name else "global"
+        _reset_group_policy(scope=scope, group_name=group_name or "__global__")
+        policy = _fetch_group_policy(scope=scope, group_name=group_name or "__global__")
+        try:
+            sock.send({
+                "action": "group_policy_update",
+                "ok": True,
+                "scope": scope,
+                "group": group_name or "__global__",
+                "policy": policy
+            })
+        except Exception:
+            pass
 
-            elif action == "feature_access_group_add":
-                if not _is_admin(user):
-                    _deny_feature("admin_console", "feature_group_result")
-                    continue
-                gname = str(msg.get("group_name", "")).strip()
-                target_user = str(msg.get("username", "")).strip()
-                if not gname or not target_user:
-                    sock.sendall((json.dumps({"action": "feature_group_result", "ok": False, "reason": "group_name and username are required."}) + "\n").encode())
-                    continue
-                con = sqlite3.connect(DB)
-                con.execute("INSERT OR IGNORE INTO user_access_groups(group_name, username) VALUES(?,?)", (gname, target_user))
-                con.commit()
-                con.close()
-                _broadcast_feature_caps()
-                sock.sendall((json.dumps({"action": "feature_group_result", "ok": True, "group_name": gname, "username": target_user}) + "\n").encode())
+    elif action == "set_bot_rules":
+        if not _can_user_use_feature(user, "bot_rules"):
+            try:
+                sock.send({"action": "bot_rules_update", "ok": False, "reason": "Bot rules are disabled for your account."})
+            except Exception:
+                pass
+            return True
+        if not _is_admin(user):
+            try:
+                sock.send({"action": "bot_rules_update", "ok": False, "reason": "Admin only."})
+            except Exception:
+                pass
+            return True
+        bot_name = str(msg.get("bot", "")).strip()
+        rules_text = str(msg.get("rules", "") or "").strip()
+        if not bot_name or not _is_registered_bot(bot_name):
+            try:
+                sock.send({"action": "bot_rules_update", "ok": False, "reason": "Unknown bot."})
+            except Exception:
+                pass
+            return True
+        if len(rules_text) > 60000:
+            rules_text = rules_text[:60000]
+        ok = _set_admin_bot_rules(user, bot_name, rules_text)
+        try:
+            sock.send({
+                "action": "bot_rules_update",
+                "ok": bool(ok),
+                "bot": bot_name,
+                "scope": "admin_override",
+                "rules_available": bool(rules_text),
+            })
+        except Exception:
+            pass
 
-            elif action == "feature_access_group_remove":
-                if not _is_admin(user):
-                    _deny_feature("admin_console", "feature_group_result")
-                    continue
-                gname = str(msg.get("group_name", "")).strip()
-                target_user = str(msg.get("username", "")).strip()
-                if not gname or not target_user:
-                    sock.sendall((json.dumps({"action": "feature_group_result", "ok": False, "reason": "group_name and username are required."}) + "\n").encode())
-                    continue
-                con = sqlite3.connect(DB)
-                con.execute("DELETE FROM user_access_groups WHERE group_name=? AND username=?", (gname, target_user))
-                con.commit()
-                con.close()
-                _broadcast_feature_caps()
-                sock.sendall((json.dumps({"action": "feature_group_result", "ok": True, "group_name": gname, "username": target_user}) + "\n").encode())
+    elif action == "reset_bot_rules":
+        if not _can_user_use_feature(user, "bot_rules"):
+            try:
+                sock.send({"action": "bot_rules_update", "ok": False, "reason": "Bot rules are disabled for your account."})
+            except Exception:
+                pass
+            return True
+        if not _is_admin(user):
+            try:
+                sock.send({"action": "bot_rules_update", "ok": False, "reason": "Admin only."})
+            except Exception:
+                pass
+            return True
+        bot_name = str(msg.get("bot", "")).strip()
+        if not bot_name or not _is_registered_bot(bot_name):
+            try:
+                sock.send({"action": "bot_rules_update", "ok": False, "reason": "Unknown bot."})
+            except Exception:
+                pass
+            return True
+        _clear_admin_bot_rules(user, bot_name)
+        _ensure_admin_bot_rules_seed(user, bot_name)
+        try:
+            sock.send({
+                "action": "bot_rules_update",
+                "ok": True,
+                "bot": bot_name,
+                "scope": "global_seeded",
+                "rules_available": bool(_effective_rules_for_bot(bot_name, user)),
+            })
+        except Exception:
+            pass
 
-            elif action == "feature_allow_group_add":
-                if not _is_admin(user):
-                    _deny_feature("admin_console", "feature_allow_group_result")
-                    continue
-                fk = str(msg.get("feature_key", "")).strip()
-                gname = str(msg.get("group_name", "")).strip()
-                if fk not in FEATURE_DEFAULTS or not gname:
-                    sock.sendall((json.dumps({"action": "feature_allow_group_result", "ok": False, "reason": "feature_key and group_name are required."}) + "\n").encode())
-                    continue
-                con = sqlite3.connect(DB)
-                con.execute("INSERT OR IGNORE INTO feature_allow_groups(feature_key, group_name) VALUES(?,?)", (fk, gname))
-                con.commit()
-                con.close()
-                _broadcast_feature_caps()
-                sock.sendall((json.dumps({"action": "feature_allow_group_result", "ok": True, "feature_key": fk, "group_name": gname}) + "\n").encode())
+    elif action == "group_call_list":
+        if not _can_user_use_feature(user, "group_call"):
+            _deny_feature("group_call", "group_call_list_response")
+            return True
+        rows = []
+        with group_call_lock:
+            for g in sorted(group_call_sessions.keys()):
+                snap = _group_call_snapshot(g)
+                rows.append(snap)
+        try:
+            sock.send({"action": "group_call_list_response", "calls": rows})
+        except Exception:
+            pass
 
-            elif action == "feature_allow_group_remove":
-                if not _is_admin(user):
-                    _deny_feature("admin_console", "feature_allow_group_result")
-                    continue
-                fk = str(msg.get("feature_key", "")).strip()
-                gname = str(msg.get("group_name", "")).strip()
-                if fk not in FEATURE_DEFAULTS or not gname:
-                    sock.sendall((json.dumps({"action": "feature_allow_group_result", "ok": False, "reason": "feature_key and group_name are required."}) + "\n").encode())
-                    continue
-                con = sqlite3.connect(DB)
-                con.execute("DELETE FROM feature_allow_groups WHERE feature_key=? AND group_name=?", (fk, gname))
-                con.commit()
-                con.close()
-                _broadcast_feature_caps()
-                sock.sendall((json.dumps({"action": "feature_allow_group_result", "ok": True, "feature_key": fk, "group_name": gname}) + "\n").encode())
+    elif action == "group_call_join":
+        if not _can_user_use_feature(user, "group_call"):
+            _deny_feature("group_call", "group_call_result")
+            return True
+        group = str(msg.get("group", "")).strip()
+        mode = str(msg.get("mode", "voice") or "voice").strip().lower()
+        if mode not in ("voice", "video"):
+            mode = "voice"
+        if not group:
+            try:
+                sock.send({"action": "group_call_result", "ok": False, "reason": "Missing group name."})
+            except Exception:
+                pass
+            return True
+        # Enforce global/group call policy when configured.
+        policy = group_policy_store.effective(group)
+        if mode == "voice" and not policy.get("allow_group_voice", True):
+            sock.send({"action": "group_call_result", "ok": False, "group": group, "reason": "Group voice calls are disabled."})
+            return True
+        if mode == "video" and not policy.get("allow_group_video", True):
+            sock.send({"action": "group_call_result", "ok": False, "group": group, "reason": "Group video calls are disabled."})
+            return True
+        with group_call_lock:
+            data = group_call_sessions.setdefault(group, {"mode": mode, "participants": set()})
+            if data.get("mode") != mode and data.get("participants"):
+                mode = data.get("mode", "voice")
+            data["mode"] = mode
+            max_voice = int(policy.get("max_group_concurrent_voice", 40) or 40)
+            if len(data["participants"]) >= max_voice and user not in data["participants"]:
+                sock.send({"action": "group_call_result", "ok": False, "group": group, "reason": "Group call participant limit reached."})
+                return True
+            data["participants"].add(user)
+        _bus_publish({"t": "state", "kind": "group_call_join", "group": group, "user": user, "mode": mode})
+        payload = {"action": "group_call_event", "event": "join", "by": user}
+        payload.update(_group_call_snapshot(group))
+        _group_call_broadcast(group, payload)
+        try:
+            sock.send({"action": "group_call_result", "ok": True, "group": group})
+        except Exception:
+            pass
 
-            elif action == "feature_access_groups_list":
-                if not _is_admin(user):
-                    _deny_feature("admin_console", "feature_group_list")
-                    continue
-                target_user = str(msg.get("username", "")).strip()
-                if not target_user:
-                    sock.sendall((json.dumps({"action": "feature_group_list", "ok": False, "reason": "username is required."}) + "\n").encode())
-                    continue
-                con = sqlite3.connect(DB)
-                groups = [r[0] for r in con.execute("SELECT group_name FROM user_access_groups WHERE username=? ORDER BY group_name", (target_user,)).fetchall()]
-                con.close()
-                sock.sendall((json.dumps({"action": "feature_group_list", "ok": True, "username": target_user, "groups": groups}) + "\n").encode())
+    elif action == "group_call_leave":
+        if not _can_user_use_feature(user, "group_call"):
+            _deny_feature("group_call", "group_call_result")
+            return True
+        group = str(msg.get("group", "")).strip()
+        if not group:
+            return True
+        with group_call_lock:
+            data = group_call_sessions.get(group)
+            if not data:
+                pass
+            else:
+                data.get("participants", set()).discard(user)
+                if not data.get("participants"):
+                    group_call_sessions.pop(group, None)
+        _bus_publish({"t": "state", "kind": "group_call_leave", "group": group, "user": user})
+        payload = {"action": "group_call_event", "event": "leave", "by": user}
+        payload.update(_group_call_snapshot(group))
+        _group_call_broadcast(group, payload, exclude=user)
+        try:
+            sock.send({"action": "group_call_result", "ok": True, "group": group})
+        except Exception:
+            pass
 
-            elif action == "add_contact":
-                contact_to_add = msg["to"]
-                if contact_to_add == user: 
-                    reason = "You cannot add yourself as a contact."
-                    sock.sendall((json.dumps({"action": "add_contact_failed", "reason": reason}) + "\n").encode())
-                    continue
-                con = sqlite3.connect(DB)
-                exists = con.execute("SELECT 1 FROM users WHERE username=?", (contact_to_add,)).fetchone()
-                is_bot = _is_registered_bot(contact_to_add)
-                if is_bot and not _can_user_use_feature(user, "bots"):
-                    reason = "Bot contacts are disabled for your account."
-                    sock.sendall((json.dumps({"action": "add_contact_failed", "reason": reason}) + "\n").encode())
-                    con.close()
-                    continue
-                if not exists and not is_bot:
-                    reason = f"User '{contact_to_add}' does not exist."
-                    sock.sendall((json.dumps({
-                        "action": "add_contact_failed",
-                        "reason": reason,
-                        "suggest_invite": True,
-                        "invite_methods": [
-                            m for m, ok in [("email", smtp_config.get("enabled", False)), ("sms", flexpbx_config.get("enabled", False))] if ok
-                        ],
-                    }) + "\n").encode())
-                else:
-                    con.execute("INSERT OR IGNORE INTO contacts(owner,contact) VALUES(?,?)", (user, contact_to_add))
-                    con.commit()
-                    is_online = _is_online_user(contact_to_add)
-                    contact_status_text = _status_for_user(contact_to_add)
-                    admins = get_admins()
-                    if is_bot:
-                        _ensure_admin_bot_rules_seed(user, contact_to_add)
-                    rules_text = _effective_rules_for_bot(contact_to_add, user) if is_bot else ""
-                    contact_data = {
-                        "user": contact_to_add,
-                        "blocked": 0,
-                        "online": is_online,
-                        "is_admin": contact_to_add in admins,
-                        "status_text": contact_status_text,
-                        "is_bot": bool(is_bot),
-                        "bot_origin": "local" if _is_virtual_bot(contact_to_add) else ("external" if is_bot else "user"),
-                        "bot_rules_available": bool(rules_text),
-                        "bot_rules_preview": rules_text[:1000] if rules_text else "",
-                        "bot_rules_editable": bool(is_bot and _is_admin(user)),
-                    }
-                    if _is_virtual_bot(contact_to_add) and str(contact_to_add).lower() == "openclaw-bot":
-                        token = _upsert_bot_token(user, contact_to_add)
-                        contact_data["bot_auth_token"] = token
-                        contact_data["bot_auth_type"] = "openclaw"
-                    sock.sendall((json.dumps({"action": "add_contact_success", "contact": contact_data}) + "\n").encode())
-                con.close()
+    elif action == "group_call_signal":
+        if not _can_user_use_feature(user, "group_call"):
+            _deny_feature("group_call", "group_call_signal_result")
+            return True
+        group = str(msg.get("group", "")).strip()
+        target = str(msg.get("to", "")).strip()
+        signal_type = str(msg.get("signal_type", "")).strip()
+        signal_data = msg.get("data", {})
+        if not group or not target:
+            return True
+        with group_call_lock:
+            data = group_call_sessions.get(group) or {}
+            participants = set(data.get("participants", set()))
+        if user not in participants or target not in participants:
+            try:
+                sock.send({"action": "group_call_signal_result", "ok": False, "reason": "Call participant not found."})
+            except Exception:
+                pass
+            return True
+        with lock:
+            target_sock = clients.get(target)
+        if not target_sock:
+            sock.send({"action": "group_call_signal_result", "ok": False, "reason": f"{target} is offline."})
+            return True
+        try:
+            target_sock.send({
+                "action": "group_call_signal",
+                "group": group,
+                "from": user,
+                "signal_type": signal_type,
+                "data": signal_data
+            })
+            sock.send({"action": "group_call_signal_result", "ok": True, "group": group, "to": target})
+        except Exception:
+            sock.send({"action": "group_call_signal_result", "ok": False, "reason": "Signal relay failed."})
 
-            elif action == "invite_user":
-                target_user = str(msg.get("username", "")).strip()
-                method = str(msg.get("method", "email")).strip().lower()
-                target = str(msg.get("target", "")).strip()
-                include_link = bool(msg.get("include_link", True))
-                if not target_user or not target:
-                    sock.sendall((json.dumps({
-                        "action": "invite_result",
-                        "ok": False,
-                        "method": method,
-                        "target": target,
-                        "reason": "Invite target username and destination are required."
-                    }) + "\n").encode())
-                    continue
-                if method not in ("email", "sms"):
-                    method = "email" if "@" in target else "sms"
-                invite_text = f"{user} invited you to join Thrive Messenger on {server_identity}."
-                if include_link:
-                    invite_text += " Visit https://im.tappedin.fm/ for setup and sign-in."
-                ok = False
-                reason = "Unsupported invite method."
-                if method == "email":
-                    ok = EmailManager.send_email(target, "You're invited to Thrive Messenger", invite_text)
-                    reason = "Invite email sent." if ok else "Email delivery is unavailable or failed."
-                elif method == "sms":
-                    ok, sms_reason = FlexPBXManager.send_sms(target, invite_text)
-                    reason = "Invite SMS sent." if ok else sms_reason
-                sock.sendall((json.dumps({
-                    "action": "invite_result",
-                    "ok": ok,
-                    "method": method,
-                    "target": target,
-                    "reason": reason
-                }) + "\n").encode())
-                
-            elif action in ("block_contact","unblock_contact"):
-                flag = 1 if action=="block_contact" else 0
-                con = sqlite3.connect(DB)
-                con.execute("UPDATE contacts SET blocked=? WHERE owner=? AND contact=?", (flag,user,msg["to"]))
-                con.commit()
-                con.close()
-                
-            elif action == "delete_contact":
-                deleted_name = msg["to"]
-                con = sqlite3.connect(DB)
-                con.execute("DELETE FROM contacts WHERE owner=? AND contact=?", (user,deleted_name))
-                con.commit()
-                con.close()
-                if _is_virtual_bot(deleted_name):
-                    _revoke_bot_token(user, deleted_name)
-                    try:
-                        sock.sendall((json.dumps({
-                            "action": "bot_token_revoked",
-                            "bot": deleted_name
-                        }) + "\n").encode())
-                    except Exception:
-                        pass
-                
-            elif action == "admin_cmd":
-                if not _can_user_use_feature(user, "admin_console"):
-                    response = "Error: Admin console is disabled for your account."
-                elif user not in get_admins(): 
-                    response = "Error: You are not authorized to use admin commands."
+    elif action == "msg":
+        to, frm = msg["to"], msg["from"]
+        if _is_registered_bot(to) and not _can_user_use_feature(user, "bots"):
+            sock.send({"action": "msg_failed", "to": to, "reason": "Bot messaging is disabled for your account."})
+            return True
+        recipient_has_blocked = block_cache.blocked(to, frm) == 1
+        sender_has_blocked = block_cache.blocked(frm, to) == 1
+
+        with lock: sock_to = clients.get(to)
+        reason = None
+        delivered = False
+        if recipient_has_blocked:
+            reason = f"Message couldn't be sent because {to} has you blocked."
+        elif sender_has_blocked: 
+            reason = "You have blocked this contact."
+        elif _maybe_send_bot_reply(sock, frm, to, msg.get("msg", "")):
+            reason = None
+        elif not sock_to: 
+            reason = f"{to} is offline."
+            if offline_config['enabled'] and _user_exists(to):
+                if _store_offline_message(to, user, str(msg.get("time", "")), str(msg.get("msg", ""))):
+                    reason = None
+                    delivered = True
                 else:
-                    cmd_parts = msg.get("cmd", "").split()
-                    command = cmd_parts[0].lower() if cmd_parts else ""
-                    if command == "exit" and len(cmd_parts) == 1:
-                        print(f"Shutdown initiated by admin: {user}")
-                        broadcast_alert(f"The server is shutting down in {shutdown_timeout} seconds.")
-                        time.sleep(shutdown_timeout)
-                        os._exit(0)
-                    elif command == "restart" and len(cmd_parts) == 1:
-                        response = f"Server is restarting in {shutdown_timeout} seconds..."
-                        _schedule_restart(shutdown_timeout, requested_by=user)
-                    elif command == "alert" and len(cmd_parts) >= 2:
-                        alert_message = " ".join(cmd_parts[1:])
-                        broadcast_alert(alert_message)
-                        response = "Alert sent to all online users."
-                    elif command == "create" and len(cmd_parts) in (3, 4):
-                        email = cmd_parts[3] if len(cmd_parts) == 4 else ""
-                        if handle_create(cmd_parts[1], cmd_parts[2], email):
-                            response = f"User '{cmd_parts[1]}' created."
-                        else:
-                            response = f"Error: Username '{cmd_parts[1]}' is already taken."
-                    elif command == "ban" and len(cmd_parts) >= 4: 
-                        handle_ban(cmd_parts[1], cmd_parts[2], " ".join(cmd_parts[3:]))
-                        response = f"User '{cmd_parts[1]}' banned."
-                    elif command == "unban" and len(cmd_parts) == 2: 
-                        handle_unban(cmd_parts[1])
-                        response = f"User '{cmd_parts[1]}' unbanned."
-                    elif command == "del" and len(cmd_parts) == 2: 
-                        handle_delete(cmd_parts[1])
-                        response = f"User '{cmd_parts[1]}' deleted."
-                    elif command == "admin" and len(cmd_parts) == 2: 
-                        add_admin(cmd_parts[1])
-                        response = f"User '{cmd_parts[1]}' is now an admin."
-                    elif command == "unadmin" and len(cmd_parts) == 2:
-                        remove_admin(cmd_parts[1])
-                        response = f"User '{cmd_parts[1]}' is no longer an admin."
-                    elif command == "banfile" and len(cmd_parts) >= 4:
-                        date_str = None
-                        try:
-                            datetime.datetime.strptime(cmd_parts[3], "%m/%d/%Y")
-                            date_str = cmd_parts[3]
-                            reason = " ".join(cmd_parts[4:]) if len(cmd_parts) >= 5 else "No reason given"
-                        except (ValueError, IndexError):
-                            reason = " ".join(cmd_parts[3:])
-                        handle_banfile(cmd_parts[1], cmd_parts[2], date_str, reason)
-                        if date_str:
-                            response = f"User '{cmd_parts[1]}' banned from sending '{cmd_parts[2]}' files until {date_str}."
-                        else:
-                            response = f"User '{cmd_parts[1]}' permanently banned from sending '{cmd_parts[2]}' files."
-                    elif command == "unbanfile" and len(cmd_parts) >= 2:
-                        file_type = cmd_parts[2] if len(cmd_parts) >= 3 else None
-                        handle_unbanfile(cmd_parts[1], file_type)
-                        if file_type:
-                            response = f"User '{cmd_parts[1]}' file ban for '{file_type}' removed."
-                        else:
-                            response = f"All file bans for user '{cmd_parts[1]}' removed."
-                    elif command == "gpolicy" and len(cmd_parts) >= 2:
-                        sub = cmd_parts[1].lower()
-                        if sub == "show":
-                            # /gpolicy show [group_name]
-                            target_group = cmd_parts[2] if len(cmd_parts) >= 3 else "__global__"
-                            scope = "group" if target_group != "__global__" else "global"
-                            policy = _fetch_group_policy(scope=scope, group_name=target_group)
-                            response = json.dumps({
-                                "scope": scope,
-                                "group": target_group,
-                                "policy": policy
-                            }, ensure_ascii=False)
-                        elif sub == "set" and len(cmd_parts) >= 4:
-                            # /gpolicy set key value [group_name]
-                            key = cmd_parts[2]
-                            value = cmd_parts[3]
-                            target_group = cmd_parts[4] if len(cmd_parts) >= 5 else "__global__"
-                            scope = "group" if target_group != "__global__" else "global"
-                            merged = _upsert_group_policy(scope=scope, group_name=target_group, updates={key: value}, updated_by=user)
-                            response = f"Group policy updated for {scope}:{target_group}. {key}={merged.get(key)}"
-                        elif sub == "reset":
-                            # /gpolicy reset [group_name]
-                            target_group = cmd_parts[2] if len(cmd_parts) >= 3 else "__global__"
-                            scope = "group" if target_group != "__global__" else "global"
-                            _reset_group_policy(scope=scope, group_name=target_group)
-                            response = f"Group policy reset for {scope}:{target_group}."
-                        elif sub == "keys":
-                            response = json.dumps(_policy_schema_payload(), ensure_ascii=False)
-                        else:
-                            response = "Error: gpolicy syntax: /gpolicy show [group], /gpolicy set <key> <value> [group], /gpolicy reset [group], /gpolicy keys"
-                    else:
-                        response = "Error: Unknown command or incorrect syntax."
-                try: sock.sendall((json.dumps({"action":"admin_response", "response": response})+"\n").encode())
-                except: pass
-
-            elif action == "schedule_restart":
-                if not _can_user_use_feature(user, "admin_console"):
-                    try:
-                        sock.sendall((json.dumps({"action": "admin_response", "response": "Error: Admin console is disabled for your account."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                if user not in get_admins():
-                    try:
-                        sock.sendall((json.dumps({"action": "admin_response", "response": "Error: You are not authorized to schedule restarts."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                try:
-                    delay = int(msg.get("seconds", shutdown_timeout))
-                except Exception:
-                    delay = shutdown_timeout
-                _schedule_restart(delay, requested_by=user)
-                try:
-                    sock.sendall((json.dumps({"action": "admin_response", "response": f"Server restart scheduled in {max(1, delay)} seconds."}) + "\n").encode())
-                except Exception:
-                    pass
-                
-            elif action == "server_info":
-                con = sqlite3.connect(DB)
-                total_users = con.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-                con.close()
-                with lock:
-                    online_count = len(clients)
-                    online_admins = sum(1 for uname in clients.keys() if uname in get_admins())
-                uptime_seconds = int(max(0, time.time() - server_started_at))
-                info = {
-                    "action": "server_info_response",
-                    "port": server_port,
-                    "ssl": use_ssl,
-                    "total_users": total_users,
-                    "online_users": online_count,
-                    "online_admin_users": online_admins,
-                    "uptime_seconds": uptime_seconds,
-                    "size_limit": file_config.get('size_limit', 0),
-                    "blackfiles": file_config.get('blackfiles', []),
-                    "max_status_length": max_status_length
-                }
-                try: sock.sendall((json.dumps(info) + "\n").encode())
-                except: pass
+                    reason = f"{to} is offline and can't receive any more messages until they log in."
+        else:
+            try: 
+                sock_to.send(msg)
+                reason = None
+                delivered = True
+            except: pass
+        if reason: 
+            sock.send({"action": "msg_failed", "to": to, "reason": reason})
+        elif delivered and history_config['enabled']:
+            _record_history(user, to, str(msg.get("time", "")), str(msg.get("msg", "")))
+
+    elif action == "typing":
+        to = msg.get("to")
+        typing = bool(msg.get("typing", False))
+        if not to:
+            return True
+        with lock:
+            sock_to = clients.get(to)
+        if sock_to:
+            try:
+                sock_to.send({"action": "typing", "from": user, "typing": typing})
+            except Exception:
+                pass
 
-            elif action == "user_directory":
-                con = sqlite3.connect(DB)
-                all_users = con.execute("SELECT username FROM users WHERE is_verified=1").fetchall()
-                user_contacts = {row[0]: row[1] for row in con.execute("SELECT contact, blocked FROM contacts WHERE owner=?", (user,)).fetchall()}
-                con.close()
-                admins = get_admins()
-                directory = []
-                include_bots = _can_user_use_feature(user, "bots")
-                known = {uname for (uname,) in all_users}
-                extra = set()
-                if include_bots:
-                    extra = set(bot_usernames) | set(bot_external_usernames)
-                for uname in sorted(known | extra):
-                    directory.append({
-                        "user": uname,
-                        "online": _is_online_user(uname),
-                        "status_text": _status_for_user(uname),
-                        "is_admin": uname in admins,
-                        "is_contact": uname in user_contacts,
-                        "is_blocked": user_contacts.get(uname, 0) == 1,
-                        "server": server_identity,
-                        "is_bot": _is_registered_bot(uname),
-                        "bot_origin": "local" if _is_virtual_bot(uname) else ("external" if _is_registered_bot(uname) else "user")
-                    })
-                try: sock.sendall((json.dumps({"action": "user_directory_response", "users": directory}) + "\n").encode())
-                except: pass
-
-            elif action == "get_bot_rules":
-                if not _can_user_use_feature(user, "bot_rules"):
-                    try:
-                        sock.sendall((json.dumps({"action": "bot_rules", "ok": False, "reason": "Bot rules are disabled for your account."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                bot_name = str(msg.get("bot", "")).strip()
-                if not bot_name or not _is_registered_bot(bot_name):
-                    try:
-                        sock.sendall((json.dumps({"action": "bot_rules", "ok": False, "reason": "Unknown bot."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                if _is_admin(user):
-                    _ensure_admin_bot_rules_seed(user, bot_name)
-                rules_text = _effective_rules_for_bot(bot_name, user)
-                try:
-                    sock.sendall((json.dumps({
-                        "action": "bot_rules",
-                        "ok": True,
-                        "bot": bot_name,
-                        "rules": rules_text,
-                        "rules_available": bool(rules_text),
-                        "editable": bool(_is_admin(user)),
-                        "scope": "admin_override" if (_is_admin(user) and bool(_get_admin_bot_rules(user, bot_name))) else "global",
-                    }) + "\n").encode())
-                except Exception:
-                    pass
-
-            elif action == "get_group_policy":
-                if not _can_user_use_feature(user, "group_policy"):
-                    try:
-                        sock.sendall((json.dumps({"action": "group_policy", "ok": False, "reason": "Group policy is disabled for your account."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                group_name = str(msg.get("group", "") or "").strip()
-                scope = "group" if group_name else "global"
-                policy = _fetch_group_policy(scope=scope, group_name=group_name or "__global__")
-                payload = {
-                    "action": "group_policy",
-                    "ok": True,
-                    "scope": scope,
-                    "group": group_name or "__global__",
-                    "policy": policy,
-                    "schema": _policy_schema_payload(),
-                    "editable": bool(user in get_admins()),
-                }
-                try:
-                    sock.sendall((json.dumps(payload) + "\n").encode())
-                except Exception:
-                    pass
-
-            elif action == "set_group_policy":
-                if not _can_user_use_feature(user, "group_policy"):
-                    try:
-                        sock.sendall((json.dumps({"action": "group_policy_update", "ok": False, "reason": "Group policy is disabled for your account."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                if user not in get_admins():
-                    try:
-                        sock.sendall((json.dumps({"action": "group_policy_update", "ok": False, "reason": "Admin only."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                group_name = str(msg.get("group", "") or "").strip()
-                scope = "group" if group_name else "global"
-                updates = msg.get("updates", {})
-                if not isinstance(updates, dict):
-                    try:
-                        sock.sendall((json.dumps({"action": "group_policy_update", "ok": False, "reason": "Invalid updates payload."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                try:
-                    merged = _upsert_group_policy(scope=scope, group_name=group_name or "__global__", updates=updates, updated_by=user)
-                    sock.sendall((json.dumps({
-                        "action": "group_policy_update",
-                        "ok": True,
-                        "scope": scope,
-                        "group": group_name or "__global__",
-                        "policy": merged
-                    }) + "\n").encode())
-                except Exception as e:
-                    try:
-                        sock.sendall((json.dumps({"action": "group_policy_update", "ok": False, "reason": str(e)}) + "\n").encode())
-                    except Exception:
-                        pass
-
-            elif action == "reset_group_policy":
-                if not _can_user_use_feature(user, "group_policy"):
-                    try:
-                        sock.sendall((json.dumps({"action": "group_policy_update", "ok": False, "reason": "Group policy is disabled for your account."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                if user not in get_admins():
-                    try:
-                        sock.sendall((json.dumps({"action": "group_policy_update", "ok": False, "reason": "Admin only."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                group_name = str(msg.get("group", "") or "").strip()
-                scope = "group" if group_name else "global"
-                _reset_group_policy(scope=scope, group_name=group_name or "__global__")
-                policy = _fetch_group_policy(scope=scope, group_name=group_name or "__global__")
-                try:
-                    sock.sendall((json.dumps({
-                        "action": "group_policy_update",
-                        "ok": True,
-                        "scope": scope,
-                        "group": group_name or "__global__",
-                        "policy": policy
-                    }) + "\n").encode())
-                except Exception:
-                    pass
-
-            elif action == "set_bot_rules":
-                if not _can_user_use_feature(user, "bot_rules"):
-                    try:
-                        sock.sendall((json.dumps({"action": "bot_rules_update", "ok": False, "reason": "Bot rules are disabled for your account."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                if not _is_admin(user):
-                    try:
-                        sock.sendall((json.dumps({"action": "bot_rules_update", "ok": False, "reason": "Admin only."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                bot_name = str(msg.get("bot", "")).strip()
-                rules_text = str(msg.get("rules", "") or "").strip()
-                if not bot_name or not _is_registered_bot(bot_name):
-                    try:
-                        sock.sendall((json.dumps({"action": "bot_rules_update", "ok": False, "reason": "Unknown bot."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                if len(rules_text) > 60000:
-                    rules_text = rules_text[:60000]
-                ok = _set_admin_bot_rules(user, bot_name, rules_text)
-                try:
-                    sock.sendall((json.dumps({
-                        "action": "bot_rules_update",
-                        "ok": bool(ok),
-                        "bot": bot_name,
-                        "scope": "admin_override",
-                        "rules_available": bool(rules_text),
-                    }) + "\n").encode())
-                except Exception:
-                    pass
-
-            elif action == "reset_bot_rules":
-                if not _can_user_use_feature(user, "bot_rules"):
-                    try:
-                        sock.sendall((json.dumps({"action": "bot_rules_update", "ok": False, "reason": "Bot rules are disabled for your account."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                if not _is_admin(user):
-                    try:
-                        sock.sendall((json.dumps({"action": "bot_rules_update", "ok": False, "reason": "Admin only."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                bot_name = str(msg.get("bot", "")).strip()
-                if not bot_name or not _is_registered_bot(bot_name):
-                    try:
-                        sock.sendall((json.dumps({"action": "bot_rules_update", "ok": False, "reason": "Unknown bot."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                _clear_admin_bot_rules(user, bot_name)
-                _ensure_admin_bot_rules_seed(user, bot_name)
-                try:
-                    sock.sendall((json.dumps({
-                        "action": "bot_rules_update",
-                        "ok": True,
-                        "bot": bot_name,
-                        "scope": "global_seeded",
-                        "rules_available": bool(_effective_rules_for_bot(bot_name, user)),
-                    }) + "\n").encode())
-                except Exception:
-                    pass
+    elif action == "file_offer":
+        to = msg["to"]
+        files = msg.get("files", [])
+        # Reject any filename containing a path separator (OS-independent check)
+        bad = next((f["filename"] for f in files if '/' in f["filename"] or '\\' in f["filename"]), None)
+        if bad:
+            sock.send({"action": "file_offer_failed", "to": to, "reason": f"Invalid filename: '{bad}'"})
+            return True
 
-            elif action == "group_call_list":
-                if not _can_user_use_feature(user, "group_call"):
-                    _deny_feature("group_call", "group_call_list_response")
-                    continue
-                rows = []
-                with group_call_lock:
-                    for g in sorted(group_call_sessions.keys()):
-                        snap = _group_call_snapshot(g)
-                        rows.append(snap)
-                try:
-                    sock.sendall((json.dumps({"action": "group_call_list_response", "calls": rows}) + "\n").encode())
-                except Exception:
-                    pass
+        # Check if recipient is online
+        with lock: sock_to = clients.get(to)
+        if not sock_to:
+            sock.send({"action": "file_offer_failed", "to": to, "reason": f"{to} is offline."})
+            return True
 
-            elif action == "group_call_join":
-                if not _can_user_use_feature(user, "group_call"):
-                    _deny_feature("group_call", "group_call_result")
-                    continue
-                group = str(msg.get("group", "")).strip()
-                mode = str(msg.get("mode", "voice") or "voice").strip().lower()
-                if mode not in ("voice", "video"):
-                    mode = "voice"
-                if not group:
-                    try:
-                        sock.sendall((json.dumps({"action": "group_call_result", "ok": False, "reason": "Missing group name."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                # Enforce global/group call policy when configured.
-                policy = _fetch_group_policy(scope="global", group_name="__global__")
-                if mode == "voice" and not policy.get("allow_group_voice", True):
-                    sock.sendall((json.dumps({"action": "group_call_result", "ok": False, "group": group, "reason": "Group voice calls are disabled."}) + "\n").encode())
-                    continue
-                if mode == "video" and not policy.get("allow_group_video", True):
-                    sock.sendall((json.dumps({"action": "group_call_result", "ok": False, "group": group, "reason": "Group video calls are disabled."}) + "\n").encode())
-                    continue
-                with group_call_lock:
-                    data = group_call_sessions.setdefault(group, {"mode": mode, "participants": set()})
-                    if data.get("mode") != mode and data.get("participants"):
-                        mode = data.get("mode", "voice")
-                    data["mode"] = mode
-                    max_voice = int(policy.get("max_group_concurrent_voice", 40) or 40)
-                    if len(data["participants"]) >= max_voice and user not in data["participants"]:
-                        sock.sendall((json.dumps({"action": "group_call_result", "ok": False, "group": group, "reason": "Group call participant limit reached."}) + "\n").encode())
-                        continue
-                    data["participants"].add(user)
-                payload = {"action": "group_call_event", "event": "join", "by": user}
-                payload.update(_group_call_snapshot(group))
-                _group_call_broadcast(group, payload)
-                try:
-                    sock.sendall((json.dumps({"action": "group_call_result", "ok": True, "group": group}) + "\n").encode())
-                except Exception:
-                    pass
+        # Check if recipient has blocked sender
+        if block_cache.blocked(to, user) == 1:
+            sock.send({"action": "file_offer_failed", "to": to, "reason": f"{to} has you blocked."})
+            return True
 
-            elif action == "group_call_leave":
-                if not _can_user_use_feature(user, "group_call"):
-                    _deny_feature("group_call", "group_call_result")
-                    continue
-                group = str(msg.get("group", "")).strip()
-                if not group:
-                    continue
-                with group_call_lock:
-                    data = group_call_sessions.get(group)
-                    if not data:
-                        pass
-                    else:
-                        data.get("participants", set()).discard(user)
-                        if not data.get("participants"):
-                            group_call_sessions.pop(group, None)
-                payload = {"action": "group_call_event", "event": "leave", "by": user}
-                payload.update(_group_call_snapshot(group))
-                _group_call_broadcast(group, payload, exclude=user)
-                try:
-                    sock.sendall((json.dumps({"action": "group_call_result", "ok": True, "group": group}) + "\n").encode())
-                except Exception:
-                    pass
+        # Check each file against server rules
+        limit = file_config.get('size_limit', 0)
+        blackfiles = file_config.get('blackfiles', [])
+        blocked = False
+        for finfo in files:
+            fname = finfo["filename"]
+            fsize = finfo.get("size", 0)
+            file_ext = fname.rsplit('.', 1)[-1].lower() if '.' in fname else ''
+            if file_ext in blackfiles:
+                sock.send({"action": "file_offer_failed", "to": to, "reason": f"File type '.{file_ext}' is not allowed by the server."})
+                blocked = True; break
+            if limit > 0 and fsize > limit:
+                sock.send({"action": "file_offer_failed", "to": to, "reason": f"File '{fname}' exceeds server size limit of {limit} bytes."})
+                blocked = True; break
+            ban_reason = check_file_ban(user, file_ext)
+            if ban_reason is None and file_ext:
+                ban_reason = check_file_ban(user, '*')
+            if ban_reason:
+                sock.send({"action": "file_offer_failed", "to": to, "reason": f"You are banned from sending '{fname}': {ban_reason}"})
+                blocked = True; break
+        if blocked: return True
+
+        # All checks passed, create transfer and forward offer
+        client_transfer_id = msg.get("transfer_id", "")  # echo back so sender can locate its pending files
+        transfer_id = str(uuid.uuid4())  # always server-generated; never trust client-supplied ID
+        _transfer_put(transfer_id, {"from": user, "to": to, "files": files, "client_transfer_id": client_transfer_id})
 
-            elif action == "group_call_signal":
-                if not _can_user_use_feature(user, "group_call"):
-                    _deny_feature("group_call", "group_call_signal_result")
-                    continue
-                group = str(msg.get("group", "")).strip()
-                target = str(msg.get("to", "")).strip()
-                signal_type = str(msg.get("signal_type", "")).strip()
-                signal_data = msg.get("data", {})
-                if not group or not target:
-                    continue
-                with group_call_lock:
-                    data = group_call_sessions.get(group) or {}
-                    participants = set(data.get("participants", set()))
-                if user not in participants or target not in participants:
-                    try:
-                        sock.sendall((json.dumps({"action": "group_call_signal_result", "ok": False, "reason": "Call participant not found."}) + "\n").encode())
-                    except Exception:
-                        pass
-                    continue
-                with lock:
-                    target_sock = clients.get(target)
-                if not target_sock:
-                    sock.sendall((json.dumps({"action": "group_call_signal_result", "ok": False, "reason": f"{target} is offline."}) + "\n").encode())
-                    continue
-                try:
-                    target_sock.sendall((json.dumps({
-                        "action": "group_call_signal",
-                        "group": group,
-                        "from": user,
-                        "signal_type": signal_type,
-                        "data": signal_data
-                    }) + "\n").encode())
-                    sock.sendall((json.dumps({"action": "group_call_signal_result", "ok": True, "group": group, "to": target}) + "\n").encode())
-                except Exception:
-                    sock.sendall((json.dumps({"action": "group_call_signal_result", "ok": False, "reason": "Signal relay failed."}) + "\n").encode())
+        try:
+            sock_to.send({"action": "file_offer", "from": user, "files": files, "transfer_id": transfer_id})
+        except:
+            sock.send({"action": "file_offer_failed", "to": to, "reason": f"Failed to send offer to {to}."})
+            _transfer_pop(transfer_id)
+
+    elif action == "file_accept":
+        transfer_id = msg["transfer_id"]
+        with transfer_lock: transfer = pending_transfers.get(transfer_id)
+        if not transfer: return True
+        if transfer["to"] != user: return True
+        file_token = str(uuid.uuid4())
+        transfer = dict(transfer, file_token=file_token)
+        _transfer_put(transfer_id, transfer)
+        sender = transfer["from"]
+        with lock: sock_sender = clients.get(sender)
+        if sock_sender:
+            try: sock_sender.send({"action": "file_accepted", "transfer_id": transfer_id, "client_transfer_id": transfer.get("client_transfer_id", ""), "to": transfer["to"], "files": transfer["files"], "file_token": file_token})
+            except: pass
 
-            elif action == "msg":
-                to, frm = msg["to"], msg["from"]
-                if _is_registered_bot(to) and not _can_user_use_feature(user, "bots"):
-                    sock.sendall(json.dumps({"action": "msg_failed", "to": to, "reason": "Bot messaging is disabled for your account."}).encode() + b"\n")
-                    continue
-                con = sqlite3.connect(DB)
-                recipient_has_blocked = con.execute("SELECT blocked FROM contacts WHERE owner=? AND contact=?", (to, frm)).fetchone()
-                sender_has_blocked = con.execute("SELECT blocked FROM contacts WHERE owner=? AND contact=?", (frm, to)).fetchone()
-                con.close()
-                
-                with lock: sock_to = clients.get(to)
-                reason = None
-                if recipient_has_blocked and recipient_has_blocked[0] == 1:
-                    reason = f"Message couldn't be sent because {to} has you blocked."
-                elif sender_has_blocked and sender_has_blocked[0] == 1: 
-                    reason = "You have blocked this contact."
-                elif _maybe_send_bot_reply(sock, frm, to, msg.get("msg", "")):
-                    reason = None
-                elif not sock_to: 
-                    reason = f"{to} is offline."
-                else:
-                    try: 
-                        sock_to.sendall((json.dumps(msg)+"\n").encode())
-                        reason = None
-                    except: pass
-                if reason: 
-                    sock.sendall(json.dumps({"action": "msg_failed", "to": to, "reason": reason}).encode() + b"\n")
-
-            elif action == "typing":
-                to = msg.get("to")
-                typing = bool(msg.get("typing", False))
-                if not to:
-                    continue
-                with lock:
-                    sock_to = clients.get(to)
-                if sock_to:
-                    try:
-                        sock_to.sendall((json.dumps({"action": "typing", "from": user, "typing": typing}) + "\n").encode())
-                    except Exception:
-                        pass
-                    
-            elif action == "file_offer":
-                to = msg["to"]
-                files = msg.get("files", [])
-                # Reject any filename containing a path separator (OS-independent check)
-                bad = next((f["filename"] for f in files if '/' in f["filename"] or '\\' in f["filename"]), None)
-                if bad:
-                    sock.sendall((json.dumps({"action": "file_offer_failed", "to": to, "reason": f"Invalid filename: '{bad}'"}) + "\n").encode())
-                    continue
+    elif action == "file_decline":
+        transfer_id = msg["transfer_id"]
+        transfer = _transfer_pop(transfer_id)
+        if not transfer: return True
+        sender = transfer["from"]
+        with lock: sock_sender = clients.get(sender)
+        if sock_sender:
+            try: sock_sender.send({"action": "file_declined", "transfer_id": transfer_id, "client_transfer_id": transfer.get("client_transfer_id", ""), "to": transfer["to"], "files": transfer["files"]})
+            except: pass
 
-                # Check if recipient is online
-                with lock: sock_to = clients.get(to)
-                if not sock_to:
-                    sock.sendall((json.dumps({"action": "file_offer_failed", "to": to, "reason": f"{to} is offline."}) + "\n").encode())
-                    continue
+    elif action == "set_status":
+        status_text = msg.get("status_text", "online")[:max_status_length]
+        with lock: client_statuses[user] = status_text
+        broadcast_contact_status(user, True)
 
-                # Check if recipient has blocked sender
-                con = sqlite3.connect(DB)
-                recipient_has_blocked = con.execute("SELECT blocked FROM contacts WHERE owner=? AND contact=?", (to, user)).fetchone()
-                con.close()
-                if recipient_has_blocked and recipient_has_blocked[0] == 1:
-                    sock.sendall((json.dumps({"action": "file_offer_failed", "to": to, "reason": f"{to} has you blocked."}) + "\n").encode())
-                    continue
+    elif action == "change_password":
+        cur_pass = msg.get("current_pass", "")
+        new_pass = msg.get("new_pass", "")
+        if not cur_pass or not new_pass:
+            sock.send({"action": "change_password_result", "ok": False, "reason": "Missing fields."})
+        else:
+            con = _db_connect()
+            row = con.execute("SELECT password FROM users WHERE username=?", (user,)).fetchone()
+            con.close()
+            stored = row[0] if row else None
+            try:
+                ok = bool(stored) and verify_password(stored, cur_pass)[0]
+                hashed = hash_password(new_pass) if ok else None
+            except _ServerBusy as e:
+                sock.send(e.reply(action="change_password_result", ok=False))
+                return True
+            if ok:
+                db_writer.execute("UPDATE users SET password=? WHERE username=?", (hashed, user))
+                session_tokens.revoke_user(user)
+                sock.send({"action": "change_password_result", "ok": True})
+            else:
+                sock.send({"action": "change_password_result", "ok": False, "reason": "Current password is incorrect."})
 
-                # Check each file against server rules
-                limit = file_config.get('size_limit', 0)
-                blackfiles = file_config.get('blackfiles', [])
-                blocked = False
-                for finfo in files:
-                    fname = finfo["filename"]
-                    fsize = finfo.get("size", 0)
-                    file_ext = fname.rsplit('.', 1)[-1].lower() if '.' in fname else ''
-                    if file_ext in blackfiles:
-                        sock.sendall((json.dumps({"action": "file_offer_failed", "to": to, "reason": f"File type '.{file_ext}' is not allowed by the server."}) + "\n").encode())
-                        blocked = True; break
-                    if limit > 0 and fsize > limit:
-                        sock.sendall((json.dumps({"action": "file_offer_failed", "to": to, "reason": f"File '{fname}' exceeds server size limit of {limit} bytes."}) + "\n").encode())
-                        blocked = True; break
-                    ban_reason = check_file_ban(user, file_ext)
-                    if ban_reason is None and file_ext:
-                        ban_reason = check_file_ban(user, '*')
-                    if ban_reason:
-                        sock.sendall((json.dumps({"action": "file_offer_failed", "to": to, "reason": f"You are banned from sending '{fname}': {ban_reason}"}) + "\n").encode())
-                        blocked = True; break
-                if blocked: continue
-
-                # All checks passed, create transfer and forward offer
-                client_transfer_id = msg.get("transfer_id", "")  # echo back so sender can locate its pending files
-                transfer_id = str(uuid.uuid4())  # always server-generated; never trust client-supplied ID
-                with transfer_lock:
-                    pending_transfers[transfer_id] = {"from": user, "to": to, "files": files, "client_transfer_id": client_transfer_id}
+    elif action == "logout":
+        # Logging out ends this device's resumable session too.
+        if sock.resume_digest:
+            session_tokens.revoke(sock.resume_digest)
+        _settle_offline_messages(sock, user)
+        return False
+    return True
 
-                try:
-                    sock_to.sendall((json.dumps({"action": "file_offer", "from": user, "files": files, "transfer_id": transfer_id}) + "\n").encode())
-                except:
-                    sock.sendall((json.dumps({"action": "file_offer_failed", "to": to, "reason": f"Failed to send offer to {to}."}) + "\n").encode())
-                    with transfer_lock: pending_transfers.pop(transfer_id, None)
-
-            elif action == "file_accept":
-                transfer_id = msg["transfer_id"]
-                with transfer_lock: transfer = pending_transfers.get(transfer_id)
-                if not transfer: continue
-                if transfer["to"] != user: continue
-                file_token = str(uuid.uuid4())
-                with transfer_lock: transfer["file_token"] = file_token
-                sender = transfer["from"]
-                with lock: sock_sender = clients.get(sender)
-                if sock_sender:
-                    try: sock_sender.sendall((json.dumps({"action": "file_accepted", "transfer_id": transfer_id, "client_transfer_id": transfer.get("client_transfer_id", ""), "to": transfer["to"], "files": transfer["files"], "file_token": file_token}) + "\n").encode())
-                    except: pass
-
-            elif action == "file_decline":
-                transfer_id = msg["transfer_id"]
-                with transfer_lock: transfer = pending_transfers.pop(transfer_id, None)
-                if not transfer: continue
-                sender = transfer["from"]
-                with lock: sock_sender = clients.get(sender)
-                if sock_sender:
-                    try: sock_sender.sendall((json.dumps({"action": "file_declined", "transfer_id": transfer_id, "client_transfer_id": transfer.get("client_transfer_id", ""), "to": transfer["to"], "files": transfer["files"]}) + "\n").encode())
-                    except: pass
-
-            elif action == "set_status":
-                status_text = msg.get("status_text", "online")[:max_status_length]
-                with lock: client_statuses[user] = status_text
-                broadcast_contact_status(user, True)
-
-            elif action == "change_password":
-                cur_pass = msg.get("current_pass", "")
-                new_pass = msg.get("new_pass", "")
-                if not cur_pass or not new_pass:
-                    sock.sendall((json.dumps({"action": "change_password_result", "ok": False, "reason": "Missing fields."}) + "\n").encode())
-                else:
-                    con = sqlite3.connect(DB)
-                    row = con.execute("SELECT password FROM users WHERE username=?", (user,)).fetchone()
-                    stored = row[0] if row else None
-                    ok = False
-                    if stored:
-                        try: _ph.verify(stored, cur_pass); ok = True
-                        except (VerifyMismatchError, VerificationError, InvalidHashError): pass
-                    if ok:
-                        con.execute("UPDATE users SET password=? WHERE username=?", (_ph.hash(new_pass), user))
-                        con.commit(); con.close()
-                        sock.sendall((json.dumps({"action": "change_password_result", "ok": True}) + "\n").encode())
-                    else:
-                        con.close()
-                        sock.sendall((json.dumps({"action": "change_password_result", "ok": False, "reason": "Current password is incorrect."}) + "\n").encode())
+def handle_client(cs, addr):
+    sock = _ThreadedSession(cs, addr)
+    f = cs.makefile("rb")
+    user = None
+    try:
+        try:
+            line = f.readline()
+            if not line: return 
+            req = json.loads(line)
+        except (UnicodeDecodeError, json.JSONDecodeError): return
+
+        if not _admit_login(sock, req): return
+        user = _handle_handshake(sock, req)
+        if not user: return
+        _negotiate_caps(sock, req)
+        _start_session(sock, user)
 
-            elif action == "logout": break
+        while True:
+            msg = _read_frame(f, sock.codec)
+            if msg is None:
+                if not sock.closing: _settle_offline_messages(sock, user)
+                break
+            if not _dispatch_timed(sock, user, msg): break
     except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError, OSError):
         pass
     except Exception as e:
         print(f"Unhandled error in handle_client for {addr}: {e}")
-        try: cs.sendall((json.dumps({"status": "error", "reason": "Internal server error."}) + "\n").encode())
+        try: sock.send({"status": "error", "reason": "Internal server error."})
         except: pass
     finally:
-        try: cs.close()
-        except: pass
-        with lock:
-            if user in clients: del clients[user]
-            client_statuses.pop(user, None)
-        if user:
-            _remove_user_from_all_group_calls(user)
-            broadcast_contact_status(user, False)
+        _end_session(sock, user)
+        _release_connection()
+
+def _transfer_put(transfer_id, transfer):
+    with transfer_lock:
+        pending_transfers[transfer_id] = transfer
+    _bus_publish({"t": "state", "kind": "transfer_set", "id": transfer_id, "transfer": transfer})
+
+def _transfer_pop(transfer_id):
+    with transfer_lock:
+        transfer = pending_transfers.pop(transfer_id, None)
+    if transfer is not None:
+        _bus_publish({"t": "state", "kind": "transfer_pop", "id": transfer_id})
+    return transfer
 
 def check_file_ban(username, file_ext):
-    con = sqlite3.connect(DB)
+    con = _db_connect()
     row = con.execute("SELECT reason FROM file_bans WHERE username=? AND (file_type=? OR file_type='*') AND (until_date IS NULL OR until_date >= ?)",
                        (username, file_ext.lower(), datetime.datetime.now().strftime("%Y-%m-%d"))).fetchone()
     con.close()
@@ -2219,11 +4338,8 @@ def handle_banfile(username, file_type, date_str, reason):
         until_date = None
         if date_str:
             until_date = datetime.datetime.strptime(date_str, "%m/%d/%Y").strftime("%Y-%m-%d")
-        con = sqlite3.connect(DB)
-        con.execute("INSERT OR REPLACE INTO file_bans(username, file_type, until_date, reason) VALUES(?,?,?,?)",
-                     (username, file_type.lower(), until_date, reason))
-        con.commit()
-        con.close()
+        db_writer.execute("INSERT OR REPLACE INTO file_bans(username, file_type, until_date, reason) VALUES(?,?,?,?)",
+                          (username, file_type.lower(), until_date, reason))
         if until_date:
             print(f"User '{username}' banned from sending '{file_type}' files until {until_date}: {reason}")
         else:
@@ -2232,19 +4348,16 @@ def handle_banfile(username, file_type, date_str, reason):
     except Exception as e: print(f"An error occurred: {e}")
 
 def handle_unbanfile(username, file_type=None):
-    con = sqlite3.connect(DB)
     if file_type:
-        con.execute("DELETE FROM file_bans WHERE username=? AND file_type=?", (username, file_type.lower()))
+        db_writer.execute("DELETE FROM file_bans WHERE username=? AND file_type=?", (username, file_type.lower()))
     else:
-        con.execute("DELETE FROM file_bans WHERE username=?", (username,))
-    con.commit()
-    con.close()
+        db_writer.execute("DELETE FROM file_bans WHERE username=?", (username,))
     if file_type:
         print(f"User '{username}' file ban for '{file_type}' removed.")
     else:
         print(f"All file bans for user '{username}' removed.")
 
-def serve_loop(config):
+def _create_server_ssl_context(config):
     global use_ssl
     context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     use_ssl = False
@@ -2252,6 +4365,8 @@ def serve_loop(config):
     print(f"Server Current Working Directory: {os.getcwd()}")
     try:
         context.load_cert_chain(certfile=config['certfile'], keyfile=config['keyfile'])
+        # TLS 1.3 tickets let a reconnecting client skip the certificate and key exchange work.
+        context.num_tickets = config.get('tls_session_tickets', 2)
         use_ssl = True
         print(f"Secure (SSL) server listening on port {config['port']}...")
     except (FileNotFoundError, ssl.SSLError) as e:
@@ -2259,76 +4374,684 @@ def serve_loop(config):
         print(f"Looking for Cert: {os.path.abspath(config['certfile'])}")
         print(f"Looking for Key:  {os.path.abspath(config['keyfile'])}")
         print(f"Server running in INSECURE (UNENCRYPTED) mode on port {config['port']}...")
+    return context
+
+def _admit_connection():
+    """Reserve a connection slot, or return False once max_connections are open."""
+    global open_connections
+    with connections_lock:
+        limit = connection_config.get('max_connections', 0)
+        if limit and open_connections >= limit:
+            return False
+        open_connections += 1
+        return True
+
+def _release_connection():
+    global open_connections
+    with connections_lock:
+        open_connections = max(0, open_connections - 1)
+
+def _reject_connection(sock, close=None):
+    # Reset instead of a graceful close: no TLS work and no TIME_WAIT for connections we refuse.
+    # asyncio hands out a TransportSocket, which can't be closed itself; pass the
+    # transport's abort as close.
+    metrics.mark("accept.rejected")
+    try: sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+    except (OSError, AttributeError): pass
+    try: (close or sock.close)()
+    except OSError: pass
+
+metrics.gauge("connections.open", lambda: open_connections)
+
+tls_handshakes = {"full": 0, "resumed": 0}
+metrics.gauge("tls.resumption_rate", lambda: round(tls_handshakes["resumed"] / max(1, tls_handshakes["full"] + tls_handshakes["resumed"]), 3))
+
+def _note_tls_handshake(ssl_object):
+    kind = "resumed" if ssl_object is not None and ssl_object.session_reused else "full"
+    metrics.incr(f"tls.handshakes_{kind}")
+    with connections_lock:
+        tls_handshakes[kind] += 1
+        full, resumed = tls_handshakes["full"], tls_handshakes["resumed"]
+    if (full + resumed) % 1000 == 0:
+        print(f"TLS session resumption: {resumed} of {full + resumed} handshakes resumed ({100.0 * resumed / (full + resumed):.1f}%).")
+
+def _start_client_thread(connstream, fromaddr):
+    try:
+        threading.Thread(target=handle_client, args=(connstream, fromaddr), daemon=True).start()
+    except Exception as e:
+        print(f"Error accepting connection from {fromaddr}: {e}")
+        connstream.close()
+        _release_connection()
+
+def _handshake_and_serve(context, newsocket, fromaddr, accepted_at):
+    timeout = connection_config.get('handshake_timeout', 10.0)
+    waited = time.monotonic() - accepted_at
+    metrics.observe("accept.queue_wait_ms", waited * 1000.0)
+    try:
+        if waited >= timeout:
+            raise socket.timeout("waited too long for a handshake worker")
+        if use_ssl:
+            started = time.perf_counter()
+            newsocket.settimeout(timeout - waited)
+            connstream = context.wrap_socket(newsocket, server_side=True)
+            connstream.settimeout(None)
+            metrics.observe("tls.handshake_ms", (time.perf_counter() - started) * 1000.0)
+            _note_tls_handshake(connstream)
+        else:
+            connstream = newsocket
+        _start_client_thread(connstream, fromaddr)
+        return
+    except socket.timeout:
+        metrics.incr("tls.handshake_timeouts")
+    except ssl.SSLError as e:
+        metrics.incr("tls.handshake_failures")
+        print(f"SSL Error from {fromaddr}: {e}. Probably a port scan. Ignoring.")
+    except Exception as e:
+        metrics.incr("tls.handshake_failures")
+        print(f"Error accepting connection from {fromaddr}: {e}")
+    try: newsocket.close()
+    except OSError: pass
+    _release_connection()
+
+def serve_loop(config):
+    context = _create_server_ssl_context(config)
+    # TLS handshakes run on a bounded pool so a slow or silent peer never holds up accept().
+    # A socket is only handed to a worker once its ClientHello has arrived, so connections
+    # that never speak cost a selector entry rather than a worker until handshake_timeout.
+    handshake_pool = ThreadPoolExecutor(max_workers=config['handshake_workers'], thread_name_prefix="handshake")
 
     bindsocket = socket.socket()
     bindsocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if worker_id:
+        bindsocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     bindsocket.bind(("0.0.0.0", config['port']))
-    bindsocket.listen(5)
+    bindsocket.listen(config['listen_backlog'])
+    selector = selectors.DefaultSelector()
+    selector.register(bindsocket, selectors.EVENT_READ)
+    pending = {}
     
     while True:
         try:
-            newsocket, fromaddr = bindsocket.accept()
-            try:
-                if use_ssl:
-                    connstream = context.wrap_socket(newsocket, server_side=True)
-                else:
-                    connstream = newsocket
-                
-                threading.Thread(target=handle_client, args=(connstream, fromaddr), daemon=True).start()
-            except ssl.SSLError as e: 
-                print(f"SSL Error from {fromaddr}: {e}. Probably a port scan. Ignoring.")
-                newsocket.close()
-            except Exception as e: 
-                print(f"Error accepting connection from {fromaddr}: {e}")
-                newsocket.close()
+            for key, _ in selector.select(timeout=1.0):
+                if key.fileobj is bindsocket:
+                    newsocket, fromaddr = bindsocket.accept()
+                    metrics.mark("accept.accepted")
+                    if not _admit_connection():
+                        _reject_connection(newsocket)
+                    elif not use_ssl:
+                        _start_client_thread(newsocket, fromaddr)
+                    else:
+                        pending[newsocket] = (fromaddr, time.monotonic())
+                        selector.register(newsocket, selectors.EVENT_READ)
+                    continue
+                newsocket = key.fileobj
+                selector.unregister(newsocket)
+                fromaddr, accepted_at = pending.pop(newsocket)
+                try:
+                    handshake_pool.submit(_handshake_and_serve, context, newsocket, fromaddr, accepted_at)
+                except Exception as e: 
+                    print(f"Error accepting connection from {fromaddr}: {e}")
+                    newsocket.close()
+                    _release_connection()
+            if pending:
+                cutoff = time.monotonic() - connection_config.get('handshake_timeout', 10.0)
+                for newsocket, (fromaddr, accepted_at) in list(pending.items()):
+                    if accepted_at < cutoff:
+                        del pending[newsocket]
+                        selector.unregister(newsocket)
+                        metrics.incr("tls.handshake_timeouts")
+                        newsocket.close()
+                        _release_connection()
         except Exception as e: 
             print(f"Critical error in main serve_loop: {e}")
-            import time
+            time.sleep(1)
+
+class _AsyncioSession(ClientSession):
+    # Frames are produced on executor threads; the writer is a task on the event loop.
+    def __init__(self, loop, writer, addr):
+        super().__init__(addr)
+        self._loop = loop
+        self._writer = writer
+        self._event = asyncio.Event()
+        self._task = loop.create_task(self._writer_task())
+        raw = writer.get_extra_info("socket")
+        if raw is not None:
+            _set_keepalive(raw)
+
+    def _wake(self):
+        try: self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError: pass
+
+    async def _writer_task(self):
+        try:
+            while True:
+                await self._event.wait()
+                self._event.clear()
+                while True:
+                    with self._lock:
+                        batch, data, compress = self._take_batch()
+                        closing = self._closing
+                    if not batch:
+                        break
+                    if compress:
+                        data = self._deflate(data)
+                    self._writer.write(data)
+                    await asyncio.wait_for(self._writer.drain(), self.write_timeout)
+                    self._record_write(len(batch), len(data))
+                if closing:
+                    break
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            self._writer_stopped()
+            self._writer.close()
+
+    def _close_transport(self):
+        try: self._loop.call_soon_threadsafe(self._writer.close)
+        except RuntimeError: pass
+
+def _asyncio_pool_for(msg):
+    # Ollama replies can take many seconds, so they get their own pool and can never
+    # starve ordinary SQLite-bound actions; password work shares the login pool.
+    action = msg.get("action")
+    if action == "msg" and _is_virtual_bot(msg.get("to")):
+        return "bot"
+    if action == "change_password":
+        return "auth"
+    return "dispatch"
+
+async def _asyncio_start_tls(writer, context, addr):
+    timeout = connection_config.get('handshake_timeout', 10.0)
+    started = time.perf_counter()
+    try:
+        async with asyncio.timeout(timeout):
+            await writer.start_tls(context)
+        metrics.observe("tls.handshake_ms", (time.perf_counter() - started) * 1000.0)
+        _note_tls_handshake(writer.get_extra_info("ssl_object"))
+        return True
+    except TimeoutError:
+        metrics.incr("tls.handshake_timeouts")
+    except ssl.SSLError as e:
+        metrics.incr("tls.handshake_failures")
+        print(f"SSL Error from {addr}: {e}. Probably a port scan. Ignoring.")
+    except (ConnectionError, OSError):
+        metrics.incr("tls.handshake_failures")
+    writer.transport.abort()
+    return False
+
+async def _asyncio_handle_client(reader, writer, context=None):
+    loop = asyncio.get_running_loop()
+    addr = writer.get_extra_info("peername")
+    metrics.mark("accept.accepted")
+    if not _admit_connection():
+        _reject_connection(writer.get_extra_info("socket"), close=writer.transport.abort)
+        return
+    if context is not None and not await _asyncio_start_tls(writer, context, addr):
+        _release_connection()
+        return
+    conn = _AsyncioSession(loop, writer, addr)
+    user = None
+    try:
+        try:
+            line = await reader.readline()
+            if not line: return
+            req = json.loads(line)
+        except (UnicodeDecodeError, json.JSONDecodeError): return
+
+        if not _admit_login(conn, req): return
+        user = await loop.run_in_executor(engine_pools["auth"], _handle_handshake, conn, req)
+        if not user: return
+        _negotiate_caps(conn, req)
+        await loop.run_in_executor(engine_pools["dispatch"], _start_session, conn, user)
+
+        while True:
+            msg = await _read_frame_async(reader, conn.codec)
+            if msg is None:
+                if not conn.closing:
+                    await loop.run_in_executor(engine_pools["dispatch"], _settle_offline_messages, conn, user)
+                break
+            keep = await loop.run_in_executor(engine_pools[_asyncio_pool_for(msg)], _dispatch_timed, conn, user, msg)
+            if not keep: break
+    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError, OSError):
+        pass
+    except Exception as e:
+        print(f"Unhandled error in handle_client for {addr}: {e}")
+        try: conn.send({"status": "error", "reason": "Internal server error."})
+        except: pass
+    finally:
+        await loop.run_in_executor(engine_pools["dispatch"], _end_session, conn, user)
+        _release_connection()
+
+async def _read_frame_async(reader, codec):
+    if codec == "msgpack":
+        try:
+            header = await reader.readexactly(FRAME_HEADER.size)
+            flags, length = FRAME_HEADER.unpack(header)
+            if length > _max_frame_bytes():
+                raise ValueError(f"Frame of {length} bytes is over the limit")
+            body = await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            return None
+        return _decode_frame_body(flags, body)
+    line = await reader.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+async def _asyncio_serve(config, context):
+    # Lines are unbounded in the threaded engine; keep the same ceiling as binary frames.
+    limit = _max_frame_bytes()
+    # TLS is started per connection, after the max_connections check, so refused
+    # connections cost no handshake.
+    tls = context if use_ssl else None
+    server = await asyncio.start_server(
+        lambda reader, writer: _asyncio_handle_client(reader, writer, tls),
+        host="0.0.0.0",
+        port=config['port'],
+        limit=limit,
+        backlog=config['listen_backlog'],
+        reuse_address=True,
+        reuse_port=bool(worker_id),
+    )
+    async with server:
+        await server.serve_forever()
+
+def serve_loop_asyncio(config):
+    context = _create_server_ssl_context(config)
+    engine_pools["dispatch"] = ThreadPoolExecutor(max_workers=config['executor_workers'], thread_name_prefix="dispatch")
+    engine_pools["auth"] = ThreadPoolExecutor(max_workers=config['auth_workers'], thread_name_prefix="auth")
+    engine_pools["bot"] = ThreadPoolExecutor(max_workers=config['bot_workers'], thread_name_prefix="bot")
+    print(f"Serving engine: asyncio (dispatch={config['executor_workers']}, auth={config['auth_workers']}, bot={config['bot_workers']})")
+    while True:
+        try:
+            asyncio.run(_asyncio_serve(config, context))
+        except Exception as e:
+            print(f"Critical error in asyncio serve_loop: {e}")
             time.sleep(1)
 
 def handle_create(user, password, email=""):
-    con = sqlite3.connect(DB)
-    existing = con.execute("SELECT 1 FROM users WHERE LOWER(username)=LOWER(?)", (user,)).fetchone()
+    """Raises _ServerBusy when the password pool's queue is full."""
+    con = _db_connect()
+    existing = con.execute("SELECT 1 FROM users WHERE username_norm=?", (_norm_username(user),)).fetchone()
+    con.close()
     if not existing:
-        con.execute("INSERT INTO users(username,password,email,is_verified) VALUES(?,?,?,1)", (user, _ph.hash(password), email))
-        con.commit(); con.close()
+        db_writer.execute("INSERT INTO users(username,password,email,is_verified) VALUES(?,?,?,1)", (user, hash_password(password), email))
         print(f"User '{user}' created.")
         return True
-    con.close()
     print(f"User '{user}' already exists (case-insensitive match).")
     return False
 
 def handle_ban(user, date_str, reason):
     try: 
         until_date = datetime.datetime.strptime(date_str,"%m/%d/%Y").strftime("%Y-%m-%d")
-        con = sqlite3.connect(DB)
-        con.execute("UPDATE users SET banned_until=?,ban_reason=? WHERE username=?",(until_date, reason, user))
-        con.commit()
-        con.close()
+        db_writer.execute("UPDATE users SET banned_until=?,ban_reason=? WHERE username=?",(until_date, reason, user))
         print(f"User '{user}' banned until {until_date} for: {reason}")
+        session_tokens.revoke_user(user)
         kick_if_banned(user)
     except ValueError: print("Error: Date format must be mm/dd/yyyy")
     except Exception as e: print(f"An error occurred: {e}")
 
 def handle_unban(user):
-    con = sqlite3.connect(DB)
-    con.execute("UPDATE users SET banned_until=NULL,ban_reason=NULL WHERE username=?",(user,))
-    con.commit()
-    con.close()
+    db_writer.execute("UPDATE users SET banned_until=NULL,ban_reason=NULL WHERE username=?",(user,))
     print(f"User '{user}' unbanned.")
 
 def handle_delete(user):
-    con = sqlite3.connect(DB)
-    con.execute("DELETE FROM users WHERE username=?", (user,))
-    con.execute("DELETE FROM contacts WHERE owner=? OR contact=?", (user, user))
-    con.commit()
+    con = _db_connect()
+    contacts = [r[0] for r in con.execute("SELECT contact FROM contacts WHERE owner=?", (user,))]
+    ids = []
+    if history_config['enabled']:
+        ids = [r[0] for r in con.execute("SELECT rowid FROM history_fts WHERE history_fts MATCH ?", (f"conversation:{_member_token(user)}",))]
     con.close()
+    db_writer.transaction([
+        ("DELETE FROM users WHERE username=?", (user,)),
+        ("DELETE FROM contacts WHERE owner=? OR contact=?", (user, user)),
+        ("DELETE FROM offline_messages WHERE recipient=?", (user,)),
+    ])
+    # Conversations are stored once for both people, so this removes the other
+    # person's copy too. Keeping it would hand it to whoever registers the name next.
+    # Chunked so other writers get a turn in between.
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        db_writer.execute(f"DELETE FROM history WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+    _forget_user_contacts(user, contacts)
+    session_tokens.revoke_user(user)
     print(f"User '{user}' and all associated contact data deleted.")
     kick_if_banned(user)
 
+# --- Multi-process mode ---
+# With --workers N the parent process spawns N serving workers on the same port
+# (SO_REUSEPORT) and runs a bus hub on a unix socket. Each worker keeps its own
+# sessions in `clients` plus a _RemoteSession for every user held by another worker,
+# so routing, presence and online checks work unchanged across the cluster.
+# Bus messages are a JSON header line, optionally followed by "n" raw frame bytes.
+
+def _bus_read(f):
+    line = f.readline()
+    if not line:
+        return None, b""
+    header = json.loads(line)
+    n = header.get("n", 0)
+    data = f.read(n) if n else b""
+    return header, data
+
+class _BusLink:
+    def __init__(self, sock):
+        self.sock = sock
+        self._lock = threading.Lock()
+
+    def send(self, header, data=b""):
+        if data:
+            header = dict(header, n=len(data))
+        wire = (json.dumps(header) + "\n").encode() + data
+        with self._lock:
+            self.sock.sendall(wire)
+
+class _BusHub:
+    """Runs in the cluster parent: routes frames to the worker holding each user and
+    replicates presence, transfer and group-call state to every worker."""
+    def __init__(self, path):
+        self.path = path
+        self.links = {}
+        self._state_lock = threading.Lock()
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        os.chmod(path, 0o600)
+        self.listener.listen(64)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                time.sleep(1)
+                continue
+            threading.Thread(target=self._serve_worker, args=(conn,), daemon=True).start()
+
+    def _serve_worker(self, conn):
+        f = conn.makefile("rb")
+        link = _BusLink(conn)
+        try:
+            header, _ = _bus_read(f)
+        except (OSError, ValueError):
+            header = None
+        if not header or header.get("t") != "hello":
+            conn.close()
+            return
+        wid = int(header.get("worker", 0))
+        with self._state_lock:
+            self.links[wid] = link
+            link.send(_bus_snapshot())
+        try:
+            while True:
+                header, data = _bus_read(f)
+                if header is None:
+                    break
+                self.route(header, data, origin=wid)
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._state_lock:
+                if self.links.get(wid) is link:
+                    del self.links[wid]
+            conn.close()
+            _bus_worker_lost(wid)
+
+    def publish(self, header, data=b""):
+        self.route(header, data, origin=0)
+
+    def route(self, header, data, origin):
+        t = header.get("t")
+        metrics.incr("bus.messages_routed")
+        if t in ("deliver", "close", "offline"):
+            link = self.links.get(header.get("worker"))
+            if link:
+                try: link.send(header, data)
+                except OSError: pass
+        elif t in ("presence", "state"):
+            # Applied and forwarded under one lock so a worker's snapshot never
+            # overtakes a change it has not seen yet.
+            with self._state_lock:
+                _apply_bus_message(header, data)
+                for wid, link in list(self.links.items()):
+                    if wid == origin:
+                        continue
+                    try: link.send(header, data)
+                    except OSError: pass
+        elif t == "control":
+            _bus_control(header)
+
+class _BusClient:
+    """A worker's connection to the hub. Losing it means the parent is gone, so the worker exits."""
+    def __init__(self, path, wid):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        self.link = _BusLink(sock)
+        self.ready = threading.Event()
+        self.link.send({"t": "hello", "worker": wid})
+        threading.Thread(target=self._read_loop, args=(sock,), daemon=True).start()
+
+    def publish(self, header, data=b""):
+        metrics.incr("bus.messages_sent")
+        try: self.link.send(header, data)
+        except OSError: pass
+
+    def _read_loop(self, sock):
+        f = sock.makefile("rb")
+        try:
+            while True:
+                header, data = _bus_read(f)
+                if header is None:
+                    break
+                _apply_bus_message(header, data)
+                if header.get("t") == "snapshot":
+                    self.ready.set()
+        except (OSError, ValueError) as e:
+            print(f"Cluster bus error: {e}")
+        print(f"Worker {worker_id} lost its connection to the cluster parent; exiting.")
+        os._exit(1)
+
+def _bus_publish(header, data=b""):
+    if bus is not None:
+        bus.publish(header, data)
+
+def _bus_snapshot():
+    with lock:
+        presence = [{"user": u, "worker": s.worker, "status": client_statuses.get(u, "online")}
+                    for u, s in clients.items() if isinstance(s, _RemoteSession)]
+    with transfer_lock:
+        transfers = dict(pending_transfers)
+    with group_call_lock:
+        calls = {g: {"mode": d.get("mode", "voice"), "participants": sorted(d.get("participants", set()))}
+                 for g, d in group_call_sessions.items()}
+    # Whether history can run was settled by init_db in the parent (it needs FTS5).
+    return {"t": "snapshot", "presence": presence, "transfers": transfers, "group_calls": calls,
+            "history": history_config['enabled']}
+
+def _apply_presence(user, worker, online, status, lost=False):
+    if worker == worker_id:
+        return
+    with lock:
+        cur = clients.get(user)
+        if online:
+            if not (isinstance(cur, _RemoteSession) and cur.worker == worker):
+                clients[user] = _RemoteSession(user, worker)
+            client_statuses[user] = status or "online"
+            return
+        if not (isinstance(cur, _RemoteSession) and cur.worker == worker):
+            return
+        clients.pop(user, None)
+        client_statuses.pop(user, None)
+    if lost:
+        # The owning worker died without sending anything, and only workers hold the
+        # contact index: each one tells its own watchers.
+        _deliver_contact_status(user, False, "offline", local_only=True)
+    # Otherwise the owning worker already sent the leave events; just drop the replica.
+    with group_call_lock:
+        for g, data in list(group_call_sessions.items()):
+            data.get("participants", set()).discard(user)
+            if not data.get("participants"):
+                group_call_sessions.pop(g, None)
+
+def _apply_state(kind, header):
+    if kind == "transfer_set":
+        with transfer_lock:
+            pending_transfers[header["id"]] = header["transfer"]
+    elif kind == "transfer_pop":
+        with transfer_lock:
+            pending_transfers.pop(header["id"], None)
+    elif kind == "group_call_join":
+        with group_call_lock:
+            data = group_call_sessions.setdefault(header["group"], {"mode": header.get("mode", "voice"), "participants": set()})
+            data["mode"] = header.get("mode", data.get("mode", "voice"))
+            data["participants"].add(header["user"])
+    elif kind == "group_call_leave":
+        with group_call_lock:
+            data = group_call_sessions.get(header["group"])
+            if data:
+                data.get("participants", set()).discard(header["user"])
+                if not data.get("participants"):
+                    group_call_sessions.pop(header["group"], None)
+    elif kind == "contact_edge":
+        _contact_changed(header["owner"], header["contact"], header.get("blocked"), publish=False)
+    elif kind == "contact_forget":
+        _forget_user_contacts(header["user"], header.get("contacts", []), publish=False)
+    elif kind == "feature_caps":
+        feature_caps.invalidate(publish=False)
+        threading.Thread(target=_broadcast_feature_caps, daemon=True).start()
+    elif kind == "admins":
+        admin_registry.reload()
+        threading.Thread(target=_broadcast_feature_caps, daemon=True).start()
+    elif kind == "group_policy":
+        group_policy_store.reload()
+    elif kind == "session_revoke":
+        session_tokens.forget_user(header["user"])
+
+def _apply_bus_message(header, data):
+    t = header.get("t")
+    if t == "deliver":
+        with lock:
+            sessions = [clients.get(u) for u in header.get("users", [])]
+        # Frames cross the bus as JSON lines; re-encode only for sessions using another codec.
+        wire = {"json": data}
+        event_key = header.get("event_key")
+        for s in sessions:
+            if not isinstance(s, ClientSession):
+                continue
+            try:
+                if event_key is not None and s.batching:
+                    if "payload" not in wire:
+                        wire["payload"] = json.loads(data)
+                    s.send_event(wire["payload"], event_key)
+                    continue
+                if s.codec not in wire:
+                    wire[s.codec] = _encode_frame(json.loads(data), s.codec)
+                s.sendall(wire[s.codec])
+            except Exception: pass
+    elif t == "close":
+        with lock:
+            s = clients.get(header.get("user"))
+        if isinstance(s, ClientSession):
+            s.close()
+    elif t == "offline":
+        with lock:
+            s = clients.get(header.get("user"))
+        if isinstance(s, ClientSession):
+            # Off the bus thread: this reads the database.
+            threading.Thread(target=_deliver_offline_messages, args=(s, header["user"]), daemon=True).start()
+    elif t == "presence":
+        _apply_presence(header["user"], header["worker"], header["online"], header.get("status"), header.get("lost", False))
+    elif t == "state":
+        _apply_state(header.get("kind"), header)
+    elif t == "snapshot":
+        if "history" in header:
+            history_config['enabled'] = bool(header["history"])
+        for p in header.get("presence", []):
+            _apply_presence(p["user"], p["worker"], True, p.get("status"))
+        with transfer_lock:
+            pending_transfers.update(header.get("transfers", {}))
+        with group_call_lock:
+            for g, d in header.get("group_calls", {}).items():
+                data = group_call_sessions.setdefault(g, {"mode": d.get("mode", "voice"), "participants": set()})
+                data["participants"].update(d.get("participants", []))
+
+def _bus_worker_lost(wid):
+    with lock:
+        users = [u for u, s in clients.items() if isinstance(s, _RemoteSession) and s.worker == wid]
+    if users:
+        print(f"Worker {wid} disconnected from the bus; marking {len(users)} users offline.")
+    for u in users:
+        bus.route({"t": "presence", "user": u, "worker": wid, "online": False, "status": "offline", "lost": True}, b"", origin=0)
+
+def _bus_control(header):
+    op = header.get("op")
+    if op == "restart":
+        _schedule_restart(header.get("seconds", shutdown_timeout), requested_by=header.get("by", "admin"))
+    elif op == "shutdown":
+        def _worker():
+            print(f"Shutdown initiated by admin: {header.get('by', 'admin')}")
+            broadcast_alert(f"The server is shutting down in {shutdown_timeout} seconds.")
+            time.sleep(shutdown_timeout)
+            os._exit(0)
+        threading.Thread(target=_worker, daemon=True).start()
+
+def _spawn_worker(wid, bus_path):
+    args = [sys.executable, os.path.abspath(__file__), "--worker", str(wid), "--bus", bus_path]
+    return subprocess.Popen(args, stdin=subprocess.DEVNULL)
+
+def run_cluster(workers):
+    """Start the bus hub and the serving workers, and respawn any worker that exits."""
+    global bus
+    bus_path = os.path.join(tempfile.gettempdir(), f"thrive-bus-{os.getpid()}.sock")
+    bus = _BusHub(bus_path)
+    with cluster_lock:
+        for wid in range(1, workers + 1):
+            cluster_workers[wid] = _spawn_worker(wid, bus_path)
+    print(f"Cluster mode: {workers} workers sharing port {server_port}.")
+
+    def _monitor():
+        while True:
+            time.sleep(1)
+            with cluster_lock:
+                if cluster_stopping:
+                    return
+                for wid, proc in list(cluster_workers.items()):
+                    if proc.poll() is not None:
+                        print(f"Worker {wid} exited with code {proc.returncode}; restarting it.")
+                        cluster_workers[wid] = _spawn_worker(wid, bus_path)
+
+    threading.Thread(target=_monitor, daemon=True).start()
+
+def _stop_cluster_workers(timeout=10):
+    """Terminate the serving workers and wait for them, so none is left holding the
+    port or running as a zombie after the parent execs itself."""
+    global cluster_stopping
+    with cluster_lock:
+        cluster_stopping = True
+        procs = list(cluster_workers.values())
+        cluster_workers.clear()
+    for proc in procs:
+        if proc.poll() is None:
+            try: proc.terminate()
+            except OSError: pass
+    deadline = time.monotonic() + timeout
+    for proc in procs:
+        try:
+            proc.wait(max(0.1, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            print(f"Worker {proc.pid} did not stop; killing it.")
+            proc.kill()
+            proc.wait()
+
+def _restart_process():
+    _stop_cluster_workers()
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
 def run_cli():
     print("Thrive Server Admin Console")
-    print("Available commands: help, create, ban, unban, del, admin, unadmin, alert, banfile, unbanfile, restart, exit")
+    print("Available commands: help, create, ban, unban, del, admin, unadmin, alert, banfile, unbanfile, stats, queues, ratelimits, retention, restart, exit")
     while True:
         try:
             cmd_line = input("> ").strip()
@@ -2336,7 +5059,7 @@ def run_cli():
             if not parts: continue
             command = parts[0].lower()
             if command == "help":
-                print("Available commands: help, create, ban, unban, del, admin, unadmin, alert, banfile, unbanfile, restart, exit")
+                print("Available commands: help, create, ban, unban, del, admin, unadmin, alert, banfile, unbanfile, stats, queues, ratelimits, retention, restart, exit")
             if command == "exit":
                 broadcast_alert(f"The server is shutting down in {shutdown_timeout} seconds.")
                 print(f"Server shutting down in {shutdown_timeout} seconds...")
@@ -2346,8 +5069,10 @@ def run_cli():
                 broadcast_alert(f"The server is restarting in {shutdown_timeout} seconds.")
                 print(f"Server restarting in {shutdown_timeout} seconds...")
                 time.sleep(shutdown_timeout)
-                os.execv(sys.executable, [sys.executable] + sys.argv)
-            elif command == "create" and len(parts)==3: handle_create(parts[1], parts[2])
+                _restart_process()
+            elif command == "create" and len(parts)==3:
+                try: handle_create(parts[1], parts[2])
+                except _ServerBusy as e: print(e)
             elif command == "ban" and len(parts)>=4: handle_ban(parts[1], parts[2], " ".join(parts[3:]))
             elif command == "unban" and len(parts)==2: handle_unban(parts[1])
             elif command == "del" and len(parts)==2: handle_delete(parts[1])
@@ -2366,17 +5091,54 @@ def run_cli():
                     reason = " ".join(parts[3:])
                 handle_banfile(parts[1], parts[2], date_str, reason)
             elif command == "unbanfile" and len(parts)>=2: handle_unbanfile(parts[1], parts[2] if len(parts)>=3 else None)
+            elif command == "stats" and len(parts)<=2: print(_stats_report(parts[1] if len(parts)==2 else ""))
+            elif command == "retention" and len(parts)==1:
+                if not any(_retention_periods().values()): print("group_retention_days and retention_offline_days are both 0; nothing expires.")
+                else: _run_retention()
+            elif command == "ratelimits" and len(parts)<=2: print(_ratelimits_report(parts[1] if len(parts)==2 else ""))
+            elif command == "queues" and len(parts)<=2: print(_queues_report(int(parts[1]) if len(parts)==2 and parts[1].isdigit() else 10))
             else: print(f"Unknown command or wrong number of arguments for: '{command}'")
         except (KeyboardInterrupt, EOFError): 
             print("\nExiting.")
             os._exit(0)
 
+def _parse_args():
+    parser = argparse.ArgumentParser(description="Thrive Messenger server")
+    parser.add_argument("--workers", type=int, default=None, help="serving processes sharing the port (overrides workers in srv.conf)")
+    parser.add_argument("--worker", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument("--bus", default="", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
 def main():
-    global server_port
+    global server_port, worker_id, bus
+    args = _parse_args()
     config = load_config()
     server_port = config['port']
+    target = serve_loop_asyncio if config['engine'] == "asyncio" else serve_loop
+    if args.worker:
+        worker_id = args.worker
+        _load_contact_index()
+        # Off until the parent's snapshot says whether its init_db could set history up.
+        history_config['enabled'] = False
+        bus = _BusClient(args.bus, worker_id)
+        if not bus.ready.wait(10):
+            print(f"WARNING: Worker {worker_id} got no state from the cluster parent; serving without it.")
+        target(config)
+        return
     init_db()
-    threading.Thread(target=serve_loop, args=(config,), daemon=True).start()
+    if session_config['token_hours']:
+        session_tokens.key()  # create it once here, before any worker reads it
+    if retention_config['interval_minutes']:
+        threading.Thread(target=_retention_worker, daemon=True).start()
+    workers = args.workers if args.workers is not None else config['workers']
+    if workers > 1 and not (hasattr(socket, "AF_UNIX") and hasattr(socket, "SO_REUSEPORT")):
+        print("WARNING: Multiple workers need unix sockets and SO_REUSEPORT; running a single process.")
+        workers = 1
+    if workers > 1:
+        run_cluster(workers)
+    else:
+        _load_contact_index()
+        threading.Thread(target=target, args=(config,), daemon=True).start()
     run_cli()
 
 if __name__=="__main__": main()